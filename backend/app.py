@@ -3,10 +3,15 @@ Queue-Free Healthcare Management System - Complete Flask Backend
 PostgreSQL + Real-time Queue Management + Role-based Authentication
 """
 
-from flask import Flask, request, jsonify
-from sqlalchemy import text, func
+from flask import Flask, Response, g, request, jsonify, has_request_context, stream_with_context
+from flask.json.provider import DefaultJSONProvider
+from sqlalchemy import text, func, event, case, tuple_, bindparam, exc as sa_exc, inspect as sa_inspect
+from sqlalchemy.dialects import postgresql as pg_dialect, sqlite as sqlite_dialect
+from sqlalchemy.orm import Session as OrmSession, aliased, joinedload, object_session
+from sqlalchemy.pool import QueuePool
 from flask_sqlalchemy import SQLAlchemy
-from flask_jwt_extended import JWTManager, create_access_token, jwt_required, get_jwt_identity, get_jwt
+from flask_jwt_extended import (JWTManager, create_access_token, jwt_required, get_jwt_identity, get_jwt,
+                                verify_jwt_in_request)
 from flask_cors import CORS
 from flask_migrate import Migrate
 
@@ -15,15 +20,32 @@ from datetime import datetime, timedelta, time, date, timezone
 from functools import wraps
 from dotenv import load_dotenv
 import os
+import sys
 import re
 import json
 import random
 import uuid
 import re
+import heapq
+import math
+import statistics
+import bisect
+import base64
+import hashlib
+import csv
+import io
 import html
+import decimal
+import operator
+import dataclasses
 import logging
 import threading
-from logging.handlers import RotatingFileHandler
+import tracemalloc
+import click
+from time import monotonic, perf_counter
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
+from collections import OrderedDict, defaultdict, deque
+import queue
 
 # Try to import psutil, provide fallback if not available
 try:
@@ -41,11 +63,207 @@ except ImportError:
     EMAIL_VALIDATOR_AVAILABLE = False
     print("Warning: email_validator not available, using basic email validation")
 
+# Try to import a fast JSON encoder (orjson, then msgspec), provide fallback if not available
+try:
+    import orjson
+    FAST_JSON_BACKEND = 'orjson'
+except ImportError:
+    try:
+        import msgspec
+        FAST_JSON_BACKEND = 'msgspec'
+    except ImportError:
+        FAST_JSON_BACKEND = None
+        print("Warning: orjson/msgspec not available, using standard json encoder")
+
+# Try to import numpy for the capacity simulator, provide fallback if not available
+try:
+    import numpy as np
+    NUMPY_AVAILABLE = True
+except ImportError:
+    NUMPY_AVAILABLE = False
+    print("Warning: numpy not available, capacity simulation disabled")
+
 # Load environment variables
 load_dotenv()
 
 app = Flask(__name__)
 
+# =======================
+# DATABASE POOL INSTRUMENTATION
+# =======================
+
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 10))
+DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', 10))
+# Adaptive mode moves max_overflow between these bounds based on observed checkout wait
+DB_POOL_ADAPTIVE = os.getenv('DB_POOL_ADAPTIVE', 'false').lower() == 'true'
+DB_MAX_OVERFLOW_MIN = int(os.getenv('DB_MAX_OVERFLOW_MIN', 5))
+DB_MAX_OVERFLOW_MAX = int(os.getenv('DB_MAX_OVERFLOW_MAX', 40))
+DB_POOL_WAIT_TARGET_MS = float(os.getenv('DB_POOL_WAIT_TARGET_MS', 50))
+# Connections used within this many seconds skip the liveness ping (0 = ping on every checkout)
+DB_PRE_PING_SKIP_SECONDS = float(os.getenv('DB_PRE_PING_SKIP_SECONDS', 0))
+
+class PoolMetrics:
+    """Thread-safe connection pool counters, grouped by the route that checked out the connection"""
+
+    ADAPT_WINDOW = 50  # Checkouts observed between adaptive overflow adjustments
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._window_waits = []
+        self.routes = {}
+        self.pings_run = 0
+        self.pings_skipped = 0
+        self.overflow_adjustments = []
+
+    def _current_route(self):
+        if has_request_context() and request.url_rule is not None:
+            return request.url_rule.rule
+        return '<background>'
+
+    def _route_bucket(self, route):
+        if route not in self.routes:
+            self.routes[route] = {
+                'checkouts': 0,
+                'timeouts': 0,
+                'wait_ms_total': 0.0,
+                'wait_ms_max': 0.0,
+                'peak_in_use': 0,
+                'peak_overflow': 0
+            }
+        return self.routes[route]
+
+    def record_checkout(self, pool, wait_ms):
+        route = self._current_route()
+        with self._lock:
+            bucket = self._route_bucket(route)
+            bucket['checkouts'] += 1
+            bucket['wait_ms_total'] += wait_ms
+            bucket['wait_ms_max'] = max(bucket['wait_ms_max'], wait_ms)
+            bucket['peak_in_use'] = max(bucket['peak_in_use'], pool.checkedout())
+            bucket['peak_overflow'] = max(bucket['peak_overflow'], pool.overflow())
+            self._observe_wait(pool, wait_ms)
+
+    def record_timeout(self, pool, wait_ms):
+        route = self._current_route()
+        with self._lock:
+            bucket = self._route_bucket(route)
+            bucket['timeouts'] += 1
+            bucket['wait_ms_max'] = max(bucket['wait_ms_max'], wait_ms)
+            self._observe_wait(pool, wait_ms)
+        app.logger.warning(f'Connection pool timeout on {route} after {wait_ms:.0f}ms '
+                           f'(in use: {pool.checkedout()}, overflow: {max(pool.overflow(), 0)})')
+
+    def record_ping(self, skipped):
+        with self._lock:
+            if skipped:
+                self.pings_skipped += 1
+            else:
+                self.pings_run += 1
+
+    def _observe_wait(self, pool, wait_ms):
+        """Collect waits and, in adaptive mode, resize max_overflow once per window (caller holds lock)"""
+        if not DB_POOL_ADAPTIVE:
+            return
+        self._window_waits.append(wait_ms)
+        if len(self._window_waits) < self.ADAPT_WINDOW:
+            return
+
+        waits = sorted(self._window_waits)
+        self._window_waits = []
+        p90_wait = waits[int(len(waits) * 0.9) - 1]
+
+        current = pool._max_overflow
+        new_overflow = current
+        if p90_wait > DB_POOL_WAIT_TARGET_MS:
+            new_overflow = min(max(current * 2, 1), DB_MAX_OVERFLOW_MAX)
+        elif p90_wait < DB_POOL_WAIT_TARGET_MS / 4:
+            new_overflow = max(current - 1, DB_MAX_OVERFLOW_MIN)
+
+        if new_overflow != current:
+            pool._max_overflow = new_overflow
+            self.overflow_adjustments.append({
+                'from': current,
+                'to': new_overflow,
+                'p90_wait_ms': round(p90_wait, 2),
+                'timestamp': datetime.now(timezone.utc).isoformat()
+            })
+            self.overflow_adjustments = self.overflow_adjustments[-20:]
+            app.logger.info(f'Adaptive pool: max_overflow {current} -> {new_overflow} (p90 wait {p90_wait:.1f}ms)')
+
+    def snapshot(self, pool):
+        with self._lock:
+            routes = {}
+            for route, bucket in self.routes.items():
+                routes[route] = dict(bucket)
+                routes[route]['wait_ms_avg'] = round(bucket['wait_ms_total'] / bucket['checkouts'], 3) if bucket['checkouts'] else 0.0
+                routes[route]['wait_ms_total'] = round(bucket['wait_ms_total'], 3)
+                routes[route]['wait_ms_max'] = round(bucket['wait_ms_max'], 3)
+
+            result = {
+                'pool_class': type(pool).__name__,
+                'adaptive': DB_POOL_ADAPTIVE,
+                'pre_ping_skip_seconds': DB_PRE_PING_SKIP_SECONDS,
+                'pings_run': self.pings_run,
+                'pings_skipped': self.pings_skipped,
+                'overflow_adjustments': list(self.overflow_adjustments),
+                'routes': routes
+            }
+
+        if isinstance(pool, QueuePool):
+            result.update({
+                'size': pool.size(),
+                'checked_in': pool.checkedin(),
+                'in_use': pool.checkedout(),
+                'overflow': max(pool.overflow(), 0),
+                'max_overflow': pool._max_overflow,
+                'timeout': pool.timeout()
+            })
+        return result
+
+pool_metrics = PoolMetrics()
+
+class InstrumentedQueuePool(QueuePool):
+    """QueuePool that times how long each checkout waits for a free connection"""
+
+    def _do_get(self):
+        started = perf_counter()
+        try:
+            record = super()._do_get()
+        except sa_exc.TimeoutError:
+            pool_metrics.record_timeout(self, (perf_counter() - started) * 1000)
+            raise
+        pool_metrics.record_checkout(self, (perf_counter() - started) * 1000)
+        return record
+
+def install_pool_instrumentation(engine):
+    """Attach pool event hooks: connection freshness tracking and the optional cheap pre-ping"""
+
+    @event.listens_for(engine, 'connect')
+    def on_connect(dbapi_connection, connection_record):
+        connection_record.info['last_used'] = monotonic()
+
+    @event.listens_for(engine, 'checkin')
+    def on_checkin(dbapi_connection, connection_record):
+        if connection_record is not None:
+            connection_record.info['last_used'] = monotonic()
+
+    if DB_PRE_PING_SKIP_SECONDS > 0:
+        @event.listens_for(engine, 'checkout')
+        def on_checkout(dbapi_connection, connection_record, connection_proxy):
+            idle = monotonic() - connection_record.info.get('last_used', 0)
+            if idle < DB_PRE_PING_SKIP_SECONDS:
+                pool_metrics.record_ping(skipped=True)
+                return
+
+            pool_metrics.record_ping(skipped=False)
+            try:
+                cursor = dbapi_connection.cursor()
+                cursor.execute('SELECT 1')
+                cursor.close()
+            except Exception:
+                # Tells the pool to discard this connection and retry with a fresh one
+                raise sa_exc.DisconnectionError()
+
 # Database Configuration - Using environment variables
 DATABASE_URL = os.getenv('DATABASE_URL')
 if not DATABASE_URL:
@@ -54,9 +272,12 @@ if not DATABASE_URL:
 app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URL
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
-    'pool_pre_ping': True,
+    'poolclass': InstrumentedQueuePool,
+    # Built-in pre-ping is replaced by the checkout hook when a skip window is configured
+    'pool_pre_ping': DB_PRE_PING_SKIP_SECONDS <= 0,
     'pool_recycle': int(os.getenv('DB_POOL_RECYCLE', 3600)),
-    'pool_size': int(os.getenv('DB_POOL_SIZE', 10)),
+    'pool_size': DB_POOL_SIZE,
+    'max_overflow': DB_MAX_OVERFLOW,
     'pool_timeout': int(os.getenv('DB_POOL_TIMEOUT', 20)),
 }
 
@@ -79,13 +300,17 @@ db = SQLAlchemy(app)
 jwt = JWTManager(app)
 migrate = Migrate(app, db)
 
+with app.app_context():
+    install_pool_instrumentation(db.engine)
+
 # CORS Configuration - allow any localhost port for local development
 # Generates a list covering ports 3000-3099 so Vite can rotate freely
 _env_origins = [o.strip() for o in os.getenv('ALLOWED_ORIGINS', '').split(',') if o.strip()]
 _localhost_ports = [f'http://localhost:{p}' for p in range(3000, 3100)] + \
                    [f'http://127.0.0.1:{p}' for p in range(3000, 3100)]
 _all_origins = list(set(_env_origins + _localhost_ports))
-CORS(app, resources={r"/*": {"origins": _all_origins}}, supports_credentials=False)
+CORS(app, resources={r"/*": {"origins": _all_origins}}, supports_credentials=False,
+     expose_headers=['ETag', 'X-Queue-Version', 'X-Low-Stock-Version'])
 
 # No SocketIO or rate limiter - pure REST API
 
@@ -370,6 +595,199 @@ def log_api_request(f):
 # Call setup_logging
 setup_logging()
 
+# =======================
+# TRAFFIC RECORDING
+# =======================
+
+# Opt-in: set TRAFFIC_RECORD_PATH to append one compact JSON line per API request, for
+# replay against a test instance with benchmarks/replay.py. Only metadata is written: the
+# route rule instead of the path, the shape of query strings and JSON bodies instead of
+# their values, the caller's role and a salted key standing in for the user.
+TRAFFIC_RECORD_PATH = os.getenv('TRAFFIC_RECORD_PATH')
+TRAFFIC_RECORD_MAX_BYTES = int(os.getenv('TRAFFIC_RECORD_MAX_BYTES', 100 * 1024 * 1024))
+TRAFFIC_RECORD_SALT = os.getenv('TRAFFIC_RECORD_SALT') or os.getenv('SECRET_KEY', '')
+# Query parameters whose values identify nobody and change what the endpoint does
+TRAFFIC_QUERY_VALUES = frozenset({
+    'limit', 'page', 'total', 'status', 'scope', 'include', 'fields', 'days', 'date', 'start', 'end',
+    'include_unavailable', 'priority', 'sort', 'order', 'format'
+})
+
+traffic_logger = None
+
+def setup_traffic_recording(path=TRAFFIC_RECORD_PATH):
+    """Write records through a queue so requests never wait on the file"""
+    global traffic_logger
+    if not path:
+        return None
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    file_handler = RotatingFileHandler(path, maxBytes=TRAFFIC_RECORD_MAX_BYTES, backupCount=5)
+    file_handler.setFormatter(logging.Formatter('%(message)s'))
+    records = queue.SimpleQueue()
+    QueueListener(records, file_handler).start()
+    
+    traffic_logger = logging.getLogger('queuefree.traffic')
+    traffic_logger.setLevel(logging.INFO)
+    traffic_logger.propagate = False
+    traffic_logger.addHandler(QueueHandler(records))
+    app.logger.info(f'Recording API traffic to {path}')
+    return traffic_logger
+
+def traffic_shape(value):
+    """Structure of a JSON value with every leaf replaced by its type name; lists keep one element"""
+    if isinstance(value, dict):
+        return {key: traffic_shape(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [traffic_shape(value[0])] if value else []
+    return type(value).__name__
+
+def _traffic_user_key(value):
+    return hashlib.blake2b(f'{TRAFFIC_RECORD_SALT}:{value}'.encode(), digest_size=6).hexdigest()
+
+@app.before_request
+def start_traffic_timer():
+    if traffic_logger:
+        g.traffic_started = perf_counter()
+
+@app.after_request
+def record_traffic(response):
+    started = g.pop('traffic_started', None)
+    if started is None or request.url_rule is None or not request.path.startswith('/api/'):
+        return response
+    try:
+        role = identity = None
+        try:
+            if verify_jwt_in_request(optional=True):
+                claims = get_jwt()
+                role, identity = claims.get('role'), claims.get('sub')
+        except Exception:
+            pass  # expired or malformed tokens are recorded as anonymous
+        client = request.environ.get('HTTP_X_FORWARDED_FOR', request.remote_addr)
+        record = {
+            't': round(datetime.now(timezone.utc).timestamp(), 3),
+            'm': request.method,
+            'r': request.url_rule.rule,
+            's': response.status_code,
+            'd': round((perf_counter() - started) * 1000, 2),
+            'u': role,
+            'k': _traffic_user_key(f'user:{identity}' if identity is not None else f'ip:{client}'),
+        }
+        if request.args:
+            record['q'] = {
+                name: value if name in TRAFFIC_QUERY_VALUES else ('int' if value.isdigit() else 'str')
+                for name, value in request.args.items()
+            }
+        if request.is_json:
+            body = request.get_json(silent=True)
+            if body is not None:
+                record['b'] = traffic_shape(body)
+        if response.content_length is not None:
+            record['z'] = response.content_length
+        traffic_logger.info(json.dumps(record, separators=(',', ':')))
+    except Exception as e:
+        app.logger.debug(f'Traffic record skipped: {e}')
+    return response
+
+setup_traffic_recording()
+
+# =======================
+# JSON SERIALIZATION
+# =======================
+
+# Row dataclass -> field names, for the standard-library fallback encoder
+_JSON_ROW_KEYS = {}
+
+def _json_default(o):
+    """Encode types the JSON backends don't handle natively (ISO 8601 for all temporal values)"""
+    if isinstance(o, (datetime, date, time)):
+        return o.isoformat()
+    if isinstance(o, uuid.UUID):
+        return str(o)
+    if isinstance(o, decimal.Decimal):
+        return float(o)
+    if type(o) in _JSON_ROW_KEYS:
+        return {key: getattr(o, key) for key in _JSON_ROW_KEYS[type(o)]}
+    if dataclasses.is_dataclass(o):
+        return dataclasses.asdict(o)
+    if isinstance(o, (set, frozenset)):
+        return list(o)
+    raise TypeError(f"Object of type {type(o).__name__} is not JSON serializable")
+
+if FAST_JSON_BACKEND == 'msgspec':
+    _msgspec_encoder = msgspec.json.Encoder(enc_hook=_json_default)
+
+class FastJSONProvider(DefaultJSONProvider):
+    """
+    Flask JSON provider backed by orjson or msgspec when installed. datetime, date,
+    time, UUID and dataclass rows are encoded natively; the stdlib fallback produces
+    the same ISO 8601 output.
+    """
+
+    def _encode(self, obj, pretty=False):
+        if FAST_JSON_BACKEND == 'orjson':
+            option = orjson.OPT_NON_STR_KEYS | (orjson.OPT_INDENT_2 if pretty else 0)
+            return orjson.dumps(obj, default=_json_default, option=option)
+        if FAST_JSON_BACKEND == 'msgspec' and not pretty:
+            return _msgspec_encoder.encode(obj)
+        if pretty:
+            return json.dumps(obj, default=_json_default, indent=2).encode()
+        return json.dumps(obj, default=_json_default, separators=(',', ':')).encode()
+
+    def dumps(self, obj, **kwargs):
+        return self._encode(obj, pretty=bool(kwargs.get('indent'))).decode()
+
+    def loads(self, s, **kwargs):
+        if FAST_JSON_BACKEND == 'orjson':
+            return orjson.loads(s)
+        if FAST_JSON_BACKEND == 'msgspec':
+            return msgspec.json.decode(s)
+        return json.loads(s, **kwargs)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        pretty = (self.compact is None and self._app.debug) or self.compact is False
+        return self._app.response_class(self._encode(obj, pretty) + b'\n', mimetype=self.mimetype)
+
+app.json = FastJSONProvider(app)
+
+class RowSchema:
+    """
+    List serializer compiled once per model: one attrgetter pulls every column and a
+    slots dataclass holds the row, so building a row is a single constructor call
+    instead of a per-field dict with isoformat()/strftime calls. Temporal values are
+    left for the JSON provider to encode natively.
+
+    Rows can be built from ORM instances (row/rows) or, for read-only lists, straight
+    from a column-only select (columns/fetch) so no instances enter the identity map.
+    """
+
+    def __init__(self, name, fields, computed=(), extras=()):
+        # fields: (key, attribute) pairs; computed: (key, fn(obj, context)); extras: keys passed per row
+        self.attrs = tuple(attr for _, attr in fields)
+        self._getter = operator.attrgetter(*self.attrs)
+        self._single_field = len(fields) == 1
+        self._computed = tuple(fn for _, fn in computed)
+        self.keys = tuple(key for key, _ in fields) + tuple(key for key, _ in computed) + tuple(extras)
+        self.row_type = dataclasses.make_dataclass(name, self.keys, slots=True)
+        _JSON_ROW_KEYS[self.row_type] = self.keys
+
+    def row(self, obj, context=None, extras=()):
+        values = self._getter(obj)
+        if self._single_field:
+            values = (values,)
+        return self.row_type(*values, *[fn(obj, context) for fn in self._computed], *extras)
+
+    def rows(self, objs, context=None):
+        return [self.row(obj, context) for obj in objs]
+
+    def columns(self, model):
+        """Labelled column expressions for the plain fields of a column-only select"""
+        return [getattr(model, attr).label(attr) for attr in self.attrs]
+
+    def fetch(self, statement, context=None):
+        """Execute a column-only select and build rows without materializing ORM instances"""
+        return [self.row(record, context) for record in db.session.execute(statement)]
+
 # =======================
 # DATABASE MODELS
 # =======================
@@ -499,6 +917,15 @@ class Appointment(db.Model):
     priority = db.Column(db.String(10), default='normal')
     doctor_notes = db.Column(db.Text)
     created_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
+    # Doctor-day queue version of the last transition that touched this row (delta sync)
+    queue_version = db.Column(db.Integer, nullable=False, default=0)
+    # Local time the patient was called in / the consultation ended (analytics rollups)
+    actual_start_time = db.Column(db.DateTime)
+    actual_end_time = db.Column(db.DateTime)
+
+    __table_args__ = (
+        db.Index('ix_appointment_queue_version', 'doctor_id', 'appointment_date', 'queue_version'),
+    )
 
     patient = db.relationship('User', foreign_keys=[patient_id])
     doctor = db.relationship('User', foreign_keys=[doctor_id])
@@ -527,6 +954,10 @@ class Appointment(db.Model):
             'created_at': self.created_at.isoformat() if self.created_at else None
         }
 
+# Prescriptions still waiting at the counter; their pickup tokens must be unique per day
+ACTIVE_PHARMACY_STATUSES = ('pending', 'preparing', 'ready')
+ACTIVE_PICKUP_PREDICATE = "pharmacy_status IN ('pending', 'preparing', 'ready')"
+
 class Prescription(db.Model):
     __tablename__ = 'prescriptions'
     
@@ -538,11 +969,27 @@ class Prescription(db.Model):
     pharmacy_status = db.Column(db.String(20), default='pending')  # pending, preparing, ready, dispensed, cancelled
     pharmacy_notes = db.Column(db.Text)
     pickup_token = db.Column(db.String(10))
+    pickup_date = db.Column(db.Date)  # day the pickup token was issued for
     is_deleted = db.Column(db.Boolean, default=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     dispensed_at = db.Column(db.DateTime)
     
+    __table_args__ = (
+        # Keyset pagination for the pharmacy records list walks (created_at, id) backwards
+        db.Index('ix_prescription_created_id', 'created_at', 'id'),
+        # The same walk filtered to one pharmacy status (the pending work queue)
+        db.Index('ix_prescription_status_created', 'pharmacy_status', 'created_at', 'id'),
+        # Patient-name side of the pharmacy search (patient_id IN the name matches)
+        db.Index('ix_prescription_patient', 'patient_id'),
+        # Exact pickup-token lookups (search fast path)
+        db.Index('ix_prescription_pickup_token', 'pickup_token'),
+        # Counter lookups: one active prescription per (day, token)
+        db.Index('uq_prescription_active_pickup', 'pickup_date', 'pickup_token', unique=True,
+                 postgresql_where=db.text(ACTIVE_PICKUP_PREDICATE),
+                 sqlite_where=db.text(ACTIVE_PICKUP_PREDICATE)),
+    )
+    
     appointment = db.relationship('Appointment', backref=db.backref('prescriptions', lazy=True))
     patient = db.relationship('User', foreign_keys=[patient_id])
     doctor = db.relationship('User', foreign_keys=[doctor_id])
@@ -562,12 +1009,25 @@ class Prescription(db.Model):
             'pharmacy_status': self.pharmacy_status,
             'pharmacy_notes': self.pharmacy_notes,
             'pickup_token': self.pickup_token,
+            'pickup_date': self.pickup_date.isoformat() if self.pickup_date else None,
             'is_deleted': self.is_deleted,
             'created_at': self.created_at.isoformat(),
             'updated_at': self.updated_at.isoformat() if self.updated_at else None,
             'dispensed_at': self.dispensed_at.isoformat() if self.dispensed_at else None
         }
 
+def medicine_stock_status(stock_quantity, reorder_level):
+    """'critical' at half the reorder level or below, 'low' at or below it, else 'available'"""
+    stock_quantity = stock_quantity or 0
+    reorder_level = reorder_level or 0
+    if stock_quantity <= reorder_level // 2:
+        return 'critical'
+    if stock_quantity <= reorder_level:
+        return 'low'
+    return 'available'
+
+LOW_STOCK_PREDICATE = 'stock_quantity <= reorder_level'
+
 class Medicine(db.Model):
     __tablename__ = 'medicines'
     
@@ -577,9 +1037,12 @@ class Medicine(db.Model):
     category = db.Column(db.String(50))
     strength = db.Column(db.String(20))
     form = db.Column(db.String(20))  # tablet, capsule, syrup, etc.
+    # Current receiving batch; per-batch quantities and expiries live in medicine_batches
     batch_number = db.Column(db.String(50))
     price_per_unit = db.Column(db.Float, default=0.0)
     stock_quantity = db.Column(db.Integer, default=0)
+    # Units held by undispensed prescriptions; available-to-promise is stock - reserved
+    reserved_quantity = db.Column(db.Integer, nullable=False, default=0)
     reorder_level = db.Column(db.Integer, default=10)
     expiry_date = db.Column(db.Date)
     manufacturer = db.Column(db.String(100))
@@ -591,25 +1054,26 @@ class Medicine(db.Model):
     __table_args__ = (
         # Prevent negative stock quantities
         db.CheckConstraint('stock_quantity >= 0', name='ck_stock_non_negative'),
+        db.CheckConstraint('reserved_quantity >= 0', name='ck_reserved_non_negative'),
         # Prevent negative prices
         db.CheckConstraint('price_per_unit >= 0', name='ck_price_non_negative'),
         # Prevent negative reorder levels
         db.CheckConstraint('reorder_level >= 0', name='ck_reorder_non_negative'),
         # Ensure medicine names are unique (case-insensitive)
-        db.Index('ix_medicine_name_unique', func.lower('name'), unique=True),
+        db.Index('ix_medicine_name_lower_unique', func.lower(name), unique=True),
         # Ensure batch numbers are unique when provided
         db.Index('ix_batch_number_unique', 'batch_number', unique=True, 
                 postgresql_where=db.text('batch_number IS NOT NULL')),
         # Index for faster stock lookups
         db.Index('ix_medicine_stock_status', 'is_available', 'stock_quantity'),
+        # Low-stock tracker loads through this; it only holds rows at or below reorder level
+        db.Index('ix_medicine_low_stock', 'id',
+                 postgresql_where=db.text(LOW_STOCK_PREDICATE),
+                 sqlite_where=db.text(LOW_STOCK_PREDICATE)),
     )
     
     def to_dict(self):
-        stock_status = 'available'
-        if self.stock_quantity < 10:
-            stock_status = 'critical'
-        elif self.stock_quantity < 50:
-            stock_status = 'low'
+        stock_status = medicine_stock_status(self.stock_quantity, self.reorder_level)
         
         return {
             'id': self.id,
@@ -621,6 +1085,8 @@ class Medicine(db.Model):
             'batch_number': self.batch_number,
             'price_per_unit': self.price_per_unit,
             'stock_quantity': self.stock_quantity,
+            'reserved_quantity': self.reserved_quantity,
+            'available_quantity': self.stock_quantity - self.reserved_quantity,
             'stock_status': stock_status,
             'reorder_level': self.reorder_level,
             'expiry_date': self.expiry_date.isoformat() if self.expiry_date else None,
@@ -630,6 +1096,64 @@ class Medicine(db.Model):
             'updated_at': self.updated_at.isoformat() if self.updated_at else None
         }
 
+class MedicineBatch(db.Model):
+    __tablename__ = 'medicine_batches'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    medicine_id = db.Column(db.Integer, db.ForeignKey('medicines.id'), nullable=False)
+    batch_number = db.Column(db.String(50))  # NULL for stock received without a batch
+    quantity = db.Column(db.Integer, nullable=False, default=0)
+    expiry_date = db.Column(db.Date)
+    received_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    __table_args__ = (
+        db.CheckConstraint('quantity >= 0', name='ck_batch_quantity_non_negative'),
+        db.Index('ix_batch_medicine_number', 'medicine_id', 'batch_number'),
+        # FEFO draw order per medicine, and the expiring-soon report; both skip empty batches
+        db.Index('ix_batch_fefo', 'medicine_id', 'expiry_date', 'id',
+                 postgresql_where=db.text('quantity > 0'), sqlite_where=db.text('quantity > 0')),
+        db.Index('ix_batch_expiry', 'expiry_date',
+                 postgresql_where=db.text('quantity > 0'), sqlite_where=db.text('quantity > 0')),
+    )
+    
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'medicine_id': self.medicine_id,
+            'batch_number': self.batch_number,
+            'quantity': self.quantity,
+            'expiry_date': self.expiry_date.isoformat() if self.expiry_date else None,
+            'received_at': self.received_at.isoformat() if self.received_at else None
+        }
+
+class StockReservation(db.Model):
+    __tablename__ = 'stock_reservations'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    prescription_id = db.Column(db.Integer, db.ForeignKey('prescriptions.id'), nullable=False)
+    medicine_id = db.Column(db.Integer, db.ForeignKey('medicines.id'), nullable=False)
+    quantity = db.Column(db.Integer, nullable=False)
+    status = db.Column(db.String(20), nullable=False, default='held')  # held, converted, released, expired
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    expires_at = db.Column(db.DateTime, nullable=False)
+    released_at = db.Column(db.DateTime)
+    
+    __table_args__ = (
+        db.CheckConstraint('quantity > 0', name='ck_reservation_quantity_positive'),
+        db.Index('ix_reservation_prescription_status', 'prescription_id', 'status'),
+        # Expiry sweep only ever looks at live holds
+        db.Index('ix_reservation_held_expiry', 'expires_at',
+                 postgresql_where=db.text("status = 'held'"),
+                 sqlite_where=db.text("status = 'held'")),
+    )
+
+class PickupTokenCounter(db.Model):
+    __tablename__ = 'pickup_token_counters'
+    
+    token_date = db.Column(db.Date, primary_key=True)
+    last_value = db.Column(db.Integer, nullable=False, default=0)
+
 class QueueLog(db.Model):
     __tablename__ = 'queue_logs'
     
@@ -641,6 +1165,43 @@ class QueueLog(db.Model):
     
     appointment = db.relationship('Appointment', backref=db.backref('queue_logs', lazy=True))
 
+class QueueVersion(db.Model):
+    __tablename__ = 'queue_versions'
+    
+    doctor_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+    queue_date = db.Column(db.Date, primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+class DailyAppointmentRollup(db.Model):
+    __tablename__ = 'daily_appointment_rollups'
+    
+    rollup_date = db.Column(db.Date, primary_key=True)
+    scope = db.Column(db.String(20), primary_key=True)  # doctor, department
+    scope_id = db.Column(db.String(36), primary_key=True)  # doctor user id or department id
+    hospital_id = db.Column(db.String(36))
+    department_id = db.Column(db.String(36))
+    appointments = db.Column(db.Integer, nullable=False, default=0)
+    completed = db.Column(db.Integer, nullable=False, default=0)
+    cancelled = db.Column(db.Integer, nullable=False, default=0)
+    no_shows = db.Column(db.Integer, nullable=False, default=0)
+    # Minutes from the booked slot to being called in
+    wait_samples = db.Column(db.Integer, nullable=False, default=0)
+    wait_total_minutes = db.Column(db.Float, nullable=False, default=0.0)
+    wait_median_minutes = db.Column(db.Float)
+    wait_p90_minutes = db.Column(db.Float)
+    # Minutes from being called in to the consultation ending
+    consult_samples = db.Column(db.Integer, nullable=False, default=0)
+    consult_total_minutes = db.Column(db.Float, nullable=False, default=0.0)
+    consult_median_minutes = db.Column(db.Float)
+    consult_p90_minutes = db.Column(db.Float)
+    # Doctor rows: queue version the row was built from (intraday refresh skips unchanged days)
+    source_version = db.Column(db.Integer)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        db.Index('ix_rollup_scope_date', 'scope', 'scope_id', 'rollup_date'),
+    )
+
 class AuditLog(db.Model):
     __tablename__ = 'audit_logs'
     
@@ -683,6 +1244,277 @@ class AuditLog(db.Model):
             'error_message': self.error_message
         }
 
+# Schema-based list serializers - same fields as to_dict(), without the per-row formatting
+def _hhmm(value):
+    return value.strftime('%H:%M') if value else None
+
+def _medicine_stock_status(medicine, context):
+    return medicine_stock_status(medicine.stock_quantity, medicine.reorder_level)
+
+def _appointment_profile(appt, profiles):
+    return profiles.get(appt.doctor_id) if profiles else None
+
+APPOINTMENT_ROW_FIELDS = [
+    ('id', 'id'),
+    ('appointment_date', 'appointment_date'),
+    ('token_number', 'token_number'),
+    ('symptoms', 'symptoms'),
+    ('status', 'status'),
+    ('priority', 'priority'),
+    ('doctor_notes', 'doctor_notes'),
+    ('created_at', 'created_at'),
+]
+APPOINTMENT_ROW_COMPUTED = [
+    ('patient_name', lambda a, ctx: a.patient_name or (a.patient.full_name if a.patient else None)),
+    ('doctor_name', lambda a, ctx: a.doctor.full_name if a.doctor else None),
+    ('hospital_name', lambda a, ctx: a.hospital.name if a.hospital else None),
+    ('department_name', lambda a, ctx: a.department.name if a.department else None),
+    ('specialization', lambda a, ctx: getattr(_appointment_profile(a, ctx), 'specialization', None)),
+    ('consultation_fee', lambda a, ctx: getattr(_appointment_profile(a, ctx), 'consultation_fee', None)),
+    ('appointment_time', lambda a, ctx: _hhmm(a.appointment_time)),
+]
+APPOINTMENT_ROWS = RowSchema('AppointmentRow', APPOINTMENT_ROW_FIELDS, APPOINTMENT_ROW_COMPUTED)
+QUEUE_APPOINTMENT_ROWS = RowSchema(
+    'QueueAppointmentRow', APPOINTMENT_ROW_FIELDS, APPOINTMENT_ROW_COMPUTED,
+    extras=('queue_position', 'schedule_reason')
+)
+# Eager loads that keep APPOINTMENT_ROWS from lazy-loading relations per row
+APPOINTMENT_ROW_LOADERS = (
+    joinedload(Appointment.patient),
+    joinedload(Appointment.doctor),
+    joinedload(Appointment.hospital),
+    joinedload(Appointment.department),
+)
+
+def appointment_row_context(appointments):
+    """Doctor profiles for a batch of appointments, fetched in one query"""
+    doctor_ids = {appt.doctor_id for appt in appointments}
+    if not doctor_ids:
+        return {}
+    return {
+        profile.user_id: profile
+        for profile in DoctorProfile.query.filter(DoctorProfile.user_id.in_(doctor_ids)).all()
+    }
+
+PRESCRIPTION_ROW_FIELDS = [
+    ('id', 'id'),
+    ('appointment_id', 'appointment_id'),
+    ('patient_id', 'patient_id'),
+    ('doctor_id', 'doctor_id'),
+    ('prescription_data', 'prescription_data'),
+    ('pharmacy_status', 'pharmacy_status'),
+    ('pharmacy_notes', 'pharmacy_notes'),
+    ('pickup_token', 'pickup_token'),
+    ('pickup_date', 'pickup_date'),
+    ('is_deleted', 'is_deleted'),
+    ('created_at', 'created_at'),
+    ('updated_at', 'updated_at'),
+    ('dispensed_at', 'dispensed_at'),
+]
+PRESCRIPTION_ROWS = RowSchema('PrescriptionRow', PRESCRIPTION_ROW_FIELDS, computed=[
+    ('token_number', lambda p, ctx: p.appointment.token_number if p.appointment else None),
+    ('appointment_time', lambda p, ctx: _hhmm(p.appointment.appointment_time) if p.appointment else None),
+    ('patient_name', lambda p, ctx: p.patient.full_name if p.patient else 'Unknown Patient'),
+    ('doctor_name', lambda p, ctx: p.doctor.full_name if p.doctor else 'Unknown Doctor'),
+])
+PRESCRIPTION_ROW_LOADERS = (
+    joinedload(Prescription.appointment),
+    joinedload(Prescription.patient),
+    joinedload(Prescription.doctor),
+)
+# Read-only variant fed by prescription_list_select(): relations arrive as joined columns
+PRESCRIPTION_LIST_ROWS = RowSchema('PrescriptionListRow', PRESCRIPTION_ROW_FIELDS, computed=[
+    ('token_number', lambda r, ctx: r.token_number),
+    ('appointment_time', lambda r, ctx: _hhmm(r.appointment_time)),
+    ('patient_name', lambda r, ctx: r.patient_full_name or 'Unknown Patient'),
+    ('doctor_name', lambda r, ctx: r.doctor_full_name or 'Unknown Doctor'),
+])
+
+def prescription_list_select():
+    """Column-only select for PRESCRIPTION_LIST_ROWS; callers add filters and ordering"""
+    patient = aliased(User)
+    doctor = aliased(User)
+    return db.select(
+        *PRESCRIPTION_LIST_ROWS.columns(Prescription),
+        Appointment.token_number.label('token_number'),
+        Appointment.appointment_time.label('appointment_time'),
+        patient.full_name.label('patient_full_name'),
+        doctor.full_name.label('doctor_full_name'),
+    ).outerjoin(Appointment, Prescription.appointment_id == Appointment.id) \
+     .outerjoin(patient, Prescription.patient_id == patient.id) \
+     .outerjoin(doctor, Prescription.doctor_id == doctor.id)
+
+MEDICINE_ROWS = RowSchema('MedicineRow', [
+    ('id', 'id'),
+    ('name', 'name'),
+    ('generic_name', 'generic_name'),
+    ('category', 'category'),
+    ('strength', 'strength'),
+    ('form', 'form'),
+    ('batch_number', 'batch_number'),
+    ('price_per_unit', 'price_per_unit'),
+    ('stock_quantity', 'stock_quantity'),
+    ('reserved_quantity', 'reserved_quantity'),
+    ('reorder_level', 'reorder_level'),
+    ('expiry_date', 'expiry_date'),
+    ('manufacturer', 'manufacturer'),
+    ('is_available', 'is_available'),
+    ('created_at', 'created_at'),
+    ('updated_at', 'updated_at'),
+], computed=[
+    ('available_quantity', lambda m, ctx: m.stock_quantity - m.reserved_quantity),
+    ('stock_status', _medicine_stock_status),
+])
+
+AUDIT_LOG_LIST_ROWS = RowSchema('AuditLogListRow', [
+    ('id', 'id'),
+    ('user_id', 'user_id'),
+    ('action_type', 'action_type'),
+    ('resource_type', 'resource_type'),
+    ('resource_id', 'resource_id'),
+    ('action_details', 'action_details'),
+    ('ip_address', 'ip_address'),
+    ('session_id', 'session_id'),
+    ('timestamp', 'timestamp'),
+    ('success', 'success'),
+    ('error_message', 'error_message'),
+], computed=[
+    ('user_name', lambda r, ctx: r.username or 'System'),
+])
+
+def audit_log_list_select():
+    """Column-only select for AUDIT_LOG_LIST_ROWS; callers add filters and ordering"""
+    return db.select(*AUDIT_LOG_LIST_ROWS.columns(AuditLog), User.username.label('username')) \
+        .outerjoin(User, AuditLog.user_id == User.id)
+
+# Pharmacy inventory view - a subset of the medicine columns under the names the UI expects
+INVENTORY_ROWS = RowSchema('InventoryRow', [
+    ('id', 'id'),
+    ('medicine_name', 'name'),
+    ('generic_name', 'generic_name'),
+    ('category', 'category'),
+    ('quantity_in_stock', 'stock_quantity'),
+    ('quantity_reserved', 'reserved_quantity'),
+    ('reorder_level', 'reorder_level'),
+    ('price_per_unit', 'price_per_unit'),
+], computed=[
+    ('low_stock', lambda m, ctx: m.stock_quantity <= m.reorder_level),
+])
+
+# Pickup tokens - six digits, collision-free within a day. The day's counter is mapped
+# through an affine permutation of the 10^6 token space, so tokens never repeat within the
+# day but don't read as a sequence either.
+PICKUP_TOKEN_SPACE = 10 ** 6
+PICKUP_TOKEN_MULTIPLIER = 738919  # coprime with 10^6, so the mapping is a bijection
+
+def format_pickup_token(value, issue_date):
+    day_offset = (issue_date.toordinal() * 7919) % PICKUP_TOKEN_SPACE
+    return f'{(value * PICKUP_TOKEN_MULTIPLIER + day_offset) % PICKUP_TOKEN_SPACE:06d}'
+
+def _next_pickup_counter(issue_date):
+    # One upsert: the day's first issuers meet on the primary key instead of racing an INSERT
+    table = PickupTokenCounter.__table__
+    insert = pg_dialect.insert if db.engine.dialect.name == 'postgresql' else sqlite_dialect.insert
+    stmt = insert(table).values(token_date=issue_date, last_value=1)
+    return db.session.execute(
+        stmt.on_conflict_do_update(
+            index_elements=[table.c.token_date],
+            set_={'last_value': table.c.last_value + 1}
+        ).returning(table.c.last_value)
+    ).scalar()
+
+def issue_pickup_token(issue_date=None):
+    """
+    Issue the next pickup token for a day inside the caller's transaction and return
+    (issue_date, token). The SQL-side counter increment keeps concurrent issuers apart;
+    the active-token probe skips values still held by legacy random tokens.
+    """
+    issue_date = issue_date or date.today()
+    while True:
+        value = _next_pickup_counter(issue_date)
+        if value >= PICKUP_TOKEN_SPACE:
+            raise ValueError(f'Pickup tokens exhausted for {issue_date.isoformat()}')
+        token = format_pickup_token(value, issue_date)
+        taken = db.session.query(Prescription.query.filter(
+            Prescription.pickup_date == issue_date,
+            Prescription.pickup_token == token,
+            Prescription.pharmacy_status.in_(ACTIVE_PHARMACY_STATUSES)
+        ).exists()).scalar()
+        if not taken:
+            return issue_date, token
+
+def backfill_pickup_dates():
+    """Date legacy tokens by creation day and reissue active duplicates so the unique index can build"""
+    db.session.execute(text(
+        'UPDATE prescriptions SET pickup_date = date(created_at) '
+        'WHERE pickup_date IS NULL AND pickup_token IS NOT NULL'
+    ))
+    duplicates = db.session.query(Prescription.pickup_date, Prescription.pickup_token).filter(
+        Prescription.pickup_token.isnot(None),
+        Prescription.pharmacy_status.in_(ACTIVE_PHARMACY_STATUSES)
+    ).group_by(Prescription.pickup_date, Prescription.pickup_token).having(func.count() > 1).all()
+    reissued = 0
+    for pickup_date, pickup_token in duplicates:
+        holders = Prescription.query.filter_by(
+            pickup_date=pickup_date, pickup_token=pickup_token
+        ).filter(Prescription.pharmacy_status.in_(ACTIVE_PHARMACY_STATUSES)).order_by(Prescription.id).all()
+        for prescription in holders[1:]:
+            prescription.pickup_date, prescription.pickup_token = issue_pickup_token(pickup_date)
+            db.session.flush()
+            reissued += 1
+    return [f'Reissued {reissued} duplicate pickup tokens'] if reissued else []
+
+# Schema upgrades - create_all() only creates missing tables, it never alters existing ones
+SCHEMA_UPGRADE_COLUMNS = [
+    ('appointments', 'queue_version', 'INTEGER NOT NULL DEFAULT 0'),
+    ('prescriptions', 'pickup_date', 'DATE'),
+    ('medicines', 'reserved_quantity', 'INTEGER NOT NULL DEFAULT 0'),
+    ('appointments', 'actual_start_time', 'TIMESTAMP'),
+    ('appointments', 'actual_end_time', 'TIMESTAMP'),
+]
+# Data fixes that must run after the columns exist and before the indexes are built
+SCHEMA_UPGRADE_STEPS = [
+    backfill_pickup_dates,
+]
+SCHEMA_UPGRADE_INDEXES = [
+    'CREATE INDEX IF NOT EXISTS ix_appointment_queue_version ON appointments (doctor_id, appointment_date, queue_version)',
+    # The original index lowercased the literal 'name', which allowed only one medicine row
+    'DROP INDEX IF EXISTS ix_medicine_name_unique',
+    'CREATE UNIQUE INDEX IF NOT EXISTS ix_medicine_name_lower_unique ON medicines (lower(name))',
+    'CREATE INDEX IF NOT EXISTS ix_prescription_created_id ON prescriptions (created_at, id)',
+    'CREATE INDEX IF NOT EXISTS ix_prescription_status_created ON prescriptions (pharmacy_status, created_at, id)',
+    'CREATE INDEX IF NOT EXISTS ix_prescription_patient ON prescriptions (patient_id)',
+    'CREATE INDEX IF NOT EXISTS ix_prescription_pickup_token ON prescriptions (pickup_token)',
+    f'CREATE INDEX IF NOT EXISTS ix_medicine_low_stock ON medicines (id) WHERE {LOW_STOCK_PREDICATE}',
+    'CREATE UNIQUE INDEX IF NOT EXISTS uq_prescription_active_pickup ON prescriptions (pickup_date, pickup_token) '
+    f'WHERE {ACTIVE_PICKUP_PREDICATE}',
+]
+# Trigram indexes behind the pharmacy search (PostgreSQL only; SQLite uses TrigramIndex)
+SCHEMA_UPGRADE_POSTGRES = [
+    'CREATE EXTENSION IF NOT EXISTS pg_trgm',
+    'CREATE INDEX IF NOT EXISTS ix_users_full_name_trgm ON users USING gin (full_name gin_trgm_ops)',
+    'CREATE INDEX IF NOT EXISTS ix_prescriptions_pickup_token_trgm ON prescriptions USING gin (pickup_token gin_trgm_ops)',
+]
+
+def apply_schema_upgrades():
+    """Add columns and indexes introduced after a database was first created"""
+    results = []
+    inspector = sa_inspect(db.engine)
+    for table, column, ddl in SCHEMA_UPGRADE_COLUMNS:
+        existing = {col['name'] for col in inspector.get_columns(table)}
+        if column not in existing:
+            db.session.execute(text(f'ALTER TABLE {table} ADD COLUMN {column} {ddl}'))
+            results.append(f'Added column {table}.{column}')
+    for step in SCHEMA_UPGRADE_STEPS:
+        results.extend(step())
+    for statement in SCHEMA_UPGRADE_INDEXES:
+        db.session.execute(text(statement))
+    if db.engine.dialect.name == 'postgresql':
+        for statement in SCHEMA_UPGRADE_POSTGRES:
+            db.session.execute(text(statement))
+    db.session.commit()
+    return results
+
 # Audit logging functions
 def log_audit_event(action_type, resource_type, resource_id=None, details=None, 
                    user_id=None, success=True, error_message=None, request_obj=None):
@@ -830,6 +1662,14 @@ def health_check():
                 'response_time_ms': round(db_response_time, 2),
                 'url': app.config['SQLALCHEMY_DATABASE_URI'].split('@')[-1]  # Hide credentials
             }
+            pool = db.engine.pool
+            if isinstance(pool, QueuePool):
+                health_status['database']['pool'] = {
+                    'size': pool.size(),
+                    'in_use': pool.checkedout(),
+                    'overflow': max(pool.overflow(), 0),
+                    'max_overflow': pool._max_overflow
+                }
         except Exception as db_error:
             health_status['database'] = {
                 'status': 'unhealthy',
@@ -1442,7 +2282,9 @@ def book_appointment():
             priority='normal',
         )
         db.session.add(appointment)
+        bump_queue_version(appointment.doctor_id, appointment.appointment_date, appointment)
         db.session.commit()
+        publish_queue_change(appointment.doctor_id)
 
         return jsonify({
             'message': 'Appointment booked successfully',
@@ -1474,9 +2316,31 @@ def create_appointment():
             if not doctor_profile:
                 return jsonify({'error': 'Doctor not found'}), 404
             
+            priority = data.get('priority', 'normal')
+            if priority not in QUEUE_PRIORITY_CLASSES:
+                return jsonify({
+                    'error': f'Invalid priority. Must be one of: {", ".join(QUEUE_PRIORITY_CLASSES)}'
+                }), 400
+            
             # Parse appointment date
             appointment_date = datetime.strptime(data['appointment_date'], '%Y-%m-%d').date()
-            appointment_time = datetime.now().time()  # Use current time
+            
+            # appointment_time is the arrival the queue schedules by (see queue_sort_key): the
+            # slot from the JSON body's appointment_time when given, otherwise a same-day booking
+            # checks in now and an advance booking takes the doctor's opening time, never the
+            # time of day it happened to be booked at
+            now = datetime.now()
+            if data.get('appointment_time'):
+                try:
+                    appointment_time = datetime.strptime(data['appointment_time'], '%H:%M').time()
+                except ValueError:
+                    return jsonify({'error': 'Invalid time format. Use HH:MM (e.g. 09:30)'}), 400
+                if appointment_date == now.date() and appointment_time < now.time().replace(second=0, microsecond=0):
+                    return jsonify({'error': 'Cannot book an appointment for a past time'}), 400
+            elif appointment_date == now.date():
+                appointment_time = now.time()
+            else:
+                appointment_time = doctor_profile.available_from or time(9, 0)
             
             # Check daily appointment limit
             daily_count = Appointment.query.filter(
@@ -1521,11 +2385,12 @@ def create_appointment():
                 appointment_time=appointment_time,
                 token_number=token_number,
                 symptoms=sanitize_string(data.get('symptoms', data.get('reason', ''))),
-                priority=data.get('priority', 'normal'),
+                priority=priority,
                 status='in_queue'
             )
             
             db.session.add(appointment)
+            bump_queue_version(doctor_profile.user_id, appointment_date, appointment)
             
             # Create audit log entry in same transaction
             log_entry = QueueLog(
@@ -1557,6 +2422,7 @@ def create_appointment():
                 log_entry.appointment_id = appointment.id
                 db.session.add(log_entry)
                 db.session.commit()
+                publish_queue_change(doctor_profile.user_id)
                 
                 return jsonify({
                     'success': True,
@@ -1601,21 +2467,31 @@ def get_patient_appointments():
         current_user_id = get_jwt_identity()
         appointments = Appointment.query.filter_by(patient_id=current_user_id).order_by(Appointment.appointment_date.desc()).all()
         
+        # Load every active doctor-day this patient is waiting in with one query,
+        # then derive positions from the priority schedule instead of a COUNT per row
+        waiting = [a for a in appointments if a.status in ['booked', 'in_queue']]
+        positions = {}
+        if waiting:
+            doctor_days = {(a.doctor_id, a.appointment_date) for a in waiting}
+            active = Appointment.query.filter(
+                Appointment.doctor_id.in_({doctor_id for doctor_id, _ in doctor_days}),
+                Appointment.appointment_date.in_({day for _, day in doctor_days}),
+                Appointment.status.in_(['booked', 'in_queue', 'consulting'])
+            ).all()
+            positions = compute_queue_positions(
+                a for a in active if (a.doctor_id, a.appointment_date) in doctor_days
+            )
+        
         result = []
         for appointment in appointments:
             appointment_data = appointment.to_dict()
             
             # Add queue position and estimated wait time
-            if appointment.status in ['booked', 'in_queue']:
-                ahead_count = Appointment.query.filter(
-                    Appointment.doctor_id == appointment.doctor_id,
-                    Appointment.appointment_date == appointment.appointment_date,
-                    Appointment.token_number < appointment.token_number,
-                    Appointment.status.in_(['booked', 'in_queue', 'consulting'])
-                ).count()
-                
+            if appointment.id in positions:
+                ahead_count = positions[appointment.id]
                 appointment_data['queue_position'] = ahead_count + 1
                 appointment_data['estimated_wait_time'] = ahead_count * 15  # 15 minutes per patient
+                appointment_data['schedule_reason'] = explain_queue_key(appointment)
             
             result.append(appointment_data)
         
@@ -1623,93 +2499,484 @@ def get_patient_appointments():
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
-@app.route('/api/queue/<int:doctor_id>', methods=['GET'])
-@role_required(['doctor', 'receptionist'])
-def get_doctor_queue(doctor_id):
+# =======================
+# QUEUE SCHEDULING
+# =======================
+
+# Minutes a normal token is handicapped against elderly/priority arrivals. Once a normal
+# patient has waited this long, later elderly arrivals no longer overtake them (aging).
+QUEUE_AGING_MINUTES = int(os.getenv('QUEUE_AGING_MINUTES', 30))
+
+# priority -> (tier, handicap minutes). Tier 0 is always served before tier 1.
+QUEUE_PRIORITY_CLASSES = {
+    'emergency': (0, 0),
+    'urgent': (0, 0),
+    'elderly': (1, 0),
+    'priority': (1, 0),
+    'normal': (1, QUEUE_AGING_MINUTES),
+}
+
+def queue_sort_key(appt):
+    """
+    Deterministic scheduling key: (tier, arrival minute + class handicap, token, id).
+    Arrival is appointment_time, which always holds a slot or check-in time: the slot for
+    advance bookings, the booking moment for same-day ones. The key depends only on stored
+    columns, so it never changes while a patient waits and the heap order is identical on
+    every worker.
+    """
+    tier, handicap = QUEUE_PRIORITY_CLASSES.get(appt.priority or 'normal', QUEUE_PRIORITY_CLASSES['normal'])
+    arrival = appt.appointment_time or time(0, 0)
+    return (tier, arrival.hour * 60 + arrival.minute + handicap, appt.token_number, appt.id)
+
+def explain_queue_key(appt):
+    """Human-readable reason for an appointment's place in the schedule"""
+    priority = appt.priority if appt.priority in QUEUE_PRIORITY_CLASSES else 'normal'
+    tier, effective_minute, token, _ = queue_sort_key(appt)
+    if tier == 0:
+        return f'{priority}: served before all non-emergency tokens, then by arrival (token #{token})'
+    handicap = QUEUE_PRIORITY_CLASSES[priority][1]
+    arrival = effective_minute - handicap
+    return (f'{priority}: arrival {arrival // 60:02d}:{arrival % 60:02d} + {handicap} min '
+            f'= scheduled as {effective_minute // 60:02d}:{effective_minute % 60:02d} (token #{token})')
+
+class ReadyQueue:
+    """Min-heap of one doctor-day's waiting appointments in scheduling order"""
+
+    def __init__(self, appointments=()):
+        self._heap = [(queue_sort_key(appt), appt) for appt in appointments]
+        heapq.heapify(self._heap)
+
+    def __len__(self):
+        return len(self._heap)
+
+    def push(self, appt):
+        heapq.heappush(self._heap, (queue_sort_key(appt), appt))
+
+    def pop(self):
+        return heapq.heappop(self._heap)[1] if self._heap else None
+
+    def ordered(self):
+        return [appt for _, appt in sorted(self._heap, key=lambda entry: entry[0])]
+
+def order_active_queue(active_appointments):
+    """Patients in consultation first (by token), then waiting patients in schedule order"""
+    active_appointments = list(active_appointments)
+    consulting = sorted(
+        (appt for appt in active_appointments if appt.status == 'consulting'),
+        key=lambda appt: appt.token_number
+    )
+    return consulting + ReadyQueue(
+        appt for appt in active_appointments if appt.status != 'consulting'
+    ).ordered()
+
+def compute_queue_positions(active_appointments):
+    """
+    Map appointment id -> number of patients ahead of it, for any mix of doctor-days.
+    Patients in consultation are always ahead; waiting patients follow the ReadyQueue order.
+    """
+    groups = {}
+    for appt in active_appointments:
+        groups.setdefault((appt.doctor_id, appt.appointment_date), []).append(appt)
+
+    positions = {}
+    for group in groups.values():
+        consulting = sum(1 for appt in group if appt.status == 'consulting')
+        ready = ReadyQueue(appt for appt in group if appt.status in ('booked', 'in_queue'))
+        for index, appt in enumerate(ready.ordered()):
+            positions[appt.id] = consulting + index
+    return positions
+
+# =======================
+# QUEUE TRANSITIONS
+# =======================
+
+def bump_queue_version(doctor_user_id, queue_date, *appointments):
+    """
+    Advance a doctor-day's queue version inside the caller's transaction and stamp
+    the changed appointments with it. The increment happens in SQL so concurrent
+    transitions never hand out the same version, and the upsert lets two first bumps
+    of a doctor-day meet on the primary key instead of failing the second INSERT.
+    """
+    table = QueueVersion.__table__
+    insert = pg_dialect.insert if db.engine.dialect.name == 'postgresql' else sqlite_dialect.insert
+    stmt = insert(table).values(doctor_id=doctor_user_id, queue_date=queue_date, version=1)
+    version = db.session.execute(
+        stmt.on_conflict_do_update(
+            index_elements=[table.c.doctor_id, table.c.queue_date],
+            set_={'version': table.c.version + 1}
+        ).returning(table.c.version)
+    ).scalar()
+    for appt in appointments:
+        if appt is not None:
+            appt.queue_version = version
+    return version
+
+def get_queue_version(doctor_user_id, queue_date):
+    version = db.session.query(QueueVersion.version).filter_by(
+        doctor_id=doctor_user_id, queue_date=queue_date
+    ).scalar()
+    return version or 0
+
+def build_queue_snapshot(doctor_user_id, queue_date):
+    """Active queue for one doctor-day in scheduling order, patient names joined in the same query"""
+    rows = db.session.query(Appointment, User.full_name).outerjoin(
+        User, User.id == Appointment.patient_id
+    ).filter(
+        Appointment.doctor_id == doctor_user_id,
+        Appointment.appointment_date == queue_date,
+        Appointment.status.in_(['booked', 'in_queue', 'consulting'])
+    ).all()
+
+    names = {appt.id: full_name for appt, full_name in rows}
+    ordered = order_active_queue(appt for appt, _ in rows)
+
+    return [{
+        'id': appt.id,
+        'patient_name': appt.patient_name or names[appt.id] or 'Unknown',
+        'token_number': appt.token_number,
+        'status': appt.status,
+        'priority': appt.priority,
+        'queue_position': position,
+        'schedule_reason': explain_queue_key(appt) if appt.status != 'consulting' else 'in consultation',
+        'symptoms': appt.symptoms,
+        'appointment_time': appt.appointment_time.strftime('%H:%M') if appt.appointment_time else None
+    } for position, appt in enumerate(ordered, 1)]
+
+def doctor_is_consulting(doctor_user_id, queue_date):
+    return db.session.query(Appointment.query.filter_by(
+        doctor_id=doctor_user_id,
+        appointment_date=queue_date,
+        status='consulting'
+    ).exists()).scalar()
+
+def advance_doctor_queue(doctor_user_id, queue_date, waiting_statuses=('booked', 'in_queue'), complete_current=False):
+    """
+    Move a doctor's queue forward inside the caller's transaction (caller commits).
+    Callers for the same doctor (double clicks, doctor + receptionist) are serialized on
+    the doctor's profile row, so each sees the previous caller's committed claim and
+    nobody calls a patient while another is still consulting. The next token comes
+    from the priority schedule (ReadyQueue) and is locked with FOR UPDATE SKIP LOCKED;
+    the claim itself is a guarded UPDATE so backends without row locks (SQLite) never
+    hand one token to two callers.
+    Returns (called_appointment, completed_appointment); either may be None.
+    """
+    DoctorProfile.query.filter_by(user_id=doctor_user_id).with_for_update().first()
+
+    completed = None
+    if complete_current:
+        completed = Appointment.query.filter_by(
+            doctor_id=doctor_user_id,
+            appointment_date=queue_date,
+            status='consulting'
+        ).with_for_update().first()
+
+        if completed:
+            completed.status = 'completed'
+            completed.actual_end_time = datetime.now()
+            db.session.add(QueueLog(
+                appointment_id=completed.id,
+                status_change='Consultation completed',
+                notes=f'Token #{completed.token_number} completed'
+            ))
+
+    # Someone still consulting (another caller got in first, or the doctor has not
+    # completed the current patient): calling another would put two patients in at once
+    if doctor_is_consulting(doctor_user_id, queue_date):
+        return None, completed
+
+    # Schedule the waiting tokens, then lock candidates in that order. SKIP LOCKED means
+    # a token being claimed by a concurrent caller is passed over instead of waited on.
+    ready = ReadyQueue(Appointment.query.filter(
+        Appointment.doctor_id == doctor_user_id,
+        Appointment.appointment_date == queue_date,
+        Appointment.status.in_(waiting_statuses)
+    ).all())
+
+    called = None
+    while called is None:
+        candidate = ready.pop()
+        if candidate is None:
+            break
+
+        locked = db.session.query(Appointment.id).filter(
+            Appointment.id == candidate.id,
+            Appointment.status.in_(waiting_statuses)
+        ).with_for_update(skip_locked=True).first()
+        if not locked:
+            continue
+
+        # Waiting -> consulting moves no system statistics counter
+        claimed = Appointment.query.filter(
+            Appointment.id == candidate.id,
+            Appointment.status.in_(waiting_statuses)
+        ).execution_options(stats_neutral=True).update({'status': 'consulting'})
+        if claimed:
+            called = candidate
+
+    if called:
+        called.actual_start_time = datetime.now()
+
+        DoctorProfile.query.filter_by(user_id=doctor_user_id).update(
+            {'current_token': called.token_number}
+        )
+
+        db.session.add(QueueLog(
+            appointment_id=called.id,
+            status_change='Patient called for consultation',
+            notes=f'Token #{called.token_number} called'
+        ))
+
+    if called or completed:
+        bump_queue_version(doctor_user_id, queue_date, called, completed)
+
+    return called, completed
+
+# =======================
+# QUEUE WALLBOARD
+# =======================
+
+# Snapshots are per worker: queue changes committed by another worker show up after this TTL
+WALLBOARD_CACHE_SECONDS = int(os.getenv('WALLBOARD_CACHE_SECONDS', 5))
+WALLBOARD_STREAM_SECONDS = 600  # Displays reconnect after this; EventSource does it automatically
+
+class WallboardCache:
+    """
+    Per-hospital snapshot of every active doctor's queue for today.
+    Local queue transitions invalidate it immediately; the TTL picks up changes
+    committed by other workers.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._snapshots = {}
+        self._doctor_hospitals = {}
+        self._version = 0
+
+    def invalidate(self, doctor_user_id=None):
+        with self._lock:
+            hospital_id = self._doctor_hospitals.get(doctor_user_id)
+            if hospital_id is None:
+                self._snapshots.clear()
+            else:
+                self._snapshots.pop(hospital_id, None)
+            self._version += 1
+            self._changed.notify_all()
+
+    def wait_for_change(self, version, timeout):
+        with self._lock:
+            self._changed.wait_for(lambda: self._version != version, timeout=timeout)
+            return self._version
+
+    @property
+    def version(self):
+        return self._version
+
+    def get(self, hospital_id):
+        with self._lock:
+            snapshot = self._snapshots.get(hospital_id)
+            if snapshot and monotonic() - snapshot['built_at'] < WALLBOARD_CACHE_SECONDS and snapshot['date'] == date.today():
+                return snapshot
+            version = self._version
+
+        snapshot = self._build(hospital_id)
+
+        with self._lock:
+            for doctor in snapshot['doctors']:
+                self._doctor_hospitals[doctor['doctor_user_id']] = hospital_id
+            # Don't cache a snapshot that a transition invalidated while it was being built
+            if self._version == version:
+                self._snapshots[hospital_id] = snapshot
+        return snapshot
+
+    def _build(self, hospital_id):
+        today = date.today()
+        doctors = db.session.query(DoctorProfile, User.full_name, Department.name).join(
+            User, User.id == DoctorProfile.user_id
+        ).outerjoin(
+            Department, Department.id == DoctorProfile.department_id
+        ).filter(
+            DoctorProfile.hospital_id == hospital_id,
+            DoctorProfile.active == True,
+            User.is_active == True
+        ).all()
+
+        queues = {profile.user_id: [] for profile, _, _ in doctors}
+        if queues:
+            active = Appointment.query.filter(
+                Appointment.doctor_id.in_(list(queues)),
+                Appointment.appointment_date == today,
+                Appointment.status.in_(['booked', 'in_queue', 'consulting'])
+            ).all()
+            for appt in active:
+                queues[appt.doctor_id].append(appt)
+
+        board = []
+        for profile, doctor_name, department_name in doctors:
+            ordered = order_active_queue(queues[profile.user_id])
+            consulting = [a for a in ordered if a.status == 'consulting']
+            board.append({
+                'doctor_id': profile.id,
+                'doctor_user_id': profile.user_id,
+                'doctor_name': doctor_name,
+                'department_id': profile.department_id,
+                'department_name': department_name,
+                'current_token': profile.current_token,
+                'consulting_token': consulting[0].token_number if consulting else None,
+                'waiting_count': len(ordered) - len(consulting),
+                'upcoming': [
+                    {'token_number': a.token_number, 'priority': a.priority, 'status': a.status}
+                    for a in ordered if a.status != 'consulting'
+                ]
+            })
+        board.sort(key=lambda d: (d['department_name'] or '', d['doctor_name'] or ''))
+
+        return {
+            'hospital_id': hospital_id,
+            'date': today,
+            'built_at': monotonic(),
+            'generated_at': datetime.now(timezone.utc).isoformat(),
+            'doctors': board
+        }
+
+wallboard_cache = WallboardCache()
+
+def publish_queue_change(doctor_user_id=None):
+    """Call after committing a queue transition so derived queue views refresh"""
+    wallboard_cache.invalidate(doctor_user_id)
+    daily_summary_cache.invalidate(doctor_user_id)
+
+def render_wallboard(snapshot, department_id=None, next_count=5):
+    """Trim a cached hospital snapshot to one department and the next N tokens per doctor"""
+    doctors = []
+    for doctor in snapshot['doctors']:
+        if department_id and doctor['department_id'] != department_id:
+            continue
+        entry = dict(doctor)
+        entry['upcoming'] = doctor['upcoming'][:next_count]
+        doctors.append(entry)
+    return {
+        'hospital_id': snapshot['hospital_id'],
+        'generated_at': snapshot['generated_at'],
+        'doctors': doctors
+    }
+
+def _wallboard_args():
+    hospital_id = request.args.get('hospital_id')
+    department_id = request.args.get('department_id')
+    next_count = max(1, min(request.args.get('next', 5, type=int), 20))
+    return hospital_id, department_id, next_count
+
+@app.route('/api/wallboard', methods=['GET'])
+@role_required(['doctor', 'receptionist', 'admin'])
+def get_wallboard():
+    """Current token and next N tokens for every active doctor in a hospital"""
     try:
-        current_date = date.today()
-        
-        # Get active appointments
-        appointments = Appointment.query.filter(
-            Appointment.doctor_id == doctor_id,
-            Appointment.appointment_date == current_date,
-            Appointment.status.in_(['in_queue', 'consulting'])
-        ).order_by(Appointment.token_number).all()
+        hospital_id, department_id, next_count = _wallboard_args()
+        if not hospital_id:
+            return jsonify({'error': 'hospital_id parameter is required'}), 400
         
-        result = []
-        for appt in appointments:
-            patient = db.session.get(User, appt.patient_id)
-            result.append({
-                'id': appt.id,
-                'patient_name': patient.full_name if patient else 'Unknown',
-                'token_number': appt.token_number,
-                'status': appt.status,
-                'symptoms': appt.symptoms,
-                'appointment_time': str(appt.appointment_time)
-            })
-            
-        return jsonify(result), 200
+        snapshot = wallboard_cache.get(hospital_id)
+        return jsonify(render_wallboard(snapshot, department_id, next_count)), 200
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
-@app.route('/api/queue/next', methods=['POST'])
-@role_required(['doctor'])
-def next_patient():
+@app.route('/api/wallboard/stream', methods=['GET'])
+@jwt_required(locations=['headers', 'query_string'])
+def stream_wallboard():
+    """Server-sent events feed of the wallboard for TV displays (token may be passed as ?jwt=)"""
+    current_user = db.session.get(User, get_jwt_identity())
+    if not current_user or current_user.role not in ['doctor', 'receptionist', 'admin']:
+        return jsonify({'error': 'Access denied. Insufficient permissions.'}), 403
+    
+    hospital_id, department_id, next_count = _wallboard_args()
+    if not hospital_id:
+        return jsonify({'error': 'hospital_id parameter is required'}), 400
+    db.session.remove()
+    
+    def generate():
+        deadline = monotonic() + WALLBOARD_STREAM_SECONDS
+        last_payload = None
+        version = wallboard_cache.version
+        while monotonic() < deadline:
+            try:
+                payload = json.dumps(render_wallboard(wallboard_cache.get(hospital_id), department_id, next_count))
+            finally:
+                # Never hold a pooled connection while the stream is idle
+                db.session.remove()
+            if payload != last_payload:
+                yield f'data: {payload}\n\n'
+                last_payload = payload
+            else:
+                yield ': keep-alive\n\n'
+            version = wallboard_cache.wait_for_change(version, timeout=WALLBOARD_CACHE_SECONDS)
+    
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+@app.route('/api/queue/<int:doctor_id>', methods=['GET'])
+@role_required(['doctor', 'receptionist'])
+def get_doctor_queue(doctor_id):
+    try:
+        # Active appointments with patient names in one joined query
+        result = [
+            entry for entry in build_queue_snapshot(doctor_id, date.today())
+            if entry['status'] in ['in_queue', 'consulting']
+        ]
+        return jsonify(result), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/queue/next', methods=['POST'])
+@role_required(['doctor', 'receptionist'])
+def next_patient():
     try:
         doctor_user_id = get_jwt_identity()
-        data = request.get_json()
+        data = request.get_json(silent=True) or {}
         
-        # Allow checking queue for other doctors if admin/reception (optional)
-        # For now assume doctor manages their own queue
+        # Receptionists advance the queue on behalf of a doctor
+        if get_jwt().get('role') == 'receptionist':
+            if not data.get('doctor_id'):
+                return jsonify({'error': 'doctor_id is required'}), 400
+            try:
+                doctor_user_id = int(data['doctor_id'])
+            except (TypeError, ValueError):
+                return jsonify({'error': 'doctor_id must be an integer'}), 400
+            # Receptionist accounts carry no hospital, so the most we can scope to is active doctors
+            if not DoctorProfile.query.filter_by(user_id=doctor_user_id, active=True).first():
+                return jsonify({'error': 'doctor_id is not an active doctor'}), 400
         
         current_date = date.today()
         
-        # 1. Finish current patient
-        current_appt = Appointment.query.filter_by(
-            doctor_id=doctor_user_id,
-            appointment_date=current_date,
-            status='consulting'
-        ).first()
-        
-        if current_appt:
-            current_appt.status = 'completed'
-            current_appt.actual_end_time = datetime.now()
-            db.session.add(current_appt)
+        # Finish current patient and call the next one in a single transaction
+        next_appt, _ = advance_doctor_queue(
+            doctor_user_id,
+            current_date,
+            waiting_statuses=('in_queue',),
+            complete_current=True
+        )
+        db.session.commit()
+        publish_queue_change(doctor_user_id)
         
-        # 2. Get next patient
-        next_appt = Appointment.query.filter(
-            Appointment.doctor_id == doctor_user_id,
-            Appointment.appointment_date == current_date,
-            Appointment.status == 'in_queue'
-        ).order_by(Appointment.token_number).first()
+        queue = build_queue_snapshot(doctor_user_id, current_date)
         
         if next_appt:
-            next_appt.status = 'consulting'
-            next_appt.actual_start_time = datetime.now()
-            db.session.add(next_appt)
-            
-            # Update doctor's current token
-            profile = DoctorProfile.query.filter_by(user_id=doctor_user_id).first()
-            if profile:
-                profile.current_token = next_appt.token_number
-                db.session.add(profile)
-            
-            db.session.commit()
-            
-            # Return next patient details
-            patient = db.session.get(User, next_appt.patient_id)
+            current = next((entry for entry in queue if entry['id'] == next_appt.id), None)
             return jsonify({
                 'message': 'Moved to next patient',
                 'current_patient': {
                     'id': next_appt.id,
-                    'name': patient.full_name if patient else 'Unknown',
+                    'name': current['patient_name'] if current else 'Unknown',
                     'token': next_appt.token_number,
                     'symptoms': next_appt.symptoms
-                }
+                },
+                'queue': queue
             }), 200
         
-        db.session.commit()
-        return jsonify({'message': 'No more patients in queue', 'current_patient': None}), 200
+        return jsonify({'message': 'No more patients in queue', 'current_patient': None, 'queue': queue}), 200
         
     except Exception as e:
         db.session.rollback()
@@ -1731,13 +2998,13 @@ def get_queue_status(appointment_id):
             app.logger.warning(f'Appointment not found or not owned by user: appointment_id={appointment_id}, user_id={current_user_id}')
             return jsonify({'error': 'Appointment not found or access denied'}), 404
         
-        # Calculate queue position — count all active appointments ahead (booked + in_queue + consulting)
-        ahead_count = Appointment.query.filter(
+        # Calculate queue position from the priority schedule of this doctor-day
+        active = Appointment.query.filter(
             Appointment.doctor_id == appointment.doctor_id,
             Appointment.appointment_date == appointment.appointment_date,
-            Appointment.token_number < appointment.token_number,
             Appointment.status.in_(['booked', 'in_queue', 'consulting'])
-        ).count()
+        ).all()
+        ahead_count = compute_queue_positions(active).get(appointment.id, 0)
         
         # Get current doctor token
         doctor_profile = DoctorProfile.query.filter_by(user_id=appointment.doctor_id).first()
@@ -1769,6 +3036,7 @@ def get_queue_status(appointment_id):
         return jsonify({
             'appointment': appointment.to_dict(),
             'queue_position': ahead_count + 1,
+            'schedule_reason': explain_queue_key(appointment),
             'current_token': current_token,
             'estimated_wait_time': max(0, int(estimated_wait_minutes)),
             'status': appointment.status
@@ -1782,9 +3050,11 @@ def get_queue_status(appointment_id):
 def get_patient_prescriptions():
     try:
         current_user_id = get_jwt_identity()
-        prescriptions = Prescription.query.filter_by(patient_id=current_user_id).order_by(Prescription.created_at.desc()).all()
+        prescriptions = Prescription.query.options(*PRESCRIPTION_ROW_LOADERS).filter_by(
+            patient_id=current_user_id
+        ).order_by(Prescription.created_at.desc()).all()
         
-        return jsonify([prescription.to_dict() for prescription in prescriptions]), 200
+        return jsonify(PRESCRIPTION_ROWS.rows(prescriptions)), 200
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -1865,29 +3135,68 @@ def get_doctor_appointments():
         date_str = request.args.get('date', datetime.now().strftime('%Y-%m-%d'))
         appointment_date = datetime.strptime(date_str, '%Y-%m-%d').date()
         
-        appointments = Appointment.query.filter_by(
+        appointments = Appointment.query.options(*APPOINTMENT_ROW_LOADERS).filter_by(
             doctor_id=current_user_id,
             appointment_date=appointment_date
         ).order_by(Appointment.token_number).all()
         
-        return jsonify([appointment.to_dict() for appointment in appointments]), 200
+        return jsonify(APPOINTMENT_ROWS.rows(appointments, appointment_row_context(appointments))), 200
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 @app.route('/api/doctor/queue', methods=['GET'])
 @role_required(['doctor'])
 def get_doctor_queue_v1():
+    """
+    Doctor-day queue with delta sync. Every transition bumps the queue version, which is
+    sent as the ETag. If-None-Match or ?since=<current version> gets a 304; an older
+    ?since returns only the appointments changed after that version.
+    """
     try:
         current_user_id = get_jwt_identity()
         date_str = request.args.get('date', datetime.now().strftime('%Y-%m-%d'))
         appointment_date = datetime.strptime(date_str, '%Y-%m-%d').date()
+        since = request.args.get('since', type=int)
         
-        queue = Appointment.query.filter_by(
-            doctor_id=current_user_id,
-            appointment_date=appointment_date
-        ).filter(Appointment.status.in_(['booked', 'in_queue', 'consulting'])).order_by(Appointment.token_number).all()
+        version = get_queue_version(current_user_id, appointment_date)
+        etag = f'queue-{current_user_id}-{appointment_date.isoformat()}-{version}'
+        
+        if since == version or request.if_none_match.contains(etag):
+            response = app.response_class(status=304)
+        elif since is not None and 0 < since < version:
+            changed = Appointment.query.options(*APPOINTMENT_ROW_LOADERS).filter(
+                Appointment.doctor_id == current_user_id,
+                Appointment.appointment_date == appointment_date,
+                Appointment.queue_version > since
+            ).order_by(Appointment.token_number).all()
+            
+            profiles = appointment_row_context(changed)
+            changes = [
+                QUEUE_APPOINTMENT_ROWS.row(appointment, profiles, extras=(None, explain_queue_key(appointment)))
+                for appointment in changed
+            ]
+            
+            response = jsonify({'version': version, 'since': since, 'changes': changes})
+        else:
+            queue = Appointment.query.options(*APPOINTMENT_ROW_LOADERS).filter_by(
+                doctor_id=current_user_id,
+                appointment_date=appointment_date
+            ).filter(Appointment.status.in_(['booked', 'in_queue', 'consulting'])).all()
+            
+            profiles = appointment_row_context(queue)
+            result = []
+            for position, appointment in enumerate(order_active_queue(queue), 1):
+                schedule_reason = (
+                    explain_queue_key(appointment) if appointment.status != 'consulting' else 'in consultation'
+                )
+                result.append(QUEUE_APPOINTMENT_ROWS.row(appointment, profiles, extras=(position, schedule_reason)))
+            
+            response = jsonify(result)
         
-        return jsonify([appointment.to_dict() for appointment in queue]), 200
+        response.set_etag(etag)
+        response.headers['X-Queue-Version'] = str(version)
+        response.headers['Cache-Control'] = 'private, no-cache'
+        return response
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -1898,46 +3207,28 @@ def call_next_patient():
         current_user_id = get_jwt_identity()
         app.logger.info(f'Doctor {current_user_id} calling next patient')
         
-        date_str = datetime.now().strftime('%Y-%m-%d')
-        appointment_date = datetime.strptime(date_str, '%Y-%m-%d').date()
+        appointment_date = date.today()
         
-        # Get next patient in queue - check both 'booked' and 'in_queue' statuses
-        next_appointment = Appointment.query.filter_by(
-            doctor_id=current_user_id,
-            appointment_date=appointment_date
-        ).filter(Appointment.status.in_(['booked', 'in_queue'])).order_by(Appointment.token_number).first()
+        # Claim the next booked/in_queue token, update current_token and log it in one transaction
+        next_appointment, _ = advance_doctor_queue(current_user_id, appointment_date)
+        
+        if not next_appointment and doctor_is_consulting(current_user_id, appointment_date):
+            db.session.rollback()
+            return jsonify({'error': 'Complete the current consultation before calling the next patient'}), 409
         
         if not next_appointment:
+            db.session.rollback()
             app.logger.warning(f'No patients in queue for doctor {current_user_id} on {appointment_date}')
             return jsonify({'message': 'No patients waiting in queue'}), 404
         
-        app.logger.info(f'Calling patient {next_appointment.id} (Token: {next_appointment.token_number})')
-        
-        # Update appointment status
-        old_status = next_appointment.status
-        next_appointment.status = 'consulting'
-        next_appointment.actual_start_time = datetime.utcnow()
-        
-        # Update doctor's current token
-        doctor_profile = DoctorProfile.query.filter_by(user_id=current_user_id).first()
-        if doctor_profile:
-            doctor_profile.current_token = next_appointment.token_number
-        
-        db.session.commit()
-        app.logger.info(f'Patient status changed from {old_status} to consulting')
-        
-        # Log the status change
-        log_entry = QueueLog(
-            appointment_id=next_appointment.id,
-            status_change='Patient called for consultation',
-            notes=f'Token #{next_appointment.token_number} called'
-        )
-        db.session.add(log_entry)
         db.session.commit()
+        publish_queue_change(current_user_id)
+        app.logger.info(f'Called patient {next_appointment.id} (Token: {next_appointment.token_number})')
         
         return jsonify({
             'message': 'Next patient called successfully',
-            'appointment': next_appointment.to_dict()
+            'appointment': next_appointment.to_dict(),
+            'queue': build_queue_snapshot(current_user_id, appointment_date)
         }), 200
         
     except Exception as e:
@@ -1962,32 +3253,38 @@ def complete_consultation():
         
         appointment.status = 'completed'
         appointment.actual_end_time = datetime.now()
+        bump_queue_version(appointment.doctor_id, appointment.appointment_date, appointment)
         
         prescription_id = None
         # Create prescription if medicines were prescribed
         if prescription_data:
-            import random, string
-            token = ''.join(random.choices(string.digits, k=6))
+            pickup_date, token = issue_pickup_token()
             prescription = Prescription(
                 appointment_id=appointment.id,
                 patient_id=appointment.patient_id,
                 doctor_id=current_user_id,
                 prescription_data={'medicines': prescription_data, 'notes': doctor_notes},
                 pharmacy_status='pending',
-                pickup_token=token
+                pickup_token=token,
+                pickup_date=pickup_date
             )
             db.session.add(prescription)
             db.session.flush()  # get prescription.id before commit
             prescription_id = prescription.id
+            stock_warnings = reserve_prescription_stock(prescription, prescription_data)
+        else:
+            stock_warnings = []
         
         db.session.commit()
+        publish_queue_change(appointment.doctor_id)
         
         return jsonify({
             'message': 'Consultation completed',
             'patient_name': appointment.patient.full_name if appointment.patient else 'Unknown',
             'appointment_time': appointment.actual_end_time.strftime('%Y-%m-%d %H:%M:%S'),
             'status': appointment.status,
-            'prescription_id': prescription_id
+            'prescription_id': prescription_id,
+            'stock_warnings': stock_warnings
         }), 200
     except Exception as e:
         db.session.rollback()
@@ -2012,20 +3309,27 @@ def create_prescription():
             return jsonify({'error': 'Appointment not found or access denied'}), 404
         
         # Create prescription
+        pickup_date, token = issue_pickup_token()
         prescription = Prescription(
             appointment_id=appointment.id,
             patient_id=appointment.patient_id,
             doctor_id=current_user_id,
             prescription_data={'medicines': data['medicines'], 'notes': data['notes']},
-            pharmacy_status='pending'
+            pharmacy_status='pending',
+            pickup_token=token,
+            pickup_date=pickup_date
         )
         
         db.session.add(prescription)
+        db.session.flush()
+        stock_warnings = reserve_prescription_stock(prescription, data['medicines'])
         db.session.commit()
         
         return jsonify({
             'message': 'Prescription created successfully',
-            'prescription_id': prescription.id
+            'prescription_id': prescription.id,
+            'pickup_token': token,
+            'stock_warnings': stock_warnings
         }), 201
         
     except Exception as e:
@@ -2048,9 +3352,11 @@ def update_appointment_status(appointment_id):
         if 'status' in data:
             appointment.status = data['status']
             if data['status'] == 'completed':
-                appointment.actual_end_time = datetime.utcnow()
+                appointment.actual_end_time = datetime.now()
+            bump_queue_version(appointment.doctor_id, appointment.appointment_date, appointment)
         
         db.session.commit()
+        publish_queue_change(appointment.doctor_id)
         
         return jsonify({
             'message': 'Appointment updated successfully',
@@ -2061,36 +3367,389 @@ def update_appointment_status(appointment_id):
         db.session.rollback()
         return jsonify({'error': str(e)}), 500
 
+# =======================
+# DAILY SUMMARY
+# =======================
+
+DAILY_SUMMARY_CACHE_SIZE = 1024
+
+class DailySummaryCache:
+    """
+    Status counts per (doctor, date), each tagged with the queue version it was built at.
+    Every transition bumps that version, so a lookup is one primary-key read of the
+    current version: equal means the cached counts still hold, even for changes made
+    by other workers. publish_queue_change() also drops a doctor's entries locally.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # (doctor_user_id, date) -> (version, counts)
+
+    def invalidate(self, doctor_user_id=None):
+        with self._lock:
+            if doctor_user_id is None:
+                self._entries.clear()
+            else:
+                for key in [key for key in self._entries if key[0] == doctor_user_id]:
+                    del self._entries[key]
+
+    def get(self, doctor_user_id, summary_date, version):
+        key = (doctor_user_id, summary_date)
+        with self._lock:
+            cached = self._entries.get(key)
+            if cached and cached[0] == version:
+                self._entries.move_to_end(key)
+                return cached[1]
+
+        counts = dict(db.session.query(Appointment.status, func.count(Appointment.id)).filter(
+            Appointment.doctor_id == doctor_user_id,
+            Appointment.appointment_date == summary_date
+        ).group_by(Appointment.status).all())
+
+        with self._lock:
+            self._entries[key] = (version, counts)
+            self._entries.move_to_end(key)
+            while len(self._entries) > DAILY_SUMMARY_CACHE_SIZE:
+                self._entries.popitem(last=False)
+        return counts
+
+daily_summary_cache = DailySummaryCache()
+
 @app.route('/api/doctor/daily-summary', methods=['GET'])
 @role_required(['doctor'])
 def get_daily_summary():
+    """
+    Appointment counts for a doctor-day, cached against the queue version (also the
+    ETag, so polling clients get a 304). ?include=appointments adds a page of the
+    day's appointments in token order (?limit=, ?cursor=).
+    """
     try:
         current_user_id = get_jwt_identity()
         date_str = request.args.get('date', datetime.now().strftime('%Y-%m-%d'))
         appointment_date = datetime.strptime(date_str, '%Y-%m-%d').date()
+        include_appointments = request.args.get('include') == 'appointments'
         
-        appointments = Appointment.query.filter_by(
-            doctor_id=current_user_id,
-            appointment_date=appointment_date
-        ).all()
-        
-        total_appointments = len(appointments)
-        completed = len([a for a in appointments if a.status == 'completed'])
-        cancelled = len([a for a in appointments if a.status == 'cancelled'])
-        pending = len([a for a in appointments if a.status in ['booked', 'in_queue']])
+        version = get_queue_version(current_user_id, appointment_date)
+        etag = f'summary-{current_user_id}-{appointment_date.isoformat()}-{version}'
+        if not include_appointments and request.if_none_match.contains(etag):
+            response = app.response_class(status=304)
+        else:
+            counts = daily_summary_cache.get(current_user_id, appointment_date, version)
+            result = {
+                'date': date_str,
+                'total_appointments': sum(counts.values()),
+                'completed': counts.get('completed', 0),
+                'cancelled': counts.get('cancelled', 0),
+                'pending': counts.get('booked', 0) + counts.get('in_queue', 0),
+                'by_status': counts
+            }
+            
+            if include_appointments:
+                try:
+                    offset = decode_offset_cursor(request.args['cursor']) if request.args.get('cursor') else 0
+                except ValueError as e:
+                    return jsonify({'error': str(e)}), 400
+                limit = min(max(request.args.get('limit', 50, type=int), 1), PAGE_LIMIT_MAX)
+                page = Appointment.query.options(*APPOINTMENT_ROW_LOADERS).filter_by(
+                    doctor_id=current_user_id,
+                    appointment_date=appointment_date
+                ).order_by(Appointment.token_number, Appointment.id).offset(offset).limit(limit + 1).all()
+                has_more = len(page) > limit
+                page = page[:limit]
+                result['appointments'] = APPOINTMENT_ROWS.rows(page, appointment_row_context(page))
+                result['has_more'] = has_more
+                result['next_cursor'] = encode_offset_cursor(offset + limit) if has_more else None
+            
+            response = jsonify(result)
         
-        return jsonify({
-            'date': date_str,
-            'total_appointments': total_appointments,
-            'completed': completed,
-            'cancelled': cancelled,
-            'pending': pending,
-            'appointments': [a.to_dict() for a in appointments]
-        }), 200
+        response.set_etag(etag)
+        response.headers['X-Queue-Version'] = str(version)
+        response.headers['Cache-Control'] = 'private, no-cache'
+        return response
         
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+# =======================
+# PAGINATION
+# =======================
+
+PAGE_LIMIT_MAX = 100
+
+def encode_cursor(created_at, row_id):
+    """Opaque keyset cursor for a (created_at, id) position"""
+    raw = f'{created_at.isoformat()}|{row_id}'.encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+def decode_cursor(cursor):
+    """Inverse of encode_cursor(); raises ValueError on a malformed cursor"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        created_at, row_id = raw.rsplit('|', 1)
+        return datetime.fromisoformat(created_at), int(row_id)
+    except (ValueError, UnicodeDecodeError, TypeError) as e:
+        raise ValueError('Invalid cursor') from e
+
+def encode_offset_cursor(offset):
+    """Cursor for result sets ordered by rank, where no stable key exists"""
+    return base64.urlsafe_b64encode(f'+{offset}'.encode()).decode().rstrip('=')
+
+def decode_offset_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        if not raw.startswith('+'):
+            raise ValueError
+        return max(int(raw[1:]), 0)
+    except (ValueError, UnicodeDecodeError, TypeError) as e:
+        raise ValueError('Invalid cursor') from e
+
+def estimate_query_count(query):
+    """
+    Planner row estimate for a query on PostgreSQL (EXPLAIN, no scan), exact COUNT elsewhere.
+    Returns (count, is_estimate).
+    """
+    if db.engine.dialect.name != 'postgresql':
+        return query.order_by(None).count(), False
+    compiled = query.order_by(None).statement.compile(dialect=db.engine.dialect)
+    plan = db.session.connection().exec_driver_sql(
+        f'EXPLAIN (FORMAT JSON) {compiled}', compiled.params
+    ).scalar()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]['Plan']['Plan Rows']), True
+
+# =======================
+# SEARCH
+# =======================
+
+# pg_trgm's default similarity threshold; substring matches are kept regardless
+SEARCH_SIMILARITY_THRESHOLD = float(os.environ.get('SEARCH_SIMILARITY_THRESHOLD', 0.3))
+# Cap on fallback candidates handed to the SQL filter as IN lists
+SEARCH_CANDIDATE_LIMIT = 500
+PICKUP_TOKEN_PATTERN = re.compile(r'^[A-Za-z0-9-]{4,10}$')
+
+def trigrams(value):
+    """pg_trgm-compatible trigrams: lowercased words padded with two leading and one trailing space"""
+    grams = set()
+    for word in re.findall(r'[a-z0-9]+', (value or '').lower()):
+        padded = f'  {word} '
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+class TrigramIndex:
+    """
+    In-process trigram index used where pg_trgm is unavailable (SQLite). Loaded lazily
+    with one query, then kept current by ORM events. Scores follow pg_trgm similarity():
+    shared trigrams / union of trigrams.
+    """
+
+    def __init__(self, loader):
+        self._loader = loader  # () -> iterable of (key, text)
+        self._lock = threading.Lock()
+        self._texts = None
+        self._grams = {}
+        self._postings = defaultdict(set)
+
+    def _add(self, key, value):
+        self._texts[key] = (value or '').lower()
+        grams = trigrams(value)
+        self._grams[key] = grams
+        for gram in grams:
+            self._postings[gram].add(key)
+
+    def _remove(self, key):
+        for gram in self._grams.pop(key, ()):
+            self._postings[gram].discard(key)
+        self._texts.pop(key, None)
+
+    def _ensure_loaded(self):
+        if self._texts is None:
+            self._texts = {}
+            for key, value in self._loader():
+                self._add(key, value)
+
+    def update(self, key, value):
+        with self._lock:
+            if self._texts is None:
+                return  # not loaded yet; the first search reads current rows
+            self._remove(key)
+            self._add(key, value)
+
+    def discard(self, key):
+        with self._lock:
+            if self._texts is not None:
+                self._remove(key)
+
+    def reset(self):
+        with self._lock:
+            self._texts = None
+            self._grams = {}
+            self._postings = defaultdict(set)
+
+    def search(self, term, threshold=SEARCH_SIMILARITY_THRESHOLD, limit=SEARCH_CANDIDATE_LIMIT):
+        """{key: score} for entries similar to term or containing it, best `limit` only"""
+        needle = term.lower()
+        query_grams = trigrams(term)
+        with self._lock:
+            self._ensure_loaded()
+            shared = defaultdict(int)
+            for gram in query_grams:
+                for key in self._postings.get(gram, ()):
+                    shared[key] += 1
+            scores = {}
+            for key, count in shared.items():
+                score = count / (len(query_grams) + len(self._grams[key]) - count)
+                if score >= threshold or needle in self._texts[key]:
+                    scores[key] = score
+            if len(needle) < 3:
+                # Too short to share a trigram with a mid-word match; scan the texts
+                for key, text_value in self._texts.items():
+                    if key not in scores and needle in text_value:
+                        scores[key] = 0.0
+        best = heapq.nlargest(limit, scores.items(), key=operator.itemgetter(1))
+        return dict(best)
+
+patient_name_index = TrigramIndex(
+    lambda: db.session.query(User.id, User.full_name).filter(User.role == 'patient').all()
+)
+pickup_token_index = TrigramIndex(
+    lambda: db.session.query(Prescription.id, Prescription.pickup_token)
+        .filter(Prescription.pickup_token.isnot(None)).all()
+)
+
+def _stage_search_text(index, key, value):
+    # Flush-time events also fire for work that is later rolled back, so changes wait for the commit
+    def stage(target):
+        session = object_session(target)
+        if session is not None:
+            session.info.setdefault('search_index_states', {})[(index, key(target))] = value(target)
+    return stage
+
+_stage_patient_name = _stage_search_text(
+    'patient', lambda user: user.id, lambda user: user.full_name if user.role == 'patient' else None
+)
+_stage_pickup_token = _stage_search_text(
+    'token', lambda prescription: prescription.id, lambda prescription: prescription.pickup_token or None
+)
+
+@event.listens_for(User, 'after_insert')
+@event.listens_for(User, 'after_update')
+def _index_patient_name(mapper, connection, target):
+    _stage_patient_name(target)
+
+@event.listens_for(Prescription, 'after_insert')
+@event.listens_for(Prescription, 'after_update')
+def _index_pickup_token(mapper, connection, target):
+    _stage_pickup_token(target)
+
+@event.listens_for(OrmSession, 'after_commit')
+def _publish_search_texts(session):
+    states = session.info.pop('search_index_states', None)
+    for (index, key), value in (states or {}).items():
+        target = patient_name_index if index == 'patient' else pickup_token_index
+        if value is None:
+            target.discard(key)
+        else:
+            target.update(key, value)
+
+@event.listens_for(OrmSession, 'after_rollback')
+def _discard_search_texts(session):
+    session.info.pop('search_index_states', None)
+
+def _escape_like(term):
+    return term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+def _sql_greatest(*values):
+    # SQLite's multi-argument max() is its GREATEST()
+    return func.max(*values) if db.engine.dialect.name == 'sqlite' else func.greatest(*values)
+
+def _set_trigram_threshold():
+    # The % operator compares against pg_trgm.similarity_threshold, not our setting; scope it to this transaction
+    db.session.execute(text("SELECT set_config('pg_trgm.similarity_threshold', :threshold, true)"),
+                       {'threshold': str(SEARCH_SIMILARITY_THRESHOLD)})
+
+def search_patients(term, limit=20):
+    """Patients ranked by name similarity: [(user_id, full_name, score)]"""
+    term = term.strip()
+    if not term:
+        return []
+    if db.engine.dialect.name == 'postgresql':
+        _set_trigram_threshold()
+        score = func.similarity(User.full_name, term)
+        rows = db.session.query(User.id, User.full_name, score.label('score')).filter(
+            User.role == 'patient',
+            db.or_(User.full_name.op('%')(term), User.full_name.ilike(f'%{_escape_like(term)}%', escape='\\'))
+        ).order_by(score.desc(), User.full_name).limit(limit).all()
+        return [(row.id, row.full_name, float(row.score)) for row in rows]
+    scores = patient_name_index.search(term)
+    if not scores:
+        return []
+    names = dict(db.session.query(User.id, User.full_name).filter(User.id.in_(scores)).all())
+    ranked = sorted((key for key in scores if key in names), key=lambda key: (-scores[key], names[key]))
+    return [(key, names[key], scores[key]) for key in ranked[:limit]]
+
+def apply_prescription_search(query, term):
+    """
+    Filter a Prescription query by patient name or pickup token.
+
+    Returns (query, rank): rank is a SQL expression to order by (higher is better), or
+    None when the exact pickup-token fast path matched and chronological order applies.
+    PostgreSQL uses the pg_trgm GIN indexes; other databases use the in-process
+    TrigramIndex and pass the candidates to SQL as IN lists.
+    """
+    term = term.strip()
+    if PICKUP_TOKEN_PATTERN.match(term):
+        exact = query.filter(Prescription.pickup_token == term.upper())
+        if db.session.query(exact.exists()).scalar():
+            return exact, None
+    
+    if db.engine.dialect.name == 'postgresql':
+        _set_trigram_threshold()
+        like = f'%{_escape_like(term)}%'
+        # One indexed probe per table, unioned: an OR spanning both sides of the join could
+        # use neither trigram index
+        matches = db.union(
+            db.select(Prescription.id).join(User, Prescription.patient_id == User.id).where(db.or_(
+                User.full_name.op('%')(term),
+                User.full_name.ilike(like, escape='\\'),
+            )),
+            db.select(Prescription.id).where(Prescription.pickup_token.ilike(like, escape='\\')),
+        ).subquery()
+        query = query.join(Prescription.patient).join(matches, matches.c.id == Prescription.id)
+        rank = _sql_greatest(
+            func.similarity(User.full_name, term),
+            func.coalesce(func.similarity(Prescription.pickup_token, term), 0)
+        )
+        return query, rank
+    
+    patient_scores = {key: score for key, _, score in search_patients(term, limit=SEARCH_CANDIDATE_LIMIT)}
+    token_scores = pickup_token_index.search(term)
+    if not patient_scores and not token_scores:
+        return query.filter(db.false()), None
+    query = query.filter(db.or_(
+        Prescription.patient_id.in_(patient_scores),
+        Prescription.id.in_(token_scores),
+    ))
+    rank = _sql_greatest(
+        case(patient_scores, value=Prescription.patient_id, else_=0.0) if patient_scores else db.literal(0.0),
+        case(token_scores, value=Prescription.id, else_=0.0) if token_scores else db.literal(0.0),
+    )
+    return query, rank
+
+@app.route('/api/pharmacy/patients/search', methods=['GET'])
+@role_required(['pharmacy', 'receptionist', 'doctor', 'admin'])
+def search_patients_route():
+    """Ranked patient name lookup (?q=, ?limit=)"""
+    try:
+        term = request.args.get('q', '')
+        limit = max(1, min(request.args.get('limit', 20, type=int), PAGE_LIMIT_MAX))
+        return jsonify([
+            {'id': user_id, 'full_name': full_name, 'score': round(score, 3)}
+            for user_id, full_name, score in search_patients(term, limit)
+        ]), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
 # =======================
 # PHARMACY ROUTES
 # =======================
@@ -2098,10 +3757,20 @@ def get_daily_summary():
 @app.route('/api/pharmacy/prescriptions', methods=['GET'])
 @role_required(['pharmacy'])
 def get_pharmacy_prescriptions():
+    """
+    Prescription records, newest first. Pass ?cursor=<next_cursor> to page by keyset on
+    (created_at, id), which costs the same at any depth; ?total=approx|exact|none controls
+    the total (default none in cursor mode). ?page=N keeps the legacy offset paging.
+    ?search= ranks matches by relevance (see apply_prescription_search).
+    """
     try:
         # Pagination
-        page = request.args.get('page', 1, type=int)
-        limit = request.args.get('limit', 20, type=int)
+        page = request.args.get('page', type=int)
+        cursor = request.args.get('cursor')
+        limit = max(1, min(request.args.get('limit', 20, type=int), PAGE_LIMIT_MAX))
+        total_mode = request.args.get('total', 'exact' if page else 'none')
+        if total_mode not in ('exact', 'approx', 'none'):
+            return jsonify({'error': 'total must be one of: exact, approx, none'}), 400
         
         # Filters
         status_filter = request.args.get('status', 'all')
@@ -2114,13 +3783,9 @@ def get_pharmacy_prescriptions():
         if status_filter != 'all':
             query = query.filter_by(pharmacy_status=status_filter)
         
-        if search:
-            query = query.join(Prescription.patient).filter(
-                db.or_(
-                    User.full_name.ilike(f'%{search}%'),
-                    Prescription.pickup_token.ilike(f'%{search}%')
-                )
-            )
+        rank = None
+        if search.strip():
+            query, rank = apply_prescription_search(query, search)
         
         if date_from:
             date_from_obj = datetime.strptime(date_from, '%Y-%m-%d')
@@ -2131,19 +3796,61 @@ def get_pharmacy_prescriptions():
             date_to_obj = date_to_obj.replace(hour=23, minute=59, second=59, microsecond=999999)
             query = query.filter(Prescription.created_at <= date_to_obj)
         
-        # Get total count
-        total = query.count()
+        # One count for the whole filter set (paginate() would issue a second one)
+        total, total_is_estimate = None, False
+        if total_mode == 'exact':
+            total = query.order_by(None).count()
+        elif total_mode == 'approx':
+            total, total_is_estimate = estimate_query_count(query)
         
-        # Apply pagination
-        prescriptions = query.order_by(Prescription.created_at.desc()).paginate(
-            page=page, per_page=limit, error_out=False
+        ordered = query.options(*PRESCRIPTION_ROW_LOADERS).order_by(
+            *([rank.desc()] if rank is not None else []),
+            Prescription.created_at.desc(), Prescription.id.desc()
         )
         
+        if page:
+            page = max(page, 1)
+            prescriptions = ordered.offset((page - 1) * limit).limit(limit).all()
+            return jsonify({
+                'prescriptions': PRESCRIPTION_ROWS.rows(prescriptions),
+                'total': total,
+                'page': page,
+                'pages': -(-total // limit) if total is not None else None
+            }), 200
+        
+        # Ranked search results page by offset (the matching set is small); lists by keyset
+        offset = 0
+        if cursor:
+            try:
+                if rank is not None:
+                    offset = decode_offset_cursor(cursor)
+                else:
+                    after_created, after_id = decode_cursor(cursor)
+                    ordered = ordered.filter(
+                        tuple_(Prescription.created_at, Prescription.id) < tuple_(after_created, after_id)
+                    )
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
+        
+        # Fetch one extra row to learn whether another page exists without counting
+        prescriptions = ordered.offset(offset).limit(limit + 1).all()
+        has_more = len(prescriptions) > limit
+        prescriptions = prescriptions[:limit]
+        last = prescriptions[-1] if prescriptions else None
+        if not has_more:
+            next_cursor = None
+        elif rank is not None:
+            next_cursor = encode_offset_cursor(offset + limit)
+        else:
+            next_cursor = encode_cursor(last.created_at, last.id)
+        
         return jsonify({
-            'prescriptions': [p.to_dict() for p in prescriptions.items],
+            'prescriptions': PRESCRIPTION_ROWS.rows(prescriptions),
+            'next_cursor': next_cursor,
+            'has_more': has_more,
+            'limit': limit,
             'total': total,
-            'page': page,
-            'pages': prescriptions.pages
+            'total_is_estimate': total_is_estimate
         }), 200
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -2155,14 +3862,39 @@ def get_today_prescriptions():
         today_start = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
         today_end = datetime.utcnow().replace(hour=23, minute=59, second=59, microsecond=999999)
         
-        prescriptions = Prescription.query.filter(
-            Prescription.created_at >= today_start,
-            Prescription.created_at <= today_end,
-            Prescription.is_deleted == False,
-            Prescription.pharmacy_status.notin_(['dispensed', 'cancelled'])
-        ).order_by(Prescription.created_at.asc()).all()
+        prescriptions = PRESCRIPTION_LIST_ROWS.fetch(
+            prescription_list_select().where(
+                Prescription.created_at >= today_start,
+                Prescription.created_at <= today_end,
+                Prescription.is_deleted == False,
+                Prescription.pharmacy_status.notin_(['dispensed', 'cancelled'])
+            ).order_by(Prescription.created_at.asc())
+        )
+        
+        return jsonify(prescriptions), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/pharmacy/pickup/<token>', methods=['GET'])
+@role_required(['pharmacy'])
+def lookup_pickup_token(token):
+    """Resolve a scanned pickup token (?date=YYYY-MM-DD, default today) via the unique active-token index"""
+    try:
+        date_str = request.args.get('date')
+        pickup_date = datetime.strptime(date_str, '%Y-%m-%d').date() if date_str else date.today()
+        
+        prescription = Prescription.query.options(*PRESCRIPTION_ROW_LOADERS).filter(
+            Prescription.pickup_date == pickup_date,
+            Prescription.pickup_token == token.strip().upper(),
+            Prescription.pharmacy_status.in_(ACTIVE_PHARMACY_STATUSES),
+            Prescription.is_deleted == False
+        ).first()
+        if not prescription:
+            return jsonify({'error': 'No active prescription for this pickup token'}), 404
         
-        return jsonify([p.to_dict() for p in prescriptions]), 200
+        return jsonify(PRESCRIPTION_ROWS.row(prescription)), 200
+    except ValueError:
+        return jsonify({'error': 'Invalid date format. Use YYYY-MM-DD'}), 400
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -2174,7 +3906,7 @@ def get_prescription_detail(prescription_id):
         if not prescription or prescription.is_deleted:
             return jsonify({'error': 'Prescription not found'}), 404
         
-        return jsonify(prescription.to_dict()), 200
+        return jsonify(PRESCRIPTION_ROWS.row(prescription)), 200
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -2211,6 +3943,19 @@ def update_prescription_status(prescription_id):
                 if not prescription_medicines:
                     return jsonify({'error': 'No medicines in prescription to dispense'}), 400
                 
+                # Claim the prescription first so a concurrent dispense of it cannot deduct too
+                claimed = db.session.execute(
+                    db.update(Prescription.__table__).where(
+                        Prescription.id == prescription.id, Prescription.pharmacy_status != 'dispensed'
+                    ).values(pharmacy_status='dispensed')
+                ).rowcount
+                if not claimed:
+                    db.session.rollback()
+                    return jsonify({'error': 'Cannot modify dispensed prescription'}), 400
+                
+                # Holds placed when the prescription was issued become the deduction below
+                release_stock_holds([StockReservation.prescription_id == prescription.id], 'converted')
+                
                 # Check stock availability first
                 stock_issues = []
                 for med_item in prescription_medicines:
@@ -2224,16 +3969,18 @@ def update_prescription_status(prescription_id):
                     medicine = Medicine.query.filter(
                         func.lower(Medicine.name) == func.lower(medicine_name),
                         Medicine.is_available == True
-                    ).with_for_update().first()
+                    ).with_for_update().populate_existing().first()
                     
                     if not medicine:
                         stock_issues.append(f'Medicine "{medicine_name}" not found in inventory')
                         continue
-                        
-                    if medicine.stock_quantity < quantity_needed:
+                    
+                    # Units held for other prescriptions are not available here
+                    available = medicine.stock_quantity - medicine.reserved_quantity
+                    if available < quantity_needed:
                         stock_issues.append(
                             f'Insufficient stock for "{medicine_name}": '
-                            f'needed {quantity_needed}, available {medicine.stock_quantity}'
+                            f'needed {quantity_needed}, available {available}'
                         )
                 
                 if stock_issues:
@@ -2243,7 +3990,8 @@ def update_prescription_status(prescription_id):
                         'stock_issues': stock_issues
                     }), 400
                 
-                # Deduct stock atomically
+                # Deduct stock atomically; a miss undoes every deduction in this attempt
+                conflict = None
                 for med_item in prescription_medicines:
                     medicine_name = med_item.get('name', '').strip()
                     quantity_needed = int(med_item.get('quantity', 0))
@@ -2259,7 +4007,7 @@ def update_prescription_status(prescription_id):
                                 updated_at = :now
                             WHERE LOWER(name) = LOWER(:medicine_name) 
                                 AND is_available = true 
-                                AND stock_quantity >= :quantity
+                                AND stock_quantity - reserved_quantity >= :quantity
                             RETURNING id, name, stock_quantity
                         """),
                         {
@@ -2271,13 +4019,8 @@ def update_prescription_status(prescription_id):
                     
                     if not result:
                         # Race condition or insufficient stock
-                        db.session.rollback()
-                        if attempt < max_retries - 1:
-                            continue  # Retry the whole operation
-                        return jsonify({
-                            'error': f'Stock deduction failed for "{medicine_name}". Please try again.',
-                            'error_code': 'STOCK_CONFLICT'
-                        }), 409
+                        conflict = medicine_name
+                        break
                     
                     dispensing_log.append({
                         'medicine_id': result[0],
@@ -2286,6 +4029,42 @@ def update_prescription_status(prescription_id):
                         'remaining_stock': result[2]
                     })
                 
+                if conflict:
+                    db.session.rollback()
+                    if attempt < max_retries - 1:
+                        continue  # Retry the whole operation from a fresh read
+                    return jsonify({
+                        'error': f'Stock deduction failed for "{conflict}". Please try again.',
+                        'error_code': 'STOCK_CONFLICT'
+                    }), 409
+                
+                # Draw the deducted units from batches, first-expiring first
+                demand = defaultdict(int)
+                for entry in dispensing_log:
+                    demand[entry['medicine_id']] += entry['quantity_dispensed']
+                drawn = defaultdict(list)
+                for _, medicine_id, batch_number, expiry_date, quantity in draw_fefo(demand):
+                    drawn[medicine_id].append({
+                        'batch_number': batch_number,
+                        'expiry_date': expiry_date.isoformat() if expiry_date else None,
+                        'quantity': quantity
+                    })
+                names = {entry['medicine_id']: entry['medicine_name'] for entry in dispensing_log}
+                unexpired = {medicine_id: sum(line['quantity'] for line in drawn[medicine_id]) for medicine_id in demand}
+                short = [medicine_id for medicine_id in demand if unexpired[medicine_id] < demand[medicine_id]]
+                if short:
+                    db.session.rollback()
+                    return jsonify({
+                        'error': 'Cannot dispense prescription due to stock issues',
+                        'stock_issues': [
+                            f'Not enough unexpired stock for "{names[medicine_id]}": '
+                            f'needed {demand[medicine_id]}, unexpired {unexpired[medicine_id]}'
+                            for medicine_id in short
+                        ]
+                    }), 400
+                for entry in dispensing_log:
+                    entry['batches'] = drawn.pop(entry['medicine_id'], [])
+                
                 # Update prescription status
                 prescription.pharmacy_status = new_status
                 prescription.dispensed_at = datetime.utcnow()
@@ -2307,6 +4086,7 @@ def update_prescription_status(prescription_id):
                     
                 if new_status == 'cancelled':
                     prescription.is_deleted = True
+                    release_stock_holds([StockReservation.prescription_id == prescription.id], 'released')
             
             # Create audit log
             log_entry = QueueLog(
@@ -2317,6 +4097,7 @@ def update_prescription_status(prescription_id):
             db.session.add(log_entry)
             
             db.session.commit()
+            low_stock_tracker.refresh(entry['medicine_id'] for entry in dispensing_log)
             
             # Log prescription status update audit event
             log_audit_event(
@@ -2359,20 +4140,9 @@ def update_prescription_status(prescription_id):
 @role_required(['pharmacy'])
 def get_pharmacy_inventory():
     try:
-        medicines = Medicine.query.filter_by(is_available=True).all()
-        
-        result = []
-        for medicine in medicines:
-            result.append({
-                'id': medicine.id,
-                'medicine_name': medicine.name,
-                'generic_name': medicine.generic_name,
-                'category': medicine.category,
-                'quantity_in_stock': medicine.stock_quantity,
-                'reorder_level': medicine.reorder_level,
-                'price_per_unit': medicine.price_per_unit,
-                'low_stock': medicine.stock_quantity <= medicine.reorder_level
-            })
+        result = INVENTORY_ROWS.fetch(
+            db.select(*INVENTORY_ROWS.columns(Medicine)).where(Medicine.is_available == True)
+        )
         
         return jsonify(result), 200
     except Exception as e:
@@ -2383,8 +4153,10 @@ def get_pharmacy_inventory():
 def manage_medicines():
     try:
         if request.method == 'GET':
-            medicines = Medicine.query.filter_by(is_available=True).all()
-            return jsonify([medicine.to_dict() for medicine in medicines]), 200
+            medicines = MEDICINE_ROWS.fetch(
+                db.select(*MEDICINE_ROWS.columns(Medicine)).where(Medicine.is_available == True)
+            )
+            return jsonify(medicines), 200
         
         elif request.method == 'POST':
             data = request.get_json()
@@ -2403,6 +4175,8 @@ def manage_medicines():
             )
             
             db.session.add(medicine)
+            db.session.flush()
+            reconcile_medicine_batches(Medicine.id == medicine.id)
             db.session.commit()
             
             return jsonify({
@@ -2424,6 +4198,18 @@ def update_medicine(medicine_id):
         
         data = request.get_json()
         
+        if 'stock_quantity' in data:
+            try:
+                stock_quantity = int(data['stock_quantity'])
+            except (TypeError, ValueError):
+                return jsonify({'error': 'stock_quantity must be an integer'}), 400
+            # Lock the row so no hold lands between the check and the write (no-op on SQLite)
+            reserved = db.session.query(Medicine.reserved_quantity).filter_by(id=medicine.id).with_for_update().scalar()
+            if stock_quantity < (reserved or 0):
+                db.session.rollback()
+                return jsonify({'error': f'stock_quantity cannot go below the {reserved} units reserved '
+                                         f'for issued prescriptions'}), 400
+        
         if 'name' in data:
             medicine.name = data['name']
         if 'generic_name' in data:
@@ -2439,7 +4225,7 @@ def update_medicine(medicine_id):
         if 'price_per_unit' in data:
             medicine.price_per_unit = data['price_per_unit']
         if 'stock_quantity' in data:
-            medicine.stock_quantity = data['stock_quantity']
+            medicine.stock_quantity = stock_quantity
         if 'reorder_level' in data:
             medicine.reorder_level = data['reorder_level']
         if 'expiry_date' in data and data['expiry_date']:
@@ -2449,6 +4235,8 @@ def update_medicine(medicine_id):
         if 'is_available' in data:
             medicine.is_available = data['is_available']
         
+        db.session.flush()
+        reconcile_medicine_batches(Medicine.id == medicine.id)
         db.session.commit()
         
         return jsonify({
@@ -2464,56 +4252,2220 @@ def update_medicine(medicine_id):
 @role_required(['pharmacy'])
 def get_low_stock_medicines():
     try:
-        low_stock = Medicine.query.filter(
-            Medicine.stock_quantity <= Medicine.reorder_level,
-            Medicine.is_available == True
-        ).all()
-        
-        return jsonify([medicine.to_dict() for medicine in low_stock]), 200
+        # Primary-key lookups for the tracked set instead of a comparison across the table
+        response = jsonify(low_stock_rows(low_stock_tracker.ids()))
+        response.headers['X-Low-Stock-Version'] = str(low_stock_tracker.version)
+        return response, 200
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 # =======================
-# REGISTER BLUEPRINTS
+# STOCK RESERVATIONS
 # =======================
-# DISABLED: Service layer refactor deferred to Phase-5
-# from appointments.routes import appointments_bp
-# app.register_blueprint(appointments_bp, url_prefix='/api/appointments')
 
-# =======================
-# DEBUG: Print all registered routes
-# =======================
-print("\n" + "=" * 60)
-print("REGISTERED ROUTES:")
-print("=" * 60)
-for rule in app.url_map.iter_rules():
-    if '/api/' in str(rule):
-        print(f"  {rule.rule} -> {rule.endpoint} [{', '.join(rule.methods - {'HEAD', 'OPTIONS'})}]")
-print("=" * 60 + "\n")
+# Prescriptions hold their medicines until dispensed, cancelled or this many hours pass
+STOCK_HOLD_HOURS = int(os.getenv('STOCK_HOLD_HOURS', '48'))
+STOCK_HOLD_SWEEP_SECONDS = 900
 
-# =======================
-# UTILITY ROUTES
-# =======================
+def _apply_medicine_deltas(deltas, now, column='stock_quantity'):
+    """One set-based UPDATE adding {medicine_id: delta} to a medicine quantity column"""
+    table = Medicine.__table__
+    if db.engine.dialect.name == 'postgresql':
+        updates = db.values(
+            db.column('id', db.Integer), db.column('delta', db.Integer), name='medicine_deltas'
+        ).data(list(deltas.items()))
+        db.session.execute(
+            db.update(table)
+            .where(table.c.id == updates.c.id)
+            .values({column: table.c[column] + updates.c.delta, 'updated_at': now})
+        )
+    else:
+        # SQLite's UPDATE ... FROM can't alias VALUES columns; executemany the same statement
+        db.session.execute(
+            db.update(table).where(table.c.id == bindparam('medicine_id')).values(
+                {column: table.c[column] + bindparam('delta'), 'updated_at': now}
+            ),
+            [{'medicine_id': medicine_id, 'delta': delta} for medicine_id, delta in deltas.items()]
+        )
 
-@app.route('/api/database/reset', methods=['POST'])
-@jwt_required()
-def reset_database_endpoint():
-    """Reset database to completely clean state - admin only"""
+def reserve_prescription_stock(prescription, medicines):
+    """
+    Hold stock for a new prescription inside the caller's transaction. Holds are soft:
+    a line gets whatever is available-to-promise, and the shortfall comes back as warnings.
+    """
+    wanted, names = defaultdict(int), {}
+    for item in medicines or []:
+        name = str(item.get('name', '')).strip()
+        try:
+            quantity = int(item.get('quantity', 0))
+        except (TypeError, ValueError):
+            continue
+        if name and quantity > 0:
+            wanted[name.lower()] += quantity
+            names.setdefault(name.lower(), name)
+    if not wanted:
+        return []
+    
+    # Lock every prescribed medicine in one round trip, in id order to avoid deadlocks
+    matched = db.session.query(
+        Medicine.id, func.lower(Medicine.name), Medicine.stock_quantity, Medicine.reserved_quantity
+    ).filter(
+        func.lower(Medicine.name).in_(list(wanted)),
+        Medicine.is_available == True
+    ).order_by(Medicine.id).with_for_update().all()
+    
+    holds, warnings, found = {}, [], set()
+    for medicine_id, key, stock, reserved in matched:
+        found.add(key)
+        available = max(stock - reserved, 0)
+        quantity = min(wanted[key], available)
+        if quantity < wanted[key]:
+            warnings.append(f'Only {available} of {wanted[key]} "{names[key]}" could be reserved')
+        if quantity:
+            holds[medicine_id] = quantity
+    for key in wanted:
+        if key not in found:
+            suggestion = medicine_autocomplete.suggest(names[key])
+            warnings.append(f'Medicine "{names[key]}" not found in inventory'
+                            + (f' (did you mean "{suggestion}"?)' if suggestion else ''))
+    
+    if holds:
+        now = datetime.utcnow()
+        _apply_medicine_deltas(holds, now, column='reserved_quantity')
+        db.session.execute(db.insert(StockReservation.__table__), [{
+            'prescription_id': prescription.id,
+            'medicine_id': medicine_id,
+            'quantity': quantity,
+            'status': 'held',
+            'created_at': now,
+            'expires_at': now + timedelta(hours=STOCK_HOLD_HOURS)
+        } for medicine_id, quantity in holds.items()])
+    return warnings
+
+def release_stock_holds(criteria, status):
+    """
+    Give back held reservations matching `criteria` and mark them `status`
+    (converted, released or expired). Runs in the caller's transaction.
+    """
+    # Lock the holds first so two releases can't both decrement the same rows
+    held = db.session.query(
+        StockReservation.id, StockReservation.medicine_id, StockReservation.quantity
+    ).filter(StockReservation.status == 'held', *criteria).with_for_update().all()
+    if not held:
+        return 0
+    
+    deltas = defaultdict(int)
+    for _, medicine_id, quantity in held:
+        deltas[medicine_id] -= quantity
+    now = datetime.utcnow()
+    _apply_medicine_deltas(dict(sorted(deltas.items())), now, column='reserved_quantity')
+    db.session.query(StockReservation).filter(
+        StockReservation.id.in_([row[0] for row in held])
+    ).update({'status': status, 'released_at': now}, synchronize_session=False)
+    return len(held)
+
+def expire_stock_holds():
+    """Release holds past their expiry (uses the partial index on live holds)"""
+    with app.app_context():
+        try:
+            expired = release_stock_holds([StockReservation.expires_at < datetime.utcnow()], 'expired')
+            db.session.commit()
+            if expired:
+                app.logger.info(f'Stock holds: expired {expired} reservation(s)')
+            return expired
+        except Exception as e:
+            db.session.rollback()
+            app.logger.error(f'Stock hold expiry failed: {e}')
+            return 0
+
+def _stock_hold_sweep_loop():
+    import time as _time
+    while True:
+        _time.sleep(STOCK_HOLD_SWEEP_SECONDS)
+        expire_stock_holds()
+
+def schedule_stock_hold_sweep():
+    """Background thread that expires stale holds every STOCK_HOLD_SWEEP_SECONDS"""
+    threading.Thread(target=_stock_hold_sweep_loop, daemon=True).start()
+
+@app.route('/api/pharmacy/medicines/<int:medicine_id>/reservations', methods=['GET'])
+@role_required(['pharmacy'])
+def get_medicine_reservations(medicine_id):
     try:
-        current_user_id = get_jwt_identity()
-        user = User.query.get(current_user_id)
-        
-        # Only allow admins or for development
-        if not user or user.role not in ['admin', 'doctor']:  # Allow doctors for demo purposes
-            return jsonify({'error': 'Unauthorized - admin access required'}), 403
+        medicine = Medicine.query.get(medicine_id)
+        if not medicine:
+            return jsonify({'error': 'Medicine not found'}), 404
         
-        # Perform complete reset
-        success = reset_database_completely()
+        holds = db.session.query(
+            StockReservation.prescription_id, StockReservation.quantity,
+            StockReservation.created_at, StockReservation.expires_at, Prescription.pickup_token
+        ).join(Prescription, Prescription.id == StockReservation.prescription_id).filter(
+            StockReservation.medicine_id == medicine_id,
+            StockReservation.status == 'held'
+        ).order_by(StockReservation.expires_at).all()
         
-        if success:
-            return jsonify({
-                'message': 'Database reset successfully', 
-                'status': 'success',
+        return jsonify({
+            'medicine_id': medicine.id,
+            'stock_quantity': medicine.stock_quantity,
+            'reserved_quantity': medicine.reserved_quantity,
+            'available_quantity': medicine.stock_quantity - medicine.reserved_quantity,
+            'holds': [{
+                'prescription_id': prescription_id,
+                'pickup_token': pickup_token,
+                'quantity': quantity,
+                'created_at': created_at.isoformat() if created_at else None,
+                'expires_at': expires_at.isoformat()
+            } for prescription_id, quantity, created_at, expires_at, pickup_token in holds]
+        }), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+# =======================
+# MEDICINE BATCHES (FEFO)
+# =======================
+
+# medicines.stock_quantity stays the product total; medicine_batches splits it by batch.
+# Dispensing draws from batches directly, other stock writes reconcile afterwards.
+EXPIRING_REPORT_DAYS_MAX = 365
+
+FEFO_PLAN_SQL = """
+WITH demand(medicine_id, needed) AS (VALUES {values}),
+ranked AS (
+    SELECT b.id, b.quantity,
+           d.needed - (SUM(b.quantity) OVER (
+               PARTITION BY b.medicine_id ORDER BY b.expiry_date IS NULL, b.expiry_date, b.id
+           ) - b.quantity) AS remaining
+    FROM medicine_batches b JOIN demand d ON d.medicine_id = b.medicine_id
+    WHERE b.quantity > 0 {expiry_filter}
+),
+plan AS (
+    SELECT id, CASE WHEN remaining < quantity THEN remaining ELSE quantity END AS take
+    FROM ranked WHERE remaining > 0
+)
+"""
+
+def draw_fefo(demand, include_expired=False):
+    """
+    Take {medicine_id: quantity} from batches, first-expiring first, in one statement.
+    Expired batches are skipped unless `include_expired` (write-offs). Returns the
+    (batch_id, medicine_id, batch_number, expiry_date, quantity) lines drawn; callers
+    compare totals with the demand to detect a shortfall.
+    """
+    if not demand:
+        return []
+    params = {'today': date.today(), 'now': datetime.utcnow()}
+    values = []
+    for i, (medicine_id, quantity) in enumerate(sorted(demand.items())):
+        values.append(f'(:medicine_{i}, :needed_{i})')
+        params[f'medicine_{i}'], params[f'needed_{i}'] = medicine_id, quantity
+    plan = FEFO_PLAN_SQL.format(
+        values=', '.join(values),
+        expiry_filter='' if include_expired else 'AND (b.expiry_date IS NULL OR b.expiry_date >= :today)'
+    )
+    columns = (db.column('id', db.Integer), db.column('medicine_id', db.Integer),
+               db.column('batch_number', db.String), db.column('expiry_date', db.Date),
+               db.column('take', db.Integer))
+    
+    if db.engine.dialect.name == 'postgresql':
+        return db.session.execute(text(plan + """
+            UPDATE medicine_batches AS b SET quantity = b.quantity - plan.take, updated_at = :now
+            FROM plan WHERE b.id = plan.id
+            RETURNING b.id, b.medicine_id, b.batch_number, b.expiry_date, plan.take
+        """).columns(*columns), params).all()
+    
+    # SQLite's RETURNING can't see the FROM clause; read the plan, then executemany it
+    drawn = db.session.execute(text(plan + """
+        SELECT b.id, b.medicine_id, b.batch_number, b.expiry_date, plan.take
+        FROM plan JOIN medicine_batches AS b ON b.id = plan.id
+    """).columns(*columns), params).all()
+    if drawn:
+        table = MedicineBatch.__table__
+        db.session.execute(
+            db.update(table).where(table.c.id == bindparam('batch_id')).values(
+                quantity=table.c.quantity - bindparam('take'), updated_at=params['now']
+            ),
+            [{'batch_id': row[0], 'take': row[4]} for row in drawn]
+        )
+    return drawn
+
+def reconcile_medicine_batches(*criteria):
+    """
+    Bring batch totals back in line with stock_quantity for medicines matching `criteria`
+    after a write that only touched the product row. A surplus is received into the
+    medicine's current batch (batch_number / expiry_date); a deficit is written off FEFO.
+    """
+    totals = db.select(
+        MedicineBatch.medicine_id, func.sum(MedicineBatch.quantity).label('total')
+    ).group_by(MedicineBatch.medicine_id).subquery()
+    difference = func.coalesce(Medicine.stock_quantity, 0) - func.coalesce(totals.c.total, 0)
+    drifted = db.session.query(
+        Medicine.id, Medicine.batch_number, Medicine.expiry_date, difference
+    ).outerjoin(totals, totals.c.medicine_id == Medicine.id).filter(difference != 0, *criteria).all()
+    if not drifted:
+        return 0
+    
+    now = datetime.utcnow()
+    receipts = [(medicine_id, number, expiry, diff) for medicine_id, number, expiry, diff in drifted if diff > 0]
+    if receipts:
+        lots = {
+            (medicine_id, number): batch_id
+            for batch_id, medicine_id, number in db.session.query(
+                MedicineBatch.id, MedicineBatch.medicine_id, MedicineBatch.batch_number
+            ).filter(MedicineBatch.medicine_id.in_([r[0] for r in receipts]))
+        }
+        top_ups, new_lots = [], []
+        for medicine_id, number, expiry, diff in receipts:
+            if (medicine_id, number) in lots:
+                top_ups.append({'batch_id': lots[(medicine_id, number)], 'delta': diff})
+            else:
+                new_lots.append({'medicine_id': medicine_id, 'batch_number': number, 'quantity': diff,
+                                 'expiry_date': expiry, 'received_at': now, 'updated_at': now})
+        table = MedicineBatch.__table__
+        if top_ups:
+            db.session.execute(
+                db.update(table).where(table.c.id == bindparam('batch_id')).values(
+                    quantity=table.c.quantity + bindparam('delta'), updated_at=now
+                ),
+                top_ups
+            )
+        if new_lots:
+            db.session.execute(db.insert(table), new_lots)
+    
+    draw_fefo({medicine_id: -diff for medicine_id, _, _, diff in drifted if diff < 0}, include_expired=True)
+    return len(drifted)
+
+def backfill_medicine_batches():
+    """Upgrade step: give every medicine's existing stock a batch row"""
+    count = reconcile_medicine_batches()
+    return [f'Reconciled batches for {count} medicines'] if count else []
+
+SCHEMA_UPGRADE_STEPS.append(backfill_medicine_batches)
+
+@app.route('/api/pharmacy/medicines/<int:medicine_id>/batches', methods=['GET', 'POST'])
+@role_required(['pharmacy'])
+def medicine_batches(medicine_id):
+    try:
+        if request.method == 'GET':
+            batches = MedicineBatch.query.filter(
+                MedicineBatch.medicine_id == medicine_id, MedicineBatch.quantity > 0
+            ).order_by(MedicineBatch.expiry_date.is_(None), MedicineBatch.expiry_date, MedicineBatch.id).all()
+            return jsonify([batch.to_dict() for batch in batches]), 200
+        
+        # Receive a delivery into its own batch (or top up a batch with the same number)
+        data = request.get_json() or {}
+        try:
+            quantity = int(data.get('quantity', 0))
+            expiry_date = datetime.strptime(data['expiry_date'], '%Y-%m-%d').date() if data.get('expiry_date') else None
+        except (TypeError, ValueError):
+            return jsonify({'error': 'quantity must be an integer and expiry_date YYYY-MM-DD'}), 400
+        if quantity <= 0:
+            return jsonify({'error': 'quantity must be positive'}), 400
+        batch_number = (data.get('batch_number') or '').strip() or None
+        
+        medicine = Medicine.query.filter_by(id=medicine_id).with_for_update().first()
+        if not medicine:
+            return jsonify({'error': 'Medicine not found'}), 404
+        batch = MedicineBatch.query.filter_by(medicine_id=medicine.id, batch_number=batch_number).first() \
+            if batch_number else None
+        if batch:
+            batch.quantity += quantity
+            batch.expiry_date = expiry_date or batch.expiry_date
+        else:
+            batch = MedicineBatch(medicine_id=medicine.id, batch_number=batch_number,
+                                  quantity=quantity, expiry_date=expiry_date)
+            db.session.add(batch)
+        medicine.stock_quantity = (medicine.stock_quantity or 0) + quantity
+        db.session.commit()
+        
+        return jsonify({
+            'message': 'Batch received',
+            'batch': batch.to_dict(),
+            'medicine': medicine.to_dict()
+        }), 201
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/pharmacy/batches/expiring', methods=['GET'])
+@role_required(['pharmacy'])
+def get_expiring_batches():
+    """Batches with stock expiring within ?days= (default 30), already-expired ones first"""
+    try:
+        days = min(max(request.args.get('days', 30, type=int), 0), EXPIRING_REPORT_DAYS_MAX)
+        today = date.today()
+        rows = db.session.query(
+            MedicineBatch.id, MedicineBatch.medicine_id, Medicine.name, MedicineBatch.batch_number,
+            MedicineBatch.quantity, MedicineBatch.expiry_date
+        ).join(Medicine, Medicine.id == MedicineBatch.medicine_id).filter(
+            MedicineBatch.quantity > 0,
+            MedicineBatch.expiry_date <= today + timedelta(days=days)
+        ).order_by(MedicineBatch.expiry_date, MedicineBatch.id).all()
+        
+        return jsonify({
+            'days': days,
+            'batches': [{
+                'batch_id': batch_id,
+                'medicine_id': medicine_id,
+                'medicine_name': name,
+                'batch_number': batch_number,
+                'quantity': quantity,
+                'expiry_date': expiry_date.isoformat(),
+                'days_left': (expiry_date - today).days,
+                'expired': expiry_date < today
+            } for batch_id, medicine_id, name, batch_number, quantity, expiry_date in rows]
+        }), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+# =======================
+# LOW-STOCK TRACKING
+# =======================
+
+# The tracker is per worker; stock changes made by other workers are only seen at a resync
+LOW_STOCK_RESYNC_SECONDS = int(os.environ.get('LOW_STOCK_RESYNC_SECONDS', 60))
+LOW_STOCK_EVENT_BACKLOG = 500
+LOW_STOCK_STREAM_SECONDS = 600
+
+class LowStockTracker:
+    """
+    Ids of available medicines at or below their reorder level. Loaded once through the
+    ix_medicine_low_stock partial index, then updated from committed stock changes: ORM
+    writes are captured automatically, raw SQL paths call refresh() with the ids they
+    touched. Every change to a low-stock medicine is kept as a versioned event for the
+    pharmacy dashboard stream. Changes made by other workers are picked up by the
+    periodic resync.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._ids = None
+        self._loaded_at = 0.0
+        self._version = 0
+        self._events = deque(maxlen=LOW_STOCK_EVENT_BACKLOG)
+
+    @property
+    def version(self):
+        return self._version
+
+    @property
+    def resync_due(self):
+        return self._ids is None or monotonic() - self._loaded_at > LOW_STOCK_RESYNC_SECONDS
+
+    def ids(self):
+        """Current low-stock medicine ids (loads or resyncs from the database when due)"""
+        if self.resync_due:
+            self.resync()
+        with self._lock:
+            return set(self._ids)
+
+    def resync(self):
+        """Reload the set through the partial index and emit events for whatever drifted"""
+        current = {medicine_id for (medicine_id,) in db.session.query(Medicine.id).filter(
+            Medicine.stock_quantity <= Medicine.reorder_level,
+            Medicine.is_available == True
+        )}
+        with self._lock:
+            previous = self._ids
+            self._loaded_at = monotonic()
+            if previous is None:
+                self._ids = current
+                return
+            drifted = previous ^ current
+        if drifted:
+            self.refresh(drifted)
+
+    def refresh(self, medicine_ids):
+        """Re-read the given medicines after a commit that bypassed the ORM"""
+        medicine_ids = set(medicine_ids)
+        if not medicine_ids or self._ids is None:
+            return
+        states = db.session.query(
+            Medicine.id, Medicine.name, Medicine.stock_quantity, Medicine.reorder_level, Medicine.is_available
+        ).filter(Medicine.id.in_(medicine_ids)).all()
+        found = {state[0] for state in states}
+        # Deleted rows leave the set
+        states += [(medicine_id, None, 0, 0, False) for medicine_id in medicine_ids - found]
+        self.apply(states)
+
+    def apply(self, states):
+        """Fold committed (id, name, stock_quantity, reorder_level, is_available) states into the set"""
+        with self._lock:
+            if self._ids is None:
+                return
+            events = []
+            for medicine_id, name, stock_quantity, reorder_level, is_available in states:
+                is_low = bool(is_available) and (stock_quantity or 0) <= (reorder_level or 0)
+                was_low = medicine_id in self._ids
+                if not is_low and not was_low:
+                    continue
+                if is_low:
+                    self._ids.add(medicine_id)
+                else:
+                    self._ids.discard(medicine_id)
+                events.append({
+                    'medicine_id': medicine_id,
+                    'name': name,
+                    'stock_quantity': stock_quantity,
+                    'reorder_level': reorder_level,
+                    'stock_status': medicine_stock_status(stock_quantity, reorder_level) if is_available else None,
+                    'change': 'updated' if is_low and was_low else ('entered' if is_low else 'left')
+                })
+            if not events:
+                return
+            for event_data in events:
+                self._version += 1
+                self._events.append({'version': self._version, **event_data})
+            self._changed.notify_all()
+
+    def events_since(self, version):
+        """Events after `version`, or None when the backlog no longer reaches back that far"""
+        with self._lock:
+            if version == self._version:
+                return []
+            if not self._events or self._events[0]['version'] > version + 1:
+                return None
+            return [event_data for event_data in self._events if event_data['version'] > version]
+
+    def wait_for_change(self, version, timeout):
+        with self._lock:
+            self._changed.wait_for(lambda: self._version != version, timeout=timeout)
+            return self._version
+
+low_stock_tracker = LowStockTracker()
+
+def _stage_medicine_state(mapper, connection, target):
+    session = object_session(target)
+    if session is not None:
+        session.info.setdefault('low_stock_states', {})[target.id] = (
+            target.id, target.name, target.stock_quantity, target.reorder_level, target.is_available
+        )
+
+def _stage_medicine_delete(mapper, connection, target):
+    session = object_session(target)
+    if session is not None:
+        session.info.setdefault('low_stock_states', {})[target.id] = (target.id, target.name, 0, 0, False)
+
+event.listen(Medicine, 'after_insert', _stage_medicine_state)
+event.listen(Medicine, 'after_update', _stage_medicine_state)
+event.listen(Medicine, 'after_delete', _stage_medicine_delete)
+
+@event.listens_for(OrmSession, 'after_commit')
+def _publish_medicine_states(session):
+    states = session.info.pop('low_stock_states', None)
+    if states:
+        low_stock_tracker.apply(states.values())
+
+@event.listens_for(OrmSession, 'after_rollback')
+def _discard_medicine_states(session):
+    session.info.pop('low_stock_states', None)
+
+def low_stock_rows(medicine_ids):
+    if not medicine_ids:
+        return []
+    return MEDICINE_ROWS.fetch(
+        db.select(*MEDICINE_ROWS.columns(Medicine)).where(Medicine.id.in_(medicine_ids)).order_by(Medicine.name)
+    )
+
+@app.route('/api/pharmacy/low-stock/stream', methods=['GET'])
+@jwt_required(locations=['headers', 'query_string'])
+def stream_low_stock():
+    """
+    Server-sent events for the pharmacy dashboard (token may be passed as ?jwt=): a
+    `snapshot` event with the full low-stock list, then `change` events as stock moves.
+    """
+    current_user = db.session.get(User, get_jwt_identity())
+    if not current_user or current_user.role not in ['pharmacy', 'admin']:
+        return jsonify({'error': 'Access denied. Insufficient permissions.'}), 403
+    
+    try:
+        version = low_stock_tracker.version
+        snapshot = json.dumps(low_stock_rows(low_stock_tracker.ids()), default=_json_default)
+    finally:
+        db.session.remove()
+    
+    def generate():
+        nonlocal version
+        yield f'event: snapshot\nid: {version}\ndata: {snapshot}\n\n'
+        deadline = monotonic() + LOW_STOCK_STREAM_SECONDS
+        while monotonic() < deadline:
+            latest = low_stock_tracker.wait_for_change(version, timeout=15)
+            if latest == version:
+                # An idle stream still resyncs, so other workers' stock changes reach it
+                if low_stock_tracker.resync_due:
+                    try:
+                        low_stock_tracker.resync()
+                    finally:
+                        db.session.remove()
+                yield ': keep-alive\n\n'
+                continue
+            events = low_stock_tracker.events_since(version)
+            if events is None:
+                # Version first: events landing while the rows are read are re-sent, never lost
+                version = low_stock_tracker.version
+                try:
+                    payload = json.dumps(low_stock_rows(low_stock_tracker.ids()), default=_json_default)
+                finally:
+                    db.session.remove()
+                yield f'event: snapshot\nid: {version}\ndata: {payload}\n\n'
+            elif events:
+                for event_data in events:
+                    yield f"event: change\nid: {event_data['version']}\ndata: {json.dumps(event_data)}\n\n"
+                version = events[-1]['version']
+    
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+# =======================
+# MEDICINE AUTOCOMPLETE
+# =======================
+
+# Medicines added or renamed through another worker reach this worker's index at a resync
+MEDICINE_INDEX_RESYNC_SECONDS = 300
+AUTOCOMPLETE_LIMIT_MAX = 25
+# Prefix matches considered before ranking; short prefixes can match most of the catalogue
+AUTOCOMPLETE_PREFIX_SCAN = 200
+
+def _autocomplete_keys(name, generic_name):
+    """Lowercased text from every word start, so 'amox' finds 'Co-Amoxiclav'"""
+    keys = set()
+    for value in (name, generic_name):
+        value = (value or '').lower()
+        keys.update(value[match.start():] for match in re.finditer(r'[a-z0-9]+', value))
+    return keys
+
+def _fold_autocomplete_states(entries, keys, states):
+    """Apply (id, entry-or-None) states to an autocomplete id map and its sorted key list"""
+    for medicine_id, entry in states:
+        previous = entries.pop(medicine_id, None)
+        if previous:
+            for key in _autocomplete_keys(previous[0], previous[1]):
+                index = bisect.bisect_left(keys, (key, medicine_id))
+                if index < len(keys) and keys[index] == (key, medicine_id):
+                    del keys[index]
+        if entry is not None:
+            entries[medicine_id] = entry
+            for key in _autocomplete_keys(entry[0], entry[1]):
+                bisect.insort(keys, (key, medicine_id))
+
+class MedicineAutocomplete:
+    """
+    Medicine name / generic name lookup for the prescribing screen, served from memory.
+    Word-start keys live in one sorted list, so a prefix lookup is a bisect plus a short
+    scan; typos fall back to a TrigramIndex. Loaded lazily with one query, then updated
+    from committed ORM changes; raw SQL writers call invalidate(), and other workers'
+    changes are picked up by the periodic resync, which rebuilds in a background thread
+    while the old list keeps serving.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = None  # id -> (name, generic_name, strength, form, is_available)
+        self._keys = []       # sorted [(key, id)]
+        self._loaded_at = 0.0
+        self._pending = None  # states committed while a load is in flight
+        self._refreshing = False
+        self._fuzzy = TrigramIndex(self._fuzzy_texts)
+
+    def _fuzzy_texts(self):
+        with self._lock:
+            entries = dict(self._entries or {})
+        return [(medicine_id, f'{entry[0]} {entry[1] or ""}') for medicine_id, entry in entries.items()]
+
+    def _load(self):
+        """Read every medicine and install the new list; returns (entries, keys)"""
+        with self._lock:
+            if self._pending is None:
+                self._pending = []
+        rows = db.session.query(
+            Medicine.id, Medicine.name, Medicine.generic_name, Medicine.strength, Medicine.form,
+            Medicine.is_available
+        ).all()
+        entries = {row[0]: tuple(row[1:]) for row in rows}
+        keys = sorted(
+            (key, medicine_id)
+            for medicine_id, entry in entries.items()
+            for key in _autocomplete_keys(entry[0], entry[1])
+        )
+        with self._lock:
+            # Commits that landed after the read would otherwise be lost until the next resync
+            _fold_autocomplete_states(entries, keys, self._pending or ())
+            self._entries, self._keys, self._loaded_at, self._pending = entries, keys, monotonic(), None
+        self._fuzzy.reset()
+        return entries, keys
+
+    def _background_load(self):
+        try:
+            with app.app_context():
+                self._load()
+        except Exception as e:
+            app.logger.error(f'Medicine autocomplete resync failed: {e}')
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+    def _snapshot(self):
+        """
+        Current (entries, keys). The first lookup (or the first after invalidate()) loads
+        inline; a stale list keeps serving while a background thread rebuilds it.
+        """
+        with self._lock:
+            entries, keys = self._entries, self._keys
+            refresh = (entries is not None and not self._refreshing
+                       and monotonic() - self._loaded_at > MEDICINE_INDEX_RESYNC_SECONDS)
+            if refresh:
+                self._refreshing = True
+        if entries is None:
+            return self._load()
+        if refresh:
+            threading.Thread(target=self._background_load, daemon=True).start()
+        return entries, keys
+
+    def apply(self, states):
+        """Fold committed (id, name, generic_name, strength, form, is_available) states in; None deletes"""
+        with self._lock:
+            if self._pending is not None:
+                self._pending.extend(states)
+            if self._entries is not None:
+                _fold_autocomplete_states(self._entries, self._keys, states)
+        for medicine_id, entry in states:
+            if entry is None:
+                self._fuzzy.discard(medicine_id)
+            else:
+                self._fuzzy.update(medicine_id, f'{entry[0]} {entry[1] or ""}')
+
+    def invalidate(self):
+        with self._lock:
+            self._entries = None
+        self._fuzzy.reset()
+
+    def lookup(self, term, limit=10, include_unavailable=False):
+        """[(id, entry, match)] best first; prefix matches on the name rank above generic/word ones"""
+        needle = term.strip().lower()
+        if not needle:
+            return []
+        # Scan the snapshot: invalidate() may swap the live list out from under us
+        entries_by_id, keys = self._snapshot()
+        ranked, entries = {}, {}
+        with self._lock:
+            index = bisect.bisect_left(keys, (needle,))
+            while index < len(keys) and len(ranked) < AUTOCOMPLETE_PREFIX_SCAN:
+                key, medicine_id = keys[index]
+                if not key.startswith(needle):
+                    break
+                entry = entries_by_id.get(medicine_id)
+                if entry and (include_unavailable or entry[4]):
+                    score = 2.0 if entry[0].lower().startswith(needle) else 1.5
+                    ranked[medicine_id] = max(ranked.get(medicine_id, 0.0), score)
+                    entries[medicine_id] = entry
+                index += 1
+        if len(ranked) < limit and len(needle) >= 3:
+            scores = self._fuzzy.search(needle, limit=limit * 2)
+            with self._lock:
+                for medicine_id, score in scores.items():
+                    entry = entries_by_id.get(medicine_id)
+                    if medicine_id not in ranked and entry and (include_unavailable or entry[4]):
+                        ranked[medicine_id], entries[medicine_id] = score, entry
+        best = sorted(ranked, key=lambda medicine_id: (-ranked[medicine_id], entries[medicine_id][0].lower()))
+        return [
+            (medicine_id, entries[medicine_id], 'prefix' if ranked[medicine_id] >= 1.5 else 'fuzzy')
+            for medicine_id in best[:limit]
+        ]
+
+    def suggest(self, term):
+        """Closest available medicine name for a free-text entry, or None"""
+        matches = self.lookup(term, limit=1)
+        return matches[0][1][0] if matches else None
+
+medicine_autocomplete = MedicineAutocomplete()
+
+def _stage_medicine_name(mapper, connection, target):
+    session = object_session(target)
+    if session is not None:
+        session.info.setdefault('medicine_index_states', {})[target.id] = (
+            target.name, target.generic_name, target.strength, target.form, bool(target.is_available)
+        )
+
+def _stage_medicine_name_delete(mapper, connection, target):
+    session = object_session(target)
+    if session is not None:
+        session.info.setdefault('medicine_index_states', {})[target.id] = None
+
+event.listen(Medicine, 'after_insert', _stage_medicine_name)
+event.listen(Medicine, 'after_update', _stage_medicine_name)
+event.listen(Medicine, 'after_delete', _stage_medicine_name_delete)
+
+@event.listens_for(OrmSession, 'after_commit')
+def _publish_medicine_names(session):
+    states = session.info.pop('medicine_index_states', None)
+    if states:
+        medicine_autocomplete.apply(list(states.items()))
+
+@event.listens_for(OrmSession, 'after_rollback')
+def _discard_medicine_names(session):
+    session.info.pop('medicine_index_states', None)
+
+@app.route('/api/medicines/autocomplete', methods=['GET'])
+@role_required(['doctor', 'pharmacy'])
+def autocomplete_medicines():
+    """?q= prefix or misspelt name; matches medicine and generic names from any word start"""
+    try:
+        limit = min(max(request.args.get('limit', 10, type=int), 1), AUTOCOMPLETE_LIMIT_MAX)
+        include_unavailable = request.args.get('include_unavailable', 'false').lower() == 'true'
+        matches = medicine_autocomplete.lookup(request.args.get('q', ''), limit, include_unavailable)
+        return jsonify([{
+            'id': medicine_id,
+            'name': name,
+            'generic_name': generic_name,
+            'strength': strength,
+            'form': form,
+            'is_available': is_available,
+            'match': match
+        } for medicine_id, (name, generic_name, strength, form, is_available), match in matches]), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+# =======================
+# BULK INVENTORY
+# =======================
+
+BULK_BATCH_SIZE = int(os.environ.get('BULK_BATCH_SIZE', 500))
+BULK_ERROR_REPORT_LIMIT = 1000
+
+def _bulk_str(limit, default=''):
+    def parse(value):
+        value = str(value).strip() if value is not None else ''
+        if not value:
+            return default
+        if len(value) > limit:
+            raise ValueError(f'longer than {limit} characters')
+        return value
+    return parse
+
+def _bulk_number(kind, default, minimum=0):
+    def parse(value):
+        if value is None or value == '':
+            return default
+        number = kind(value)
+        if number < minimum:
+            raise ValueError(f'must be >= {minimum}')
+        return number
+    return parse
+
+def _bulk_date(value):
+    if value is None or value == '':
+        return None
+    return datetime.strptime(str(value).strip(), '%Y-%m-%d').date()
+
+def _bulk_bool(value):
+    if value is None or value == '':
+        return True
+    if isinstance(value, bool):
+        return value
+    text_value = str(value).strip().lower()
+    if text_value not in ('true', 'false', '1', '0', 'yes', 'no'):
+        raise ValueError('must be true or false')
+    return text_value in ('true', '1', 'yes')
+
+# Importable medicine columns and their parsers; blank cells take the same defaults as POST
+MEDICINE_IMPORT_COLUMNS = {
+    'name': _bulk_str(100),
+    'generic_name': _bulk_str(100),
+    'category': _bulk_str(50),
+    'strength': _bulk_str(20),
+    'form': _bulk_str(20),
+    'batch_number': _bulk_str(50, default=None),
+    'price_per_unit': _bulk_number(float, 0.0),
+    'stock_quantity': _bulk_number(int, 0),
+    'reorder_level': _bulk_number(int, 10),
+    'expiry_date': _bulk_date,
+    'manufacturer': _bulk_str(100),
+    'is_available': _bulk_bool,
+}
+
+class BulkReport:
+    """
+    Running totals and a capped per-row error list for one bulk request. Valid rows that
+    wrote nothing (an import row overridden by a later one for the same medicine, stock
+    deltas that cancel out) count as unchanged rather than applied.
+    """
+
+    def __init__(self):
+        self.processed = 0
+        self.applied = 0
+        self.unchanged = 0
+        self.failed = 0
+        self.errors = []
+
+    def error(self, row_number, message, key=None):
+        self.failed += 1
+        if len(self.errors) < BULK_ERROR_REPORT_LIMIT:
+            entry = {'row': row_number, 'error': message}
+            if key is not None:
+                entry['key'] = key
+            self.errors.append(entry)
+
+    def to_dict(self):
+        return {
+            'processed': self.processed,
+            'applied': self.applied,
+            'unchanged': self.unchanged,
+            'failed': self.failed,
+            'errors': sorted(self.errors, key=operator.itemgetter('row')),
+            'errors_truncated': self.failed > len(self.errors)
+        }
+
+def iter_bulk_records():
+    """
+    Stream records from the request body as (row_number, dict) without buffering it.
+    CSV (text/csv, header row required) or NDJSON (application/x-ndjson, one object
+    per line); ?format=csv|ndjson overrides the content type. Unparseable NDJSON lines
+    are yielded as (row_number, None).
+    """
+    fmt = request.args.get('format') or ('csv' if request.mimetype in ('text/csv', 'application/csv') else 'ndjson')
+    lines = (line.decode('utf-8') for line in request.stream)
+    if fmt == 'csv':
+        reader = csv.DictReader(line.lstrip('\ufeff') if i == 0 else line for i, line in enumerate(lines))
+        for record in reader:
+            yield reader.line_num, {
+                (key or '').strip().lower(): (value.strip() if isinstance(value, str) else value)
+                for key, value in record.items()
+            }
+    else:
+        for row_number, line in enumerate(lines, 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                record = None
+            yield row_number, record if isinstance(record, dict) or record is None else None
+
+def iter_bulk_batches(records):
+    batch = []
+    for item in records:
+        batch.append(item)
+        if len(batch) >= BULK_BATCH_SIZE:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def _medicine_upsert_statement(update_columns):
+    dialect = db.engine.dialect.name
+    insert = pg_dialect.insert if dialect == 'postgresql' else sqlite_dialect.insert
+    stmt = insert(Medicine.__table__)
+    set_ = {column: stmt.excluded[column] for column in update_columns if column != 'name'}
+    set_['updated_at'] = stmt.excluded.updated_at
+    return stmt.on_conflict_do_update(index_elements=[func.lower(Medicine.__table__.c.name)], set_=set_)
+
+def _copy_medicine_batch(rows, update_columns):
+    """PostgreSQL: COPY the batch into a temp staging table, then upsert it in one statement"""
+    columns = list(MEDICINE_IMPORT_COLUMNS) + ['created_at', 'updated_at']
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow(['\\N' if row[column] is None else row[column] for column in columns])
+    buffer.seek(0)
+    
+    connection = db.session.connection()
+    connection.exec_driver_sql(
+        'CREATE TEMP TABLE IF NOT EXISTS medicine_import_staging ON COMMIT DELETE ROWS '
+        f"AS SELECT {', '.join(columns)} FROM medicines WITH NO DATA"
+    )
+    cursor = connection.connection.cursor()
+    try:
+        cursor.copy_expert(
+            f"COPY medicine_import_staging ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv, NULL '\\N')",
+            buffer
+        )
+    finally:
+        cursor.close()
+    assignments = ', '.join(f'{column} = EXCLUDED.{column}' for column in update_columns if column != 'name')
+    connection.exec_driver_sql(
+        f"INSERT INTO medicines ({', '.join(columns)}) "
+        f"SELECT {', '.join(columns)} FROM medicine_import_staging "
+        f"ON CONFLICT ((lower(name))) DO UPDATE SET {assignments + ', ' if assignments else ''}"
+        f"updated_at = EXCLUDED.updated_at"
+    )
+    connection.exec_driver_sql('TRUNCATE medicine_import_staging')
+
+def _upsert_medicine_batch(batch, update_columns, report):
+    """Validate one batch and upsert the valid rows; constraint failures fall back to per-row savepoints"""
+    now = datetime.utcnow()
+    rows = {}
+    superseded = 0
+    for row_number, record in batch:
+        report.processed += 1
+        if record is None:
+            report.error(row_number, 'not a JSON object')
+            continue
+        try:
+            row = {}
+            for column, parse in MEDICINE_IMPORT_COLUMNS.items():
+                try:
+                    row[column] = parse(record.get(column))
+                except (TypeError, ValueError) as e:
+                    raise ValueError(f'{column}: {e}')
+            if not row['name']:
+                raise ValueError('name: required')
+        except ValueError as e:
+            report.error(row_number, str(e), record.get('name'))
+            continue
+        row['created_at'] = row['updated_at'] = now
+        # A later row for the same medicine wins; ON CONFLICT can't touch a row twice per statement
+        if row['name'].lower() in rows:
+            superseded += 1
+        rows[row['name'].lower()] = (row_number, row)
+    if 'stock_quantity' in update_columns:
+        # Units held for issued prescriptions cannot be overwritten away (FOR UPDATE is a no-op on SQLite)
+        reserved = dict(db.session.query(func.lower(Medicine.name), Medicine.reserved_quantity).filter(
+            func.lower(Medicine.name).in_(list(rows)), Medicine.reserved_quantity > 0
+        ).order_by(Medicine.id).with_for_update().all())
+        for name, held in reserved.items():
+            row_number, row = rows[name]
+            if (row['stock_quantity'] or 0) < held:
+                report.error(row_number, f'stock_quantity: below the {held} units reserved', row['name'])
+                del rows[name]
+    report.unchanged += superseded
+    if not rows:
+        return
+    
+    try:
+        with db.session.begin_nested():
+            if db.engine.dialect.name == 'postgresql':
+                _copy_medicine_batch([row for _, row in rows.values()], update_columns)
+            else:
+                db.session.execute(_medicine_upsert_statement(update_columns), [row for _, row in rows.values()])
+        report.applied += len(rows)
+    except sa_exc.DBAPIError:
+        statement = _medicine_upsert_statement(update_columns)
+        for row_number, row in rows.values():
+            try:
+                with db.session.begin_nested():
+                    db.session.execute(statement, [row])
+                report.applied += 1
+            except sa_exc.DBAPIError as e:
+                report.error(row_number, str(e.orig).splitlines()[0], row['name'])
+    if 'stock_quantity' in update_columns:
+        reconcile_medicine_batches(func.lower(Medicine.name).in_(list(rows)))
+
+@app.route('/api/pharmacy/medicines/import', methods=['POST'])
+@role_required(['pharmacy'])
+def import_medicines():
+    """
+    Bulk create/update medicines from a streamed CSV or NDJSON body, matched on the
+    case-insensitive name. Only the columns in the CSV header (or the first NDJSON
+    record) are overwritten on existing medicines. Each batch commits separately and
+    the response lists failed rows.
+    """
+    try:
+        report = BulkReport()
+        update_columns = None
+        for batch in iter_bulk_batches(iter_bulk_records()):
+            if update_columns is None:
+                first = next((record for _, record in batch if record), {})
+                update_columns = [column for column in MEDICINE_IMPORT_COLUMNS if column in first]
+                if 'name' not in update_columns:
+                    return jsonify({'error': 'name column is required'}), 400
+            _upsert_medicine_batch(batch, update_columns, report)
+            db.session.commit()
+        # Upserts bypass the ORM and are keyed by name; diff the whole set once
+        low_stock_tracker.resync()
+        medicine_autocomplete.invalidate()
+        system_stats.mark_stale()
+        
+        log_audit_event(
+            action_type='BULK_IMPORT',
+            resource_type='MEDICINE',
+            details={key: value for key, value in report.to_dict().items() if key != 'errors'},
+            user_id=get_jwt_identity(),
+            request_obj=request
+        )
+        db.session.commit()
+        return jsonify(report.to_dict()), 200 if not report.failed else 207
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 500
+
+def _adjust_stock_batch(batch, report):
+    """Resolve, lock and validate one batch of stock deltas, then apply them together"""
+    parsed = []
+    ids, names = set(), set()
+    for row_number, record in batch:
+        report.processed += 1
+        if record is None:
+            report.error(row_number, 'not a JSON object')
+            continue
+        key = record.get('medicine_id') or record.get('name')
+        try:
+            delta = int(record.get('delta'))
+            if delta == 0:
+                raise ValueError
+        except (TypeError, ValueError):
+            report.error(row_number, 'delta: must be a non-zero integer', key)
+            continue
+        if record.get('medicine_id'):
+            try:
+                key = int(record['medicine_id'])
+            except (TypeError, ValueError):
+                report.error(row_number, 'medicine_id: must be an integer', key)
+                continue
+            ids.add(key)
+        elif record.get('name'):
+            key = str(record['name']).strip().lower()
+            names.add(key)
+        else:
+            report.error(row_number, 'medicine_id or name is required')
+            continue
+        parsed.append((row_number, key, delta))
+    if not parsed:
+        return
+    
+    # One locking read for the whole batch (FOR UPDATE is a no-op on SQLite)
+    lookup = db.session.query(
+        Medicine.id, func.lower(Medicine.name), Medicine.stock_quantity, Medicine.reserved_quantity
+    ).filter(
+        db.or_(Medicine.id.in_(ids), func.lower(Medicine.name).in_(names))
+    ).order_by(Medicine.id).with_for_update().all()
+    stock = {medicine_id: quantity for medicine_id, _, quantity, _ in lookup}
+    reserved = {medicine_id: held or 0 for medicine_id, _, _, held in lookup}
+    by_name = {name: medicine_id for medicine_id, name, _, _ in lookup}
+    
+    deltas = defaultdict(int)
+    accepted = defaultdict(int)
+    for row_number, key, delta in parsed:
+        medicine_id = key if isinstance(key, int) else by_name.get(key)
+        if medicine_id not in stock:
+            report.error(row_number, 'medicine not found', key)
+            continue
+        # Units held for issued prescriptions cannot be written off
+        if delta < 0 and stock[medicine_id] + delta < reserved[medicine_id]:
+            available = max(stock[medicine_id] - reserved[medicine_id], 0)
+            report.error(row_number, f'insufficient stock ({available} available, '
+                                     f'{reserved[medicine_id]} reserved)', key)
+            continue
+        stock[medicine_id] += delta
+        deltas[medicine_id] += delta
+        accepted[medicine_id] += 1
+    for medicine_id, rows in accepted.items():
+        if deltas[medicine_id]:
+            report.applied += rows
+        else:
+            report.unchanged += rows
+    deltas = {medicine_id: delta for medicine_id, delta in deltas.items() if delta}
+    if deltas:
+        _apply_medicine_deltas(deltas, datetime.utcnow())
+        # Deliveries land in the current batch, write-offs come out of the first-expiring
+        reconcile_medicine_batches(Medicine.id.in_(list(deltas)))
+    return deltas.keys()
+
+@app.route('/api/pharmacy/medicines/stock-adjustments', methods=['POST'])
+@role_required(['pharmacy'])
+def adjust_medicine_stock():
+    """
+    Bulk stock deltas from a streamed CSV or NDJSON body: records of medicine_id (or
+    name) and a signed delta, e.g. a delivery (+) or a write-off (-). Write-offs that would
+    take stock below the units reserved for issued prescriptions are rejected per row;
+    each batch commits separately.
+    """
+    try:
+        report = BulkReport()
+        for batch in iter_bulk_batches(iter_bulk_records()):
+            adjusted = _adjust_stock_batch(batch, report)
+            db.session.commit()
+            low_stock_tracker.refresh(adjusted or ())
+        
+        log_audit_event(
+            action_type='BULK_STOCK_ADJUSTMENT',
+            resource_type='MEDICINE',
+            details={key: value for key, value in report.to_dict().items() if key != 'errors'},
+            user_id=get_jwt_identity(),
+            request_obj=request
+        )
+        db.session.commit()
+        return jsonify(report.to_dict()), 200 if not report.failed else 207
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 500
+
+# =======================
+# SYSTEM STATISTICS
+# =======================
+
+# Counters are per worker, so other workers' writes are only counted at a reconcile
+STATS_RECONCILE_SECONDS = int(os.environ.get('STATS_RECONCILE_SECONDS', 300))
+# PostgreSQL tables estimated above this many rows are counted from pg_class instead
+STATS_EXACT_ROW_LIMIT = 100_000
+
+# Attributes whose changes move a counter, per tracked model
+STAT_TRACKED_ATTRIBUTES = {
+    User: ('role',),
+    Hospital: (),
+    Department: ('is_active',),
+    DoctorProfile: (),
+    Appointment: ('appointment_date', 'status'),
+    Prescription: ('pharmacy_status',),
+    Medicine: (),
+}
+
+def _stat_keys(model, state):
+    """Counter keys a row with these attribute values contributes to"""
+    if model is User:
+        return ['users', f'users:{state["role"]}']
+    if model is Hospital:
+        return ['hospitals']
+    if model is Department:
+        return ['departments'] + (['departments:active'] if state['is_active'] else [])
+    if model is DoctorProfile:
+        return ['doctor_profiles']
+    if model is Appointment:
+        day = state['appointment_date'].isoformat() if state['appointment_date'] else None
+        keys = ['appointments', f'appointments:{day}']
+        return keys + [f'appointments:{day}:completed'] if state['status'] == 'completed' else keys
+    if model is Prescription:
+        return ['prescriptions'] + (['prescriptions:pending'] if state['pharmacy_status'] == 'pending' else [])
+    return ['medicines']
+
+def _count_statistics(today):
+    """Exact counters in one round trip; very large PostgreSQL tables use pg_class estimates"""
+    totals = {'users': User, 'hospitals': Hospital, 'departments': Department, 'doctor_profiles': DoctorProfile,
+              'appointments': Appointment, 'prescriptions': Prescription, 'medicines': Medicine}
+    estimated = {}
+    if db.engine.dialect.name == 'postgresql':
+        names = {model.__tablename__: key for key, model in totals.items()}
+        for relname, reltuples in db.session.execute(
+            text("SELECT relname, reltuples FROM pg_class WHERE relkind = 'r' AND relname = ANY(:names)"),
+            {'names': list(names)}
+        ):
+            if reltuples >= STATS_EXACT_ROW_LIMIT:
+                estimated[names[relname]] = int(reltuples)
+    
+    def count(model, *criteria):
+        return db.select(func.count()).select_from(model).where(*criteria).scalar_subquery()
+    
+    queries = {key: count(model) for key, model in totals.items() if key not in estimated}
+    queries.update({
+        'users:doctor': count(User, User.role == 'doctor'),
+        'users:patient': count(User, User.role == 'patient'),
+        'departments:active': count(Department, Department.is_active == True),
+        f'appointments:{today}': count(Appointment, Appointment.appointment_date == today),
+        f'appointments:{today}:completed': count(
+            Appointment, Appointment.appointment_date == today, Appointment.status == 'completed'
+        ),
+        'prescriptions:pending': count(Prescription, Prescription.pharmacy_status == 'pending'),
+    })
+    row = db.session.execute(db.select(*queries.values())).one()
+    counts = dict(zip(queries, row))
+    counts.update(estimated)
+    return counts, set(estimated)
+
+class SystemStats:
+    """
+    Record counters for /api/stats and /api/database/status, served from memory.
+    Reconciled with one counting query at most every STATS_RECONCILE_SECONDS (or when
+    marked stale by a bulk write, or the day rolls over); in between, committed ORM
+    inserts, updates and deletes adjust the counters. Other workers' writes show up
+    at the next reconcile.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = None
+        self._estimated = set()
+        self._day = None
+        self._loaded_at = 0.0
+        self._stale = False
+
+    def mark_stale(self):
+        with self._lock:
+            self._stale = True
+
+    def reconcile(self):
+        today = date.today()
+        counts, estimated = _count_statistics(today)
+        with self._lock:
+            self._counts, self._estimated, self._day = counts, estimated, today
+            self._loaded_at = monotonic()
+            self._stale = False
+
+    def snapshot(self):
+        """(counts, estimated keys, today's date) - reconciling first when due"""
+        with self._lock:
+            due = (self._counts is None or self._stale or self._day != date.today()
+                   or monotonic() - self._loaded_at > STATS_RECONCILE_SECONDS)
+        if due:
+            self.reconcile()
+        with self._lock:
+            return dict(self._counts), set(self._estimated), self._day
+
+    def apply(self, deltas):
+        """Fold committed {key: delta} in; keys outside the tracked set (other days) are ignored"""
+        with self._lock:
+            if self._counts is None:
+                return
+            for key, delta in deltas.items():
+                if key in self._counts:
+                    self._counts[key] += delta
+
+system_stats = SystemStats()
+
+def _stage_stat_deltas(target, deltas):
+    session = object_session(target)
+    if session is not None:
+        staged = session.info.setdefault('stat_deltas', defaultdict(int))
+        for key, delta in deltas:
+            staged[key] += delta
+
+def _stat_state(target, attributes, previous=False):
+    state = {}
+    for attribute in attributes:
+        if previous:
+            history = sa_inspect(target).attrs[attribute].history
+            if history.deleted:
+                state[attribute] = history.deleted[0]
+                continue
+        state[attribute] = getattr(target, attribute)
+    return state
+
+def _count_insert(mapper, connection, target):
+    model = mapper.class_
+    _stage_stat_deltas(target, [(key, 1) for key in _stat_keys(model, _stat_state(target, STAT_TRACKED_ATTRIBUTES[model]))])
+
+def _count_delete(mapper, connection, target):
+    model = mapper.class_
+    _stage_stat_deltas(target, [(key, -1) for key in _stat_keys(model, _stat_state(target, STAT_TRACKED_ATTRIBUTES[model]))])
+
+def _count_update(mapper, connection, target):
+    model = mapper.class_
+    attributes = STAT_TRACKED_ATTRIBUTES[model]
+    if not any(sa_inspect(target).attrs[attribute].history.has_changes() for attribute in attributes):
+        return
+    before = _stat_keys(model, _stat_state(target, attributes, previous=True))
+    after = _stat_keys(model, _stat_state(target, attributes))
+    _stage_stat_deltas(target, [(key, -1) for key in before] + [(key, 1) for key in after])
+
+for _model in STAT_TRACKED_ATTRIBUTES:
+    event.listen(_model, 'after_insert', _count_insert)
+    event.listen(_model, 'after_update', _count_update)
+    event.listen(_model, 'after_delete', _count_delete)
+
+@event.listens_for(OrmSession, 'after_bulk_update')
+def _bulk_update_stats(update_context):
+    # Query.update() skips the mapper events; re-count if it set a counted attribute
+    model = update_context.mapper.class_
+    if model in STAT_TRACKED_ATTRIBUTES and not update_context.query.get_execution_options().get('stats_neutral'):
+        changed = {getattr(key, 'key', key) for key in update_context.values}
+        if changed & set(STAT_TRACKED_ATTRIBUTES[model]):
+            system_stats.mark_stale()
+
+@event.listens_for(OrmSession, 'after_bulk_delete')
+def _bulk_delete_stats(delete_context):
+    if delete_context.mapper.class_ in STAT_TRACKED_ATTRIBUTES:
+        system_stats.mark_stale()
+
+@event.listens_for(OrmSession, 'after_commit')
+def _publish_stat_deltas(session):
+    deltas = session.info.pop('stat_deltas', None)
+    if deltas:
+        system_stats.apply(deltas)
+
+@event.listens_for(OrmSession, 'after_rollback')
+def _discard_stat_deltas(session):
+    session.info.pop('stat_deltas', None)
+
+# =======================
+# ANALYTICS ROLLUPS
+# =======================
+
+# Intraday refresh interval for today's rollups (only doctor-days whose queue changed)
+ROLLUP_REFRESH_SECONDS = int(os.environ.get('ROLLUP_REFRESH_SECONDS', 900))
+ROLLUP_CHUNK_DAYS = 7
+ROLLUP_SCOPES = ('doctor', 'department')
+ANALYTICS_RANGE_DAYS_MAX = 366
+WEEKDAY_NAMES = ('Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday')
+
+def _percentile(values, fraction):
+    """Nearest-rank percentile of a non-empty list"""
+    ordered = sorted(values)
+    return ordered[max(math.ceil(fraction * len(ordered)) - 1, 0)]
+
+def _utc_to_local(timestamp):
+    # queue_logs are stamped with utcnow(); appointment times are local
+    return timestamp.replace(tzinfo=timezone.utc).astimezone().replace(tzinfo=None) if timestamp else None
+
+def _rollup_source(*criteria):
+    """Appointment facts matching criteria, with call/finish times (queue_logs fill in older rows)"""
+    appointments = db.session.query(
+        Appointment.id, Appointment.doctor_id, Appointment.department_id, Appointment.hospital_id,
+        Appointment.appointment_date, Appointment.appointment_time, Appointment.status,
+        Appointment.actual_start_time, Appointment.actual_end_time
+    ).filter(*criteria).all()
+    
+    logged = defaultdict(dict)
+    for appointment_id, status_change, timestamp in db.session.query(
+        QueueLog.appointment_id, QueueLog.status_change, func.min(QueueLog.timestamp)
+    ).join(Appointment, Appointment.id == QueueLog.appointment_id).filter(
+        *criteria,
+        db.or_(Appointment.actual_start_time.is_(None), Appointment.actual_end_time.is_(None)),
+        QueueLog.status_change.in_(['Patient called for consultation', 'Consultation completed'])
+    ).group_by(QueueLog.appointment_id, QueueLog.status_change):
+        logged[appointment_id][status_change] = _utc_to_local(timestamp)
+    
+    facts = []
+    for row in appointments:
+        logs = logged.get(row.id, {})
+        facts.append((row, row.actual_start_time or logs.get('Patient called for consultation'),
+                      row.actual_end_time or logs.get('Consultation completed')))
+    return facts
+
+def _rollup_metrics(facts):
+    waits, consults = [], []
+    statuses = defaultdict(int)
+    for row, started, ended in facts:
+        statuses[row.status] += 1
+        if started and row.appointment_time:
+            # Waits run from the slot or same-day check-in time (see queue_sort_key)
+            scheduled = datetime.combine(row.appointment_date, row.appointment_time)
+            waits.append(max((started - scheduled).total_seconds() / 60, 0.0))
+        if started and ended and ended >= started:
+            consults.append((ended - started).total_seconds() / 60)
+    return {
+        'appointments': len(facts),
+        'completed': statuses['completed'],
+        'cancelled': statuses['cancelled'],
+        'no_shows': statuses['expired'],
+        'wait_samples': len(waits),
+        'wait_total_minutes': sum(waits),
+        'wait_median_minutes': round(statistics.median(waits), 2) if waits else None,
+        'wait_p90_minutes': round(_percentile(waits, 0.9), 2) if waits else None,
+        'consult_samples': len(consults),
+        'consult_total_minutes': sum(consults),
+        'consult_median_minutes': round(statistics.median(consults), 2) if consults else None,
+        'consult_p90_minutes': round(_percentile(consults, 0.9), 2) if consults else None,
+    }
+
+def _build_rollups(facts, scopes, versions=None):
+    """Rollup rows for the given facts, grouped per day and per doctor and/or department"""
+    groups = defaultdict(list)
+    for fact in facts:
+        row = fact[0]
+        if 'doctor' in scopes:
+            groups[(row.appointment_date, 'doctor', str(row.doctor_id))].append(fact)
+        if 'department' in scopes and row.department_id:
+            groups[(row.appointment_date, 'department', str(row.department_id))].append(fact)
+    now = datetime.utcnow()
+    rows = []
+    for (rollup_date, scope, scope_id), group in groups.items():
+        first = group[0][0]
+        rows.append({
+            'rollup_date': rollup_date,
+            'scope': scope,
+            'scope_id': scope_id,
+            'hospital_id': first.hospital_id,
+            'department_id': first.department_id,
+            'source_version': (versions or {}).get((first.doctor_id, rollup_date)) if scope == 'doctor' else None,
+            'updated_at': now,
+            **_rollup_metrics(group)
+        })
+    return rows
+
+def _queue_versions(*criteria):
+    return {(doctor_id, queue_date): version for doctor_id, queue_date, version in db.session.query(
+        QueueVersion.doctor_id, QueueVersion.queue_date, QueueVersion.version
+    ).filter(*criteria)}
+
+def rollup_days(start_date, end_date, chunk_days=ROLLUP_CHUNK_DAYS, progress=None):
+    """Rebuild rollups for [start_date, end_date] in chunks of days, committing each chunk"""
+    written = 0
+    chunk_start = start_date
+    while chunk_start <= end_date:
+        chunk_end = min(chunk_start + timedelta(days=chunk_days - 1), end_date)
+        in_chunk = (Appointment.appointment_date >= chunk_start, Appointment.appointment_date <= chunk_end)
+        rows = _build_rollups(
+            _rollup_source(*in_chunk), ROLLUP_SCOPES,
+            _queue_versions(QueueVersion.queue_date >= chunk_start, QueueVersion.queue_date <= chunk_end)
+        )
+        DailyAppointmentRollup.query.filter(
+            DailyAppointmentRollup.rollup_date >= chunk_start,
+            DailyAppointmentRollup.rollup_date <= chunk_end
+        ).delete(synchronize_session=False)
+        if rows:
+            db.session.execute(db.insert(DailyAppointmentRollup.__table__), rows)
+        db.session.commit()
+        written += len(rows)
+        if progress:
+            progress(chunk_start, chunk_end, len(rows))
+        chunk_start = chunk_end + timedelta(days=1)
+    return written
+
+def refresh_day_rollups(day=None):
+    """
+    Incremental refresh for one day: rebuild only doctors whose queue version moved past
+    the version their rollup row was built from, plus those doctors' departments.
+    """
+    day = day or date.today()
+    versions = _queue_versions(QueueVersion.queue_date == day)
+    rolled = dict(db.session.query(DailyAppointmentRollup.scope_id, DailyAppointmentRollup.source_version).filter(
+        DailyAppointmentRollup.rollup_date == day, DailyAppointmentRollup.scope == 'doctor'
+    ).all())
+    stale = [doctor_id for (doctor_id, _), version in versions.items() if rolled.get(str(doctor_id)) != version]
+    if not stale:
+        return 0
+    
+    doctor_facts = _rollup_source(Appointment.appointment_date == day, Appointment.doctor_id.in_(stale))
+    departments = {fact[0].department_id for fact in doctor_facts if fact[0].department_id}
+    department_facts = _rollup_source(
+        Appointment.appointment_date == day, Appointment.department_id.in_(departments)
+    ) if departments else []
+    rows = _build_rollups(doctor_facts, ('doctor',), versions) + _build_rollups(department_facts, ('department',))
+    
+    DailyAppointmentRollup.query.filter(
+        DailyAppointmentRollup.rollup_date == day,
+        db.or_(
+            db.and_(DailyAppointmentRollup.scope == 'doctor',
+                    DailyAppointmentRollup.scope_id.in_([str(doctor_id) for doctor_id in stale])),
+            db.and_(DailyAppointmentRollup.scope == 'department',
+                    DailyAppointmentRollup.scope_id.in_([str(d) for d in departments]))
+        )
+    ).delete(synchronize_session=False)
+    if rows:
+        db.session.execute(db.insert(DailyAppointmentRollup.__table__), rows)
+    db.session.commit()
+    return len(rows)
+
+def _rollup_refresh_loop():
+    import time as _time
+    while True:
+        _time.sleep(ROLLUP_REFRESH_SECONDS)
+        with app.app_context():
+            try:
+                refresh_day_rollups()
+            except Exception as e:
+                db.session.rollback()
+                app.logger.error(f'Rollup refresh failed: {e}')
+
+def schedule_rollup_refresh():
+    """Background thread keeping today's rollups current; the nightly job finalises yesterday"""
+    threading.Thread(target=_rollup_refresh_loop, daemon=True).start()
+
+@app.cli.command('rollup-backfill')
+@click.option('--start', 'start_date', help='First day (YYYY-MM-DD); defaults to the earliest appointment')
+@click.option('--end', 'end_date', help='Last day (YYYY-MM-DD); defaults to today')
+@click.option('--chunk-days', default=ROLLUP_CHUNK_DAYS, show_default=True, help='Days rebuilt per transaction')
+def rollup_backfill_command(start_date, end_date, chunk_days):
+    """Rebuild daily appointment rollups for a date range, one chunk per transaction."""
+    first = db.session.query(func.min(Appointment.appointment_date)).scalar()
+    start = datetime.strptime(start_date, '%Y-%m-%d').date() if start_date else first
+    end = datetime.strptime(end_date, '%Y-%m-%d').date() if end_date else date.today()
+    if start is None:
+        click.echo('No appointments to roll up')
+        return
+    written = rollup_days(start, end, chunk_days, progress=lambda s, e, n: click.echo(f'{s} .. {e}: {n} rows'))
+    click.echo(f'Wrote {written} rollup rows')
+
+def _analytics_range():
+    """(start, end) from ?start=&end= (default: the last 30 days), capped at ANALYTICS_RANGE_DAYS_MAX"""
+    end = datetime.strptime(request.args['end'], '%Y-%m-%d').date() if request.args.get('end') else date.today()
+    start = datetime.strptime(request.args['start'], '%Y-%m-%d').date() if request.args.get('start') \
+        else end - timedelta(days=29)
+    if start > end or (end - start).days >= ANALYTICS_RANGE_DAYS_MAX:
+        raise ValueError(f'start must be on or before end, at most {ANALYTICS_RANGE_DAYS_MAX} days apart')
+    return start, end
+
+def _rollup_filter(scope, start, end):
+    query = DailyAppointmentRollup.query.filter(
+        DailyAppointmentRollup.scope == scope,
+        DailyAppointmentRollup.rollup_date >= start,
+        DailyAppointmentRollup.rollup_date <= end
+    )
+    if request.args.get('id'):
+        query = query.filter(DailyAppointmentRollup.scope_id == request.args['id'])
+    return query
+
+def _average(total, samples):
+    return round(total / samples, 1) if samples else None
+
+@app.route('/api/analytics/throughput', methods=['GET'])
+@role_required(['admin'])
+def get_throughput_analytics():
+    """
+    Daily volume, no-shows, wait and consultation times per doctor or department
+    (?scope=doctor|department&id=&start=&end=), read from the rollup table only.
+    """
+    try:
+        scope = request.args.get('scope', 'doctor')
+        if scope not in ROLLUP_SCOPES:
+            return jsonify({'error': 'scope must be doctor or department'}), 400
+        try:
+            start, end = _analytics_range()
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        rollups = _rollup_filter(scope, start, end).order_by(
+            DailyAppointmentRollup.scope_id, DailyAppointmentRollup.rollup_date
+        ).all()
+        summaries = {}
+        for rollup in rollups:
+            summary = summaries.setdefault(rollup.scope_id, defaultdict(float))
+            for column in ('appointments', 'completed', 'cancelled', 'no_shows', 'wait_samples',
+                           'wait_total_minutes', 'consult_samples', 'consult_total_minutes'):
+                summary[column] += getattr(rollup, column)
+        
+        return jsonify({
+            'scope': scope,
+            'start': start.isoformat(),
+            'end': end.isoformat(),
+            'summary': [{
+                'id': scope_id,
+                'appointments': int(summary['appointments']),
+                'completed': int(summary['completed']),
+                'cancelled': int(summary['cancelled']),
+                'no_shows': int(summary['no_shows']),
+                'avg_wait_minutes': _average(summary['wait_total_minutes'], summary['wait_samples']),
+                'avg_consult_minutes': _average(summary['consult_total_minutes'], summary['consult_samples'])
+            } for scope_id, summary in summaries.items()],
+            'daily': [{
+                'id': rollup.scope_id,
+                'date': rollup.rollup_date.isoformat(),
+                'appointments': rollup.appointments,
+                'completed': rollup.completed,
+                'cancelled': rollup.cancelled,
+                'no_shows': rollup.no_shows,
+                'wait_median_minutes': rollup.wait_median_minutes,
+                'wait_p90_minutes': rollup.wait_p90_minutes,
+                'consult_median_minutes': rollup.consult_median_minutes,
+                'consult_p90_minutes': rollup.consult_p90_minutes
+            } for rollup in rollups]
+        }), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/analytics/wait-by-weekday', methods=['GET'])
+@role_required(['admin'])
+def get_wait_by_weekday():
+    """Average wait per department (or doctor) per weekday over ?start=&end=, from rollups"""
+    try:
+        scope = request.args.get('scope', 'department')
+        if scope not in ROLLUP_SCOPES:
+            return jsonify({'error': 'scope must be doctor or department'}), 400
+        try:
+            start, end = _analytics_range()
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        totals = defaultdict(lambda: [0.0, 0, []])  # (id, weekday) -> [minutes, samples, daily medians]
+        for scope_id, rollup_date, minutes, samples, median in _rollup_filter(scope, start, end).with_entities(
+            DailyAppointmentRollup.scope_id, DailyAppointmentRollup.rollup_date,
+            DailyAppointmentRollup.wait_total_minutes, DailyAppointmentRollup.wait_samples,
+            DailyAppointmentRollup.wait_median_minutes
+        ):
+            entry = totals[(scope_id, rollup_date.weekday())]
+            entry[0] += minutes
+            entry[1] += samples
+            if median is not None:
+                entry[2].append(median)
+        
+        return jsonify({
+            'scope': scope,
+            'start': start.isoformat(),
+            'end': end.isoformat(),
+            'rows': [{
+                'id': scope_id,
+                'weekday': WEEKDAY_NAMES[weekday],
+                'avg_wait_minutes': _average(minutes, samples),
+                'median_of_daily_median_minutes': statistics.median(medians) if medians else None,
+                'samples': samples
+            } for (scope_id, weekday), (minutes, samples, medians) in sorted(totals.items())]
+        }), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+# =======================
+# CAPACITY SIMULATION
+# =======================
+
+SIMULATION_RUNS_DEFAULT = 2000
+SIMULATION_RUNS_MAX = 20000
+SIMULATION_HISTORY_DAYS = 90
+# Below this many samples a doctor's history is pooled with the other simulated doctors
+SIMULATION_MIN_SAMPLES = 30
+# Used when there is no usable history at all
+SIMULATION_DEFAULT_CONSULT_MINUTES = 12.0
+
+def _minutes(value):
+    return value.hour * 60 + value.minute
+
+def parse_schedule_candidate(candidate):
+    """{'available_from': 'HH:MM', 'available_to': 'HH:MM', 'max_patients_per_day': n} -> (open, close, cap) in minutes"""
+    opens = _minutes(datetime.strptime(candidate['available_from'], '%H:%M').time())
+    closes = _minutes(datetime.strptime(candidate['available_to'], '%H:%M').time())
+    cap = int(candidate['max_patients_per_day'])
+    if closes <= opens or cap <= 0:
+        raise ValueError('available_to must be after available_from and max_patients_per_day positive')
+    return opens, closes, cap
+
+def _doctor_history(profiles, history_days):
+    """
+    Per doctor: daily booking counts, no-show rate, arrival positions within the session
+    (0..1) and consultation minutes, from appointments and queue_logs.
+    """
+    today = date.today()
+    facts = _rollup_source(
+        Appointment.doctor_id.in_([profile.user_id for profile in profiles]),
+        Appointment.appointment_date >= today - timedelta(days=history_days),
+        Appointment.appointment_date < today
+    )
+    sessions = {
+        profile.user_id: (_minutes(profile.available_from or time(9, 0)), _minutes(profile.available_to or time(17, 0)))
+        for profile in profiles
+    }
+    history = {profile.user_id: {'days': defaultdict(int), 'booked': 0, 'no_shows': 0, 'arrivals': [], 'durations': []}
+               for profile in profiles}
+    for row, started, ended in facts:
+        entry = history[row.doctor_id]
+        if row.status == 'cancelled':
+            continue
+        entry['days'][row.appointment_date] += 1
+        entry['booked'] += 1
+        if row.status == 'expired':
+            entry['no_shows'] += 1
+            continue
+        opens, closes = sessions[row.doctor_id]
+        if row.appointment_time:
+            entry['arrivals'].append(min(max((_minutes(row.appointment_time) - opens) / (closes - opens), 0.0), 1.0))
+        if started and ended and ended >= started:
+            entry['durations'].append((ended - started).total_seconds() / 60)
+    return history
+
+def simulate_clinic_days(rng, daily_demand, no_show_rate, arrival_positions, durations, schedule, runs):
+    """
+    Monte-Carlo clinic days for one doctor and one schedule: bootstrap the day's bookings,
+    cap them at the schedule's limit (the rest overflow), drop no-shows, place arrivals in
+    the session and serve first-come-first-served. Each step is vectorised across runs;
+    only the queue recursion loops, once per patient slot.
+    """
+    opens, closes, cap = schedule
+    session = closes - opens
+    booked = rng.choice(daily_demand, size=runs)
+    admitted = np.minimum(booked, cap)
+    overflow = booked - admitted
+    shows = rng.binomial(admitted, 1.0 - no_show_rate)
+    width = int(shows.max()) if runs else 0
+    
+    mask = np.arange(width)[None, :] < shows[:, None]
+    arrivals = np.sort(
+        np.where(mask, rng.choice(arrival_positions, size=(runs, width)) * session, np.inf), axis=1
+    )
+    # Empty slots sorted to the end; zero them so the recursion stays finite
+    arrivals = np.where(mask, arrivals, 0.0)
+    service = np.where(mask, rng.choice(durations, size=(runs, width)), 0.0)
+    
+    free_at = np.zeros(runs)
+    waits = np.zeros((runs, width))
+    for slot in range(width):
+        active = mask[:, slot]
+        start = np.maximum(arrivals[:, slot], free_at)
+        waits[:, slot] = np.where(active, start - arrivals[:, slot], 0.0)
+        free_at = np.where(active, start + service[:, slot], free_at)
+    overtime = np.maximum(free_at - session, 0.0)
+    patient_waits = waits[mask]
+    
+    return {
+        'expected_wait_minutes': round(float(patient_waits.mean()), 1) if patient_waits.size else 0.0,
+        'p90_wait_minutes': round(float(np.percentile(patient_waits, 90)), 1) if patient_waits.size else 0.0,
+        'expected_patients_seen': round(float(shows.mean()), 1),
+        'expected_overflow': round(float(overflow.mean()), 2),
+        'overflow_probability': round(float((overflow > 0).mean()), 3),
+        'expected_overtime_minutes': round(float(overtime.mean()), 1),
+        'p90_overtime_minutes': round(float(np.percentile(overtime, 90)), 1),
+        'utilization': round(float(service.sum() / (runs * session)), 3),
+    }
+
+def run_capacity_simulation(profiles, candidates=None, runs=SIMULATION_RUNS_DEFAULT,
+                            history_days=SIMULATION_HISTORY_DAYS, seed=None):
+    """Simulate each doctor's current schedule plus the candidate schedules"""
+    rng = np.random.default_rng(seed)
+    history = _doctor_history(profiles, history_days)
+    pooled = {
+        'days': [count for entry in history.values() for count in entry['days'].values()],
+        'arrivals': [value for entry in history.values() for value in entry['arrivals']],
+        'durations': [value for entry in history.values() for value in entry['durations']],
+    }
+    parsed = [(candidate, parse_schedule_candidate(candidate)) for candidate in candidates or []]
+    
+    results = []
+    for profile in profiles:
+        entry = history[profile.user_id]
+        current = {
+            'available_from': (profile.available_from or time(9, 0)).strftime('%H:%M'),
+            'available_to': (profile.available_to or time(17, 0)).strftime('%H:%M'),
+            'max_patients_per_day': profile.max_patients_per_day or 50,
+        }
+        sources = {}
+        samples = {}
+        for key, own in (('days', list(entry['days'].values())), ('arrivals', entry['arrivals']),
+                         ('durations', entry['durations'])):
+            minimum = 1 if key == 'days' else SIMULATION_MIN_SAMPLES
+            if len(own) >= minimum:
+                samples[key], sources[key] = own, 'doctor'
+            elif len(pooled[key]) >= minimum:
+                samples[key], sources[key] = pooled[key], 'pooled'
+            else:
+                samples[key], sources[key] = None, 'default'
+        cap = current['max_patients_per_day']
+        daily_demand = np.asarray(samples['days'] or rng.poisson(cap * 0.8, size=256))
+        arrival_positions = np.asarray(samples['arrivals'] or np.linspace(0.0, 1.0, 64, endpoint=False))
+        durations = np.asarray(
+            samples['durations'] or rng.lognormal(math.log(SIMULATION_DEFAULT_CONSULT_MINUTES), 0.5, size=512)
+        )
+        no_show_rate = entry['no_shows'] / entry['booked'] if entry['booked'] else 0.0
+        
+        schedules = [('current', current, parse_schedule_candidate(current))]
+        schedules += [(f'candidate_{i + 1}', candidate, schedule) for i, (candidate, schedule) in enumerate(parsed)]
+        results.append({
+            'doctor_id': profile.id,
+            'doctor_user_id': profile.user_id,
+            'history': {
+                'days': len(entry['days']),
+                'bookings': entry['booked'],
+                'no_show_rate': round(no_show_rate, 3),
+                'consultations': len(entry['durations']),
+                'sources': sources
+            },
+            'schedules': [{
+                'name': name,
+                **candidate,
+                **simulate_clinic_days(rng, daily_demand, no_show_rate, arrival_positions, durations, schedule, runs)
+            } for name, candidate, schedule in schedules]
+        })
+    return results
+
+def _simulation_profiles(hospital_id=None, doctor_ids=None):
+    query = DoctorProfile.query.filter(DoctorProfile.active == True)
+    if hospital_id:
+        query = query.filter(DoctorProfile.hospital_id == hospital_id)
+    if doctor_ids:
+        query = query.filter(DoctorProfile.id.in_(doctor_ids))
+    return query.order_by(DoctorProfile.id).all()
+
+@app.route('/api/admin/capacity-simulation', methods=['POST'])
+@role_required(['admin'])
+def capacity_simulation():
+    """
+    Monte-Carlo capacity planning. Body: hospital_id and/or doctor_ids, optional
+    candidates [{available_from, available_to, max_patients_per_day}], runs, history_days,
+    seed. Each doctor's current schedule is always simulated for comparison.
+    """
+    if not NUMPY_AVAILABLE:
+        return jsonify({'error': 'Capacity simulation requires numpy'}), 503
+    try:
+        data = request.get_json() or {}
+        if not data.get('hospital_id') and not data.get('doctor_ids'):
+            return jsonify({'error': 'hospital_id or doctor_ids is required'}), 400
+        try:
+            runs = min(max(int(data.get('runs', SIMULATION_RUNS_DEFAULT)), 1), SIMULATION_RUNS_MAX)
+            history_days = min(max(int(data.get('history_days', SIMULATION_HISTORY_DAYS)), 1), ANALYTICS_RANGE_DAYS_MAX)
+            candidates = data.get('candidates') or []
+            for candidate in candidates:
+                parse_schedule_candidate(candidate)
+        except (KeyError, TypeError, ValueError) as e:
+            return jsonify({'error': f'Invalid simulation parameters: {e}'}), 400
+        
+        profiles = _simulation_profiles(data.get('hospital_id'), data.get('doctor_ids'))
+        started = perf_counter()
+        results = run_capacity_simulation(profiles, candidates, runs, history_days, data.get('seed'))
+        return jsonify({
+            'runs': runs,
+            'history_days': history_days,
+            'elapsed_seconds': round(perf_counter() - started, 3),
+            'doctors': results
+        }), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+def _parse_candidate_option(value):
+    """'09:00-13:00/30' -> candidate dict"""
+    hours, _, cap = value.partition('/')
+    available_from, _, available_to = hours.partition('-')
+    return {'available_from': available_from, 'available_to': available_to, 'max_patients_per_day': int(cap)}
+
+@app.cli.command('capacity-simulate')
+@click.option('--hospital-id', help='Simulate every active doctor in this hospital')
+@click.option('--doctor-id', 'doctor_ids', multiple=True, help='Doctor profile id (repeatable)')
+@click.option('--candidate', 'candidates', multiple=True, help='Schedule as HH:MM-HH:MM/max_patients (repeatable)')
+@click.option('--runs', default=SIMULATION_RUNS_DEFAULT, show_default=True)
+@click.option('--history-days', default=SIMULATION_HISTORY_DAYS, show_default=True)
+@click.option('--seed', type=int)
+def capacity_simulate_command(hospital_id, doctor_ids, candidates, runs, history_days, seed):
+    """Monte-Carlo waits, overflow and overtime for current and candidate schedules."""
+    if not NUMPY_AVAILABLE:
+        raise click.ClickException('Capacity simulation requires numpy')
+    try:
+        parsed = [_parse_candidate_option(value) for value in candidates]
+        for candidate in parsed:
+            parse_schedule_candidate(candidate)
+    except ValueError as e:
+        raise click.BadParameter(f'candidate: {e}')
+    profiles = _simulation_profiles(hospital_id, list(doctor_ids))
+    started = perf_counter()
+    results = run_capacity_simulation(profiles, parsed, min(runs, SIMULATION_RUNS_MAX), history_days, seed)
+    
+    click.echo(f'{"doctor":<38}{"schedule":<22}{"wait":>7}{"p90":>7}{"overflow":>10}{"P(ovf)":>8}{"overtime":>10}{"util":>7}')
+    for doctor in results:
+        for result in doctor['schedules']:
+            schedule = f"{result['available_from']}-{result['available_to']}/{result['max_patients_per_day']}"
+            click.echo(
+                f"{doctor['doctor_id']:<38}{schedule:<22}{result['expected_wait_minutes']:>7}"
+                f"{result['p90_wait_minutes']:>7}{result['expected_overflow']:>10}"
+                f"{result['overflow_probability']:>8}{result['expected_overtime_minutes']:>10}{result['utilization']:>7}"
+            )
+    click.echo(f'{len(results)} doctors, {runs} runs each, {perf_counter() - started:.2f}s')
+
+# =======================
+# PROFILING
+# =======================
+
+# Bounds that keep on-demand profiling safe on a live worker
+PROFILE_MAX_SECONDS = 60
+PROFILE_MIN_INTERVAL_MS = 5
+PROFILE_MAX_DEPTH = 64
+PROFILE_MAX_STACKS = 20_000
+TRACEMALLOC_MAX_FRAMES = 25
+TRACEMALLOC_MAX_SECONDS = int(os.getenv('TRACEMALLOC_MAX_SECONDS', 900))
+
+class SamplingProfiler:
+    """
+    Wall-clock sampling profiler over live requests. While a profile runs, the admin request
+    itself samples sys._current_frames() every interval and counts each request thread's
+    stack, rooted at its route. Between profiles the only cost is registering request threads;
+    one profile runs at a time, for at most PROFILE_MAX_SECONDS.
+    """
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.request_threads = {}
+    
+    def enter_request(self, route):
+        self.request_threads[threading.get_ident()] = route
+    
+    def exit_request(self):
+        self.request_threads.pop(threading.get_ident(), None)
+    
+    @staticmethod
+    def _stack(frame, root):
+        labels = []
+        while frame is not None and len(labels) < PROFILE_MAX_DEPTH:
+            code = frame.f_code
+            labels.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+            frame = frame.f_back
+        labels.append(root)
+        return ';'.join(label.replace(';', ',') for label in reversed(labels))
+    
+    def profile(self, seconds, interval, all_threads=False):
+        """Collapsed stacks -> sample count, or None when another profile is running"""
+        if not self.lock.acquire(blocking=False):
+            return None
+        try:
+            own = threading.get_ident()
+            stacks = defaultdict(int)
+            samples = 0
+            sampling = 0.0
+            pause = threading.Event()
+            started = perf_counter()
+            deadline = started + seconds
+            while perf_counter() < deadline:
+                tick = perf_counter()
+                names = {thread.ident: thread.name for thread in threading.enumerate()} if all_threads else {}
+                for ident, frame in sys._current_frames().items():
+                    if ident == own:
+                        continue
+                    root = self.request_threads.get(ident)
+                    if root is None:
+                        if not all_threads:
+                            continue
+                        root = f'[thread {names.get(ident, ident)}]'
+                    key = self._stack(frame, root)
+                    if key in stacks or len(stacks) < PROFILE_MAX_STACKS:
+                        stacks[key] += 1
+                    else:
+                        stacks['[other stacks]'] += 1
+                samples += 1
+                sampling += perf_counter() - tick
+                pause.wait(max(interval - (perf_counter() - tick), 0))
+            return {
+                'stacks': dict(stacks),
+                'samples': samples,
+                'duration_seconds': round(perf_counter() - started, 3),
+                'sampling_seconds': round(sampling, 4)
+            }
+        finally:
+            self.lock.release()
+
+request_profiler = SamplingProfiler()
+
+@app.before_request
+def register_profiled_request():
+    request_profiler.enter_request(
+        f'{request.method} {request.url_rule.rule if request.url_rule else request.path}'
+    )
+
+@app.teardown_request
+def unregister_profiled_request(exc):
+    request_profiler.exit_request()
+
+def speedscope_profile(stacks, interval_ms, name):
+    """Aggregated stacks as a speedscope 'sampled' profile (https://www.speedscope.app)"""
+    frames, index = [], {}
+    samples, weights = [], []
+    for stack, count in sorted(stacks.items(), key=lambda item: -item[1]):
+        sample = []
+        for label in stack.split(';'):
+            if label not in index:
+                index[label] = len(frames)
+                frames.append({'name': label})
+            sample.append(index[label])
+        samples.append(sample)
+        weights.append(round(count * interval_ms, 3))
+    return {
+        '$schema': 'https://www.speedscope.app/file-format-schema.json',
+        'name': name,
+        'exporter': 'queuefree-profiler',
+        'shared': {'frames': frames},
+        'profiles': [{
+            'type': 'sampled', 'name': name, 'unit': 'milliseconds',
+            'startValue': 0, 'endValue': round(sum(weights), 3),
+            'samples': samples, 'weights': weights
+        }]
+    }
+
+class MemorySnapshots:
+    """
+    tracemalloc on demand: start() begins tracing with an automatic stop after max_seconds
+    (tracing slows allocation noticeably), snapshot() diffs against the previous snapshot.
+    Only the latest snapshot is kept.
+    """
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.previous = None
+        self.started_at = None
+        self.timer = None
+    
+    def start(self, frames, max_seconds):
+        with self.lock:
+            if tracemalloc.is_tracing():
+                return False
+            tracemalloc.start(frames)
+            self.previous = None
+            self.started_at = datetime.utcnow()
+            self.timer = threading.Timer(max_seconds, self.stop)
+            self.timer.daemon = True
+            self.timer.start()
+            return True
+    
+    def stop(self):
+        with self.lock:
+            if self.timer:
+                self.timer.cancel()
+                self.timer = None
+            self.previous = None
+            self.started_at = None
+            was_tracing = tracemalloc.is_tracing()
+            tracemalloc.stop()
+            return was_tracing
+    
+    @staticmethod
+    def _entry(stat, diff):
+        entry = {
+            'size_kb': round(stat.size / 1024, 1),
+            'count': stat.count,
+            'traceback': [f'{frame.filename}:{frame.lineno}' for frame in stat.traceback]
+        }
+        if diff:
+            entry['size_diff_kb'] = round(stat.size_diff / 1024, 1)
+            entry['count_diff'] = stat.count_diff
+        return entry
+    
+    def snapshot(self, group_by, limit):
+        with self.lock:
+            if not tracemalloc.is_tracing():
+                return None
+            snapshot = tracemalloc.take_snapshot().filter_traces((
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+                tracemalloc.Filter(False, '<unknown>'),
+            ))
+            if self.previous is not None:
+                stats = snapshot.compare_to(self.previous, group_by)[:limit]
+            else:
+                stats = snapshot.statistics(group_by)[:limit]
+            diff = self.previous is not None
+            self.previous = snapshot
+            current, peak = tracemalloc.get_traced_memory()
+            return {
+                'compared_to_previous': diff,
+                'tracing_since': self.started_at.isoformat(),
+                'traced_current_kb': round(current / 1024, 1),
+                'traced_peak_kb': round(peak / 1024, 1),
+                'top': [self._entry(stat, diff) for stat in stats]
+            }
+
+memory_snapshots = MemorySnapshots()
+
+def in_memory_structure_sizes():
+    """Sizes of the module-level dicts/lists that grow with traffic"""
+    return {
+        'rate_limit_tracker': {'keys': len(rate_limit_tracker),
+                               'entries': sum(len(attempts) for attempts in list(rate_limit_tracker.values()))},
+        'failed_login_attempts': {'keys': len(failed_login_attempts)},
+        'prescription_queue': {'entries': len(prescription_queue)},
+        'profiled_request_threads': {'keys': len(request_profiler.request_threads)},
+    }
+
+@app.route('/api/admin/pool-stats', methods=['GET'])
+@role_required(['admin'])
+def get_pool_stats():
+    """Get connection pool checkout latency, in-use, overflow and timeout counters per route"""
+    try:
+        return jsonify({
+            'pool': pool_metrics.snapshot(db.engine.pool),
+            'timestamp': datetime.utcnow().isoformat()
+        }), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/admin/profile', methods=['POST'])
+@role_required(['admin'])
+def profile_requests():
+    """
+    Sample live requests on this worker for ?seconds= (default 10, max 60) every
+    ?interval_ms= (default 10, min 5). ?format=json (summary + top stacks), collapsed
+    (flamegraph.pl / speedscope text) or speedscope (flamegraph file). ?all_threads=1
+    also samples background threads.
+    """
+    try:
+        seconds = min(max(request.args.get('seconds', 10, type=float), 0.1), PROFILE_MAX_SECONDS)
+        interval_ms = max(request.args.get('interval_ms', 10, type=float), PROFILE_MIN_INTERVAL_MS)
+        output = request.args.get('format', 'json')
+        if output not in ('json', 'collapsed', 'speedscope'):
+            return jsonify({'error': 'format must be one of: json, collapsed, speedscope'}), 400
+        all_threads = request.args.get('all_threads', '').lower() in ('1', 'true', 'yes')
+        
+        result = request_profiler.profile(seconds, interval_ms / 1000, all_threads)
+        if result is None:
+            return jsonify({'error': 'A profile is already running on this worker'}), 409
+        stacks = result.pop('stacks')
+        stamp = datetime.utcnow().strftime('%Y%m%dT%H%M%S')
+        
+        if output == 'collapsed':
+            body = ''.join(f'{stack} {count}\n' for stack, count in sorted(stacks.items(), key=lambda item: -item[1]))
+            return Response(body, mimetype='text/plain', headers={
+                'Content-Disposition': f'attachment; filename=profile-{os.getpid()}-{stamp}.collapsed'
+            })
+        if output == 'speedscope':
+            response = jsonify(speedscope_profile(stacks, interval_ms, f'worker {os.getpid()} {stamp}'))
+            response.headers['Content-Disposition'] = f'attachment; filename=profile-{os.getpid()}-{stamp}.speedscope.json'
+            return response
+        
+        self_samples = defaultdict(int)
+        routes = defaultdict(int)
+        for stack, count in stacks.items():
+            labels = stack.split(';')
+            self_samples[labels[-1]] += count
+            routes[labels[0]] += count
+        total = sum(stacks.values()) or 1
+        return jsonify({
+            **result,
+            'pid': os.getpid(),
+            'interval_ms': interval_ms,
+            'stack_samples': sum(stacks.values()),
+            'sampler_overhead_pct': round(100 * result['sampling_seconds'] / max(result['duration_seconds'], 1e-9), 2),
+            'routes': dict(sorted(routes.items(), key=lambda item: -item[1])),
+            'top_self': [{'frame': frame, 'samples': count, 'pct': round(100 * count / total, 1)}
+                         for frame, count in sorted(self_samples.items(), key=lambda item: -item[1])[:25]],
+            'top_stacks': [{'stack': stack, 'samples': count}
+                           for stack, count in sorted(stacks.items(), key=lambda item: -item[1])[:50]]
+        }), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/admin/memory', methods=['GET', 'POST', 'DELETE'])
+@role_required(['admin'])
+def memory_snapshot():
+    """
+    POST starts tracemalloc on this worker (?frames=, default 10; stops itself after
+    TRACEMALLOC_MAX_SECONDS). GET takes a snapshot and returns the top allocation sites
+    (?group_by=lineno|filename|traceback, ?limit=) diffed against the previous GET, plus the
+    sizes of in-memory trackers. DELETE stops tracing.
+    """
+    try:
+        if request.method == 'POST':
+            frames = min(max(request.args.get('frames', 10, type=int), 1), TRACEMALLOC_MAX_FRAMES)
+            if not memory_snapshots.start(frames, TRACEMALLOC_MAX_SECONDS):
+                return jsonify({'error': 'tracemalloc is already tracing on this worker'}), 409
+            return jsonify({'message': f'Tracing allocations with {frames} frames',
+                            'auto_stop_seconds': TRACEMALLOC_MAX_SECONDS, 'pid': os.getpid()}), 201
+        if request.method == 'DELETE':
+            return jsonify({'stopped': memory_snapshots.stop(), 'pid': os.getpid()}), 200
+        
+        group_by = request.args.get('group_by', 'lineno')
+        if group_by not in ('lineno', 'filename', 'traceback'):
+            return jsonify({'error': 'group_by must be one of: lineno, filename, traceback'}), 400
+        limit = min(max(request.args.get('limit', 25, type=int), 1), 100)
+        result = {'pid': os.getpid(), 'structures': in_memory_structure_sizes()}
+        if PSUTIL_AVAILABLE:
+            result['rss_mb'] = round(psutil.Process().memory_info().rss / 1024 ** 2, 1)
+        snapshot = memory_snapshots.snapshot(group_by, limit)
+        result['tracemalloc'] = snapshot if snapshot is not None else {'tracing': False, 'hint': 'POST to start tracing'}
+        return jsonify(result), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+# =======================
+# REGISTER BLUEPRINTS
+# =======================
+# DISABLED: Service layer refactor deferred to Phase-5
+# from appointments.routes import appointments_bp
+# app.register_blueprint(appointments_bp, url_prefix='/api/appointments')
+
+# =======================
+# DEBUG: Print all registered routes
+# =======================
+print("\n" + "=" * 60)
+print("REGISTERED ROUTES:")
+print("=" * 60)
+for rule in app.url_map.iter_rules():
+    if '/api/' in str(rule):
+        print(f"  {rule.rule} -> {rule.endpoint} [{', '.join(rule.methods - {'HEAD', 'OPTIONS'})}]")
+print("=" * 60 + "\n")
+
+# =======================
+# UTILITY ROUTES
+# =======================
+
+@app.route('/api/database/reset', methods=['POST'])
+@jwt_required()
+def reset_database_endpoint():
+    """Reset database to completely clean state - admin only"""
+    try:
+        current_user_id = get_jwt_identity()
+        user = User.query.get(current_user_id)
+        
+        # Only allow admins or for development
+        if not user or user.role not in ['admin', 'doctor']:  # Allow doctors for demo purposes
+            return jsonify({'error': 'Unauthorized - admin access required'}), 403
+        
+        # Perform complete reset
+        success = reset_database_completely()
+        
+        if success:
+            return jsonify({
+                'message': 'Database reset successfully', 
+                'status': 'success',
                 'details': 'All data cleared, IDs reset to start from 1'
             }), 200
         else:
@@ -2527,25 +6479,26 @@ def reset_database_endpoint():
 def get_database_status():
     """Get current database status and record counts"""
     try:
+        counts, estimated, _ = system_stats.snapshot()
         status = {
-            'users': User.query.count(),
-            'hospitals': Hospital.query.count(), 
-            'departments': Department.query.count(),
-            'doctors': User.query.filter_by(role='doctor').count(),
-            'patients': User.query.filter_by(role='patient').count(),
-            'appointments': Appointment.query.count(),
-            'prescriptions': Prescription.query.count(),
-            'medicines': Medicine.query.count(),
-            'total_records': (
-                User.query.count() + Hospital.query.count() + Department.query.count() +
-                DoctorProfile.query.count() + Appointment.query.count() + 
-                Prescription.query.count() + Medicine.query.count()
-            ),
+            'users': counts['users'],
+            'hospitals': counts['hospitals'],
+            'departments': counts['departments'],
+            'doctors': counts['users:doctor'],
+            'patients': counts['users:patient'],
+            'appointments': counts['appointments'],
+            'prescriptions': counts['prescriptions'],
+            'medicines': counts['medicines'],
+            'total_records': sum(counts[key] for key in (
+                'users', 'hospitals', 'departments', 'doctor_profiles', 'appointments', 'prescriptions', 'medicines'
+            )),
             'is_clean': (
-                User.query.count() == 0 and Hospital.query.count() == 0 and 
-                Department.query.count() == 0 and Appointment.query.count() == 0
+                counts['users'] == 0 and counts['hospitals'] == 0 and
+                counts['departments'] == 0 and counts['appointments'] == 0
             )
         }
+        if estimated:
+            status['estimated'] = sorted(estimated)
         
         return jsonify({
             'status': 'success',
@@ -2560,17 +6513,14 @@ def get_database_status():
 @jwt_required()
 def get_system_stats():
     try:
-        today = date.today()
+        counts, _, today = system_stats.snapshot()
         
         stats = {
-            'total_users': User.query.count(),
-            'total_appointments_today': Appointment.query.filter_by(appointment_date=today).count(),
-            'completed_appointments_today': Appointment.query.filter_by(
-                appointment_date=today, 
-                status='completed'
-            ).count(),
-            'pending_prescriptions': Prescription.query.filter_by(pharmacy_status='pending').count(),
-            'active_departments': Department.query.filter_by(is_active=True).count()
+            'total_users': counts['users'],
+            'total_appointments_today': counts[f'appointments:{today}'],
+            'completed_appointments_today': counts[f'appointments:{today}:completed'],
+            'pending_prescriptions': counts['prescriptions:pending'],
+            'active_departments': counts['departments:active']
         }
         
         return jsonify(stats), 200
@@ -2588,10 +6538,12 @@ def get_security_audit():
     """Get security audit information for administrators"""
     try:
         # Recent security events
-        recent_audit_logs = AuditLog.query.filter(
-            AuditLog.action_type == 'SECURITY_EVENT',
-            AuditLog.timestamp >= datetime.utcnow() - timedelta(hours=24)
-        ).order_by(AuditLog.timestamp.desc()).limit(50).all()
+        recent_audit_logs = AUDIT_LOG_LIST_ROWS.fetch(
+            audit_log_list_select().where(
+                AuditLog.action_type == 'SECURITY_EVENT',
+                AuditLog.timestamp >= datetime.utcnow() - timedelta(hours=24)
+            ).order_by(AuditLog.timestamp.desc()).limit(50)
+        )
         
         # Failed login statistics
         failed_login_stats = {
@@ -2609,7 +6561,7 @@ def get_security_audit():
         }
         
         return jsonify({
-            'security_events': [log.to_dict() for log in recent_audit_logs],
+            'security_events': recent_audit_logs,
             'failed_login_stats': failed_login_stats,
             'rate_limit_stats': rate_limit_stats,
             'audit_timestamp': datetime.utcnow().isoformat()
@@ -2626,7 +6578,7 @@ def migrate_database():
         # Create all tables and constraints
         db.create_all()
         
-        migration_results = []
+        migration_results = apply_schema_upgrades()
         
         # Create additional indexes manually if they don't exist
         try:
@@ -2699,7 +6651,9 @@ def reset_database_completely():
         db.session.execute(text('DELETE FROM audit_logs'))
         db.session.execute(text('DELETE FROM queue_logs'))
         
-        # 2. Clear prescriptions (depends on appointments and medicines)
+        # 2. Clear stock holds and batches, then prescriptions (depends on appointments and medicines)
+        db.session.execute(text('DELETE FROM stock_reservations'))
+        db.session.execute(text('DELETE FROM medicine_batches'))
         db.session.execute(text('DELETE FROM prescriptions'))
         
         # 3. Clear appointments (depends on users and doctor_profiles)  
@@ -2723,7 +6677,8 @@ def reset_database_completely():
         # Reset auto-increment counters (SQLite syntax)
         tables_to_reset = [
             'users', 'hospitals', 'departments', 'doctor_profiles', 
-            'appointments', 'prescriptions', 'medicines', 'queue_logs', 'audit_logs'
+            'appointments', 'prescriptions', 'medicines', 'queue_logs', 'audit_logs',
+            'medicine_batches', 'stock_reservations'
         ]
         
         for table in tables_to_reset:
@@ -2735,6 +6690,8 @@ def reset_database_completely():
                 app.logger.debug(f'Could not reset sequence for {table}: {e}')
         
         db.session.commit()
+        system_stats.mark_stale()
+        medicine_autocomplete.invalidate()
         
         # Verify reset
         total_records = (
@@ -2751,6 +6708,359 @@ def reset_database_completely():
         app.logger.error(f'Database reset failed: {e}')
         return False
 
+# =======================
+# SYNTHETIC WORKLOAD
+# =======================
+
+SYNTHETIC_BATCH_SIZE = 10_000
+SYNTHETIC_PASSWORD = 'password123'  # every generated account shares it
+
+SYNTHETIC_FIRST_NAMES = (
+    'Aarav', 'Aditi', 'Arjun', 'Divya', 'Ganesh', 'Harini', 'Karthik', 'Kavya', 'Lakshmi', 'Manoj',
+    'Meena', 'Nandini', 'Pradeep', 'Priya', 'Rahul', 'Revathi', 'Sanjay', 'Saranya', 'Suresh', 'Vignesh'
+)
+SYNTHETIC_LAST_NAMES = (
+    'Balan', 'Chandran', 'Devi', 'Iyer', 'Krishnan', 'Kumar', 'Menon', 'Murugan', 'Nair', 'Pillai',
+    'Raj', 'Raman', 'Reddy', 'Selvam', 'Subramaniam', 'Sundaram', 'Venkatesh'
+)
+SYNTHETIC_DEPARTMENTS = (
+    ('General Medicine', 'General Physician'), ('Cardiology', 'Cardiologist'), ('Orthopedics', 'Orthopedic Surgeon'),
+    ('Pediatrics', 'Pediatrician'), ('Dermatology', 'Dermatologist'), ('ENT', 'ENT Specialist'),
+    ('Gynecology', 'Gynecologist'), ('Neurology', 'Neurologist'), ('Ophthalmology', 'Ophthalmologist'),
+    ('Psychiatry', 'Psychiatrist')
+)
+SYNTHETIC_CITIES = ('Coimbatore', 'Chennai', 'Madurai', 'Salem', 'Tiruchirappalli', 'Erode', 'Tirunelveli')
+# (start, end, max patients per day)
+SYNTHETIC_SCHEDULES = ((time(9, 0), time(17, 0), 50), (time(8, 0), time(14, 0), 40),
+                       (time(10, 0), time(18, 0), 45), (time(14, 0), time(20, 0), 30))
+SYNTHETIC_SYMPTOMS = (
+    'fever and cough', 'headache', 'back pain', 'skin rash', 'chest discomfort', 'joint pain',
+    'sore throat', 'follow-up visit', 'stomach ache', 'dizziness', 'ear pain', 'blurred vision'
+)
+SYNTHETIC_GENERICS = (
+    ('Paracetamol', 'analgesic', ('500mg', '650mg')), ('Ibuprofen', 'analgesic', ('200mg', '400mg')),
+    ('Amoxicillin', 'antibiotic', ('250mg', '500mg')), ('Azithromycin', 'antibiotic', ('250mg', '500mg')),
+    ('Cetirizine', 'antihistamine', ('5mg', '10mg')), ('Metformin', 'antidiabetic', ('500mg', '850mg')),
+    ('Amlodipine', 'antihypertensive', ('5mg', '10mg')), ('Atorvastatin', 'statin', ('10mg', '20mg')),
+    ('Omeprazole', 'antacid', ('20mg', '40mg')), ('Pantoprazole', 'antacid', ('20mg', '40mg')),
+    ('Salbutamol', 'bronchodilator', ('2mg', '4mg')), ('Diclofenac', 'analgesic', ('50mg', '75mg')),
+    ('Losartan', 'antihypertensive', ('25mg', '50mg')), ('Levothyroxine', 'thyroid', ('50mcg', '100mcg')),
+    ('Ondansetron', 'antiemetic', ('4mg', '8mg')), ('Vitamin D3', 'supplement', ('1000IU', '60000IU'))
+)
+SYNTHETIC_FORMS = ('tablet', 'capsule', 'syrup')
+SYNTHETIC_FREQUENCIES = ('Once daily', 'Twice daily', 'Three times daily', 'At bedtime')
+# Relative demand Monday..Sunday
+SYNTHETIC_WEEKDAY_LOAD = (1.25, 1.05, 1.0, 1.0, 0.95, 0.8, 0.0)
+
+def _synthetic_uuid(rng):
+    return str(uuid.UUID(int=rng.getrandbits(128), version=4))
+
+def _synthetic_name(rng):
+    return f'{rng.choice(SYNTHETIC_FIRST_NAMES)} {rng.choice(SYNTHETIC_LAST_NAMES)}'
+
+def _next_id(model):
+    return (db.session.query(func.max(model.id)).scalar() or 0) + 1
+
+def _copy_rows(table, columns, rows):
+    """PostgreSQL: stream one batch straight into the table with COPY"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow([
+            '\\N' if value is None else json.dumps(value) if isinstance(value, (dict, list)) else value
+            for value in row
+        ])
+    buffer.seek(0)
+    cursor = db.session.connection().connection.cursor()
+    try:
+        cursor.copy_expert(
+            f"COPY {table.name} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv, NULL '\\N')", buffer
+        )
+    finally:
+        cursor.close()
+
+def bulk_load(model, columns, rows, batch_size=SYNTHETIC_BATCH_SIZE):
+    """
+    Load an iterable of row tuples in batches: COPY on PostgreSQL, executemany elsewhere.
+    Core inserts skip the ORM events, so callers refresh derived state afterwards.
+    """
+    table = model.__table__
+    insert = table.insert()
+    loaded = 0
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            loaded += _load_batch(table, insert, columns, batch)
+            batch = []
+    if batch:
+        loaded += _load_batch(table, insert, columns, batch)
+    return loaded
+
+def _load_batch(table, insert, columns, batch):
+    if db.engine.dialect.name == 'postgresql':
+        _copy_rows(table, columns, batch)
+    else:
+        db.session.execute(insert, [dict(zip(columns, row)) for row in batch])
+    db.session.commit()
+    return len(batch)
+
+def _synthetic_day_load(rng, max_patients, popularity, day):
+    """Bookings for one doctor-day: popularity and weekday scaled, noisy, capped at the daily limit"""
+    mean = max_patients * popularity * SYNTHETIC_WEEKDAY_LOAD[day.weekday()]
+    if mean <= 0:
+        return 0
+    return max(0, min(max_patients, round(rng.gauss(mean, mean * 0.15))))
+
+def seed_synthetic_workload(hospitals=3, departments=6, doctors_per_department=3, patients=5000,
+                            days=90, future_days=7, medicines=500, seed=42, prefix='syn',
+                            batch_size=SYNTHETIC_BATCH_SIZE, progress=None):
+    """
+    Generate a reproducible workload: hospitals, departments, doctors, patients, `days` of
+    past appointments (plus today and `future_days` of bookings) with call/finish times and
+    queue logs, prescriptions, medicines and their batches. Today's session is played through
+    only up to the current time, so nothing finishes in the future. Rows are generated in id order
+    so foreign keys never need a round trip. Returns row counts per table.
+    """
+    # The prefix is part of the seed so a second load under another prefix gets fresh uuids
+    rng = random.Random(f'{seed}:{prefix}')
+    today = date.today()
+    now = datetime.utcnow()
+    local_now = datetime.now()
+    counts = {}
+    report = progress or (lambda table, count: None)
+    
+    def load(model, columns, rows):
+        counts[model.__tablename__] = bulk_load(model, columns, rows, batch_size)
+        report(model.__tablename__, counts[model.__tablename__])
+    
+    # Hospitals and departments
+    hospital_rows = []
+    for h in range(hospitals):
+        city = rng.choice(SYNTHETIC_CITIES)
+        hospital_rows.append((_synthetic_uuid(rng), f'{city} {prefix.upper()} Hospital {h + 1}', city, True, now))
+    department_rows = []
+    for hospital in hospital_rows:
+        for name, specialization in SYNTHETIC_DEPARTMENTS[:departments]:
+            department_rows.append((_synthetic_uuid(rng), hospital[0], name, f'{name} department', True, now,
+                                    specialization))
+    load(Hospital, ('id', 'name', 'location', 'active', 'created_at'), hospital_rows)
+    load(Department, ('id', 'hospital_id', 'name', 'description', 'is_active', 'created_at'),
+         [row[:6] for row in department_rows])
+    
+    # Users: doctors first, then patients; one password hash shared by all
+    password_hash = generate_password_hash(SYNTHETIC_PASSWORD)
+    first_user_id = _next_id(User)
+    doctors = []
+    user_rows = []
+    for department in department_rows:
+        for _ in range(doctors_per_department):
+            user_id = first_user_id + len(user_rows)
+            username = f'{prefix}_doctor_{len(doctors) + 1}'
+            user_rows.append((user_id, username, f'{username}@{prefix}.local', password_hash,
+                              f'Dr. {_synthetic_name(rng)}', f'9{rng.randrange(10 ** 9):09d}', 'doctor', True, now))
+            starts, ends, max_patients = rng.choice(SYNTHETIC_SCHEDULES)
+            doctors.append({
+                'id': _synthetic_uuid(rng), 'user_id': user_id, 'hospital_id': department[1],
+                'department_id': department[0], 'specialization': department[6],
+                'available_from': starts, 'available_to': ends, 'max_patients_per_day': max_patients,
+                # Share of the daily limit usually booked; a few doctors run full every day
+                'popularity': min(rng.betavariate(4, 3) * 1.2, 1.0)
+            })
+    first_patient_id = first_user_id + len(user_rows)
+    
+    def user_stream():
+        yield from user_rows
+        for p in range(patients):
+            username = f'{prefix}_patient_{p + 1}'
+            yield (first_patient_id + p, username, f'{username}@{prefix}.local', password_hash,
+                   _synthetic_name(rng), f'9{rng.randrange(10 ** 9):09d}', 'patient', True, now)
+    
+    load(User, ('id', 'username', 'email', 'password_hash', 'full_name', 'phone', 'role', 'is_active',
+                'created_at'), user_stream())
+    load(DoctorProfile, ('id', 'user_id', 'hospital_id', 'department_id', 'specialization', 'experience_years',
+                         'consultation_fee', 'available_from', 'available_to', 'available_days',
+                         'max_patients_per_day', 'current_token', 'active', 'created_at'),
+         [(d['id'], d['user_id'], d['hospital_id'], d['department_id'], d['specialization'], rng.randint(2, 30),
+           float(rng.choice((200, 300, 500, 800))), d['available_from'], d['available_to'],
+           ['MON', 'TUE', 'WED', 'THU', 'FRI', 'SAT'], d['max_patients_per_day'], 0, True, now)
+          for d in doctors])
+    
+    # Medicines, each stocked from one to three batches; names already in the table are skipped
+    combos = [(f'{generic} {strength}', generic, category, strength)
+              for generic, category, strengths in SYNTHETIC_GENERICS for strength in strengths]
+    taken = {name.lower() for name, in db.session.query(Medicine.name)}
+    first_medicine_id = _next_id(Medicine)
+    medicine_rows = []
+    batch_rows = []
+    candidate = 0
+    for i in range(medicines):
+        while True:
+            name, generic, category, strength = combos[candidate % len(combos)]
+            if candidate >= len(combos):
+                name = f'{name} #{candidate // len(combos) + 1}'
+            candidate += 1
+            if name.lower() not in taken:
+                break
+        medicine_id = first_medicine_id + i
+        batches = [(rng.randint(0, 400), today + timedelta(days=rng.randint(-30, 720)))
+                   for _ in range(rng.randint(1, 3))]
+        stock = sum(quantity for quantity, _ in batches)
+        medicine_rows.append((medicine_id, name, generic.lower(), category, strength, rng.choice(SYNTHETIC_FORMS),
+                              f'{prefix.upper()}-{medicine_id:07d}', round(rng.uniform(0.5, 40), 2), stock, 0,
+                              rng.choice((10, 20, 50)), max(expiry for _, expiry in batches),
+                              f'{rng.choice(SYNTHETIC_LAST_NAMES)} Pharma', True, now, now))
+        batch_rows.extend((medicine_id, f'{prefix.upper()}-{medicine_id:07d}-{n + 1}', quantity, expiry, now, now)
+                          for n, (quantity, expiry) in enumerate(batches))
+    load(Medicine, ('id', 'name', 'generic_name', 'category', 'strength', 'form', 'batch_number', 'price_per_unit',
+                    'stock_quantity', 'reserved_quantity', 'reorder_level', 'expiry_date', 'manufacturer',
+                    'is_available', 'created_at', 'updated_at'), medicine_rows)
+    load(MedicineBatch, ('medicine_id', 'batch_number', 'quantity', 'expiry_date', 'received_at', 'updated_at'),
+         batch_rows)
+    prescribable = [row[1] for row in medicine_rows if row[8] > 0] or ['Paracetamol 500mg']
+    
+    # Appointments: tokens are booked in order into the doctor's slots, and past days are
+    # played through a first-come-first-served queue so call/finish times, queue logs and
+    # waits agree. Queue logs and prescriptions are flushed with each appointment batch.
+    columns = {
+        Appointment: ('id', 'patient_id', 'patient_name', 'hospital_id', 'department_id', 'doctor_id',
+                      'appointment_date', 'appointment_time', 'token_number', 'symptoms', 'status', 'priority',
+                      'doctor_notes', 'created_at', 'queue_version', 'actual_start_time', 'actual_end_time'),
+        QueueLog: ('appointment_id', 'status_change', 'timestamp', 'notes'),
+        Prescription: ('appointment_id', 'patient_id', 'doctor_id', 'prescription_data', 'pharmacy_status',
+                       'pickup_token', 'pickup_date', 'is_deleted', 'created_at', 'updated_at', 'dispensed_at'),
+    }
+    buffers = {model: [] for model in columns}
+    
+    def flush():
+        for model, rows in buffers.items():
+            if rows:
+                loaded = _load_batch(model.__table__, model.__table__.insert(), columns[model], rows)
+                counts[model.__tablename__] = counts.get(model.__tablename__, 0) + loaded
+                rows.clear()
+        report(Appointment.__tablename__, counts.get(Appointment.__tablename__, 0))
+    
+    def to_utc(local):
+        return local.astimezone(timezone.utc).replace(tzinfo=None)
+    
+    counter = PickupTokenCounter.query.get(today)
+    pickup_counter = counter.last_value if counter else 0
+    appointment_id = _next_id(Appointment)
+    for offset in range(-days, future_days + 1):
+        day = today + timedelta(days=offset)
+        for doctor in doctors:
+            booked = _synthetic_day_load(rng, doctor['max_patients_per_day'], doctor['popularity'], day)
+            opens = datetime.combine(day, doctor['available_from'])
+            slot = (datetime.combine(day, doctor['available_to']) - opens) / doctor['max_patients_per_day']
+            free_at = opens
+            playing = offset == 0  # today's session is played through up to the current time only
+            for token in range(1, booked + 1):
+                scheduled = opens + slot * (token - 1)
+                patient_id = first_patient_id + rng.randrange(patients)
+                started = ended = None
+                if offset > 0:
+                    status = 'booked'
+                elif offset == 0:
+                    status = 'in_queue'
+                    if playing:
+                        started = max(scheduled + timedelta(minutes=rng.gauss(0, 8)), free_at)
+                        ended = started + timedelta(minutes=max(3.0, rng.lognormvariate(math.log(10), 0.45)))
+                        if ended <= local_now:
+                            status = 'completed'
+                        elif started <= local_now:
+                            status, ended, playing = 'consulting', None, False
+                        else:
+                            started = ended = None
+                            playing = False
+                else:
+                    status = rng.choices(('completed', 'cancelled', 'expired'), (0.84, 0.07, 0.09))[0]
+                    if status == 'completed':
+                        started = max(scheduled + timedelta(minutes=rng.gauss(0, 8)), free_at)
+                        ended = started + timedelta(minutes=max(3.0, rng.lognormvariate(math.log(10), 0.45)))
+                
+                if started:
+                    free_at = ended or started
+                    buffers[QueueLog].append((appointment_id, 'Patient called for consultation', to_utc(started), None))
+                if ended:
+                    buffers[QueueLog].append((appointment_id, 'Consultation completed', to_utc(ended), None))
+                
+                buffers[Appointment].append((
+                    appointment_id, patient_id, None, doctor['hospital_id'], doctor['department_id'],
+                    doctor['user_id'], day, scheduled.time(), token, rng.choice(SYNTHETIC_SYMPTOMS), status,
+                    'urgent' if rng.random() < 0.03 else 'normal', None,
+                    to_utc(opens - timedelta(days=rng.randint(0, 6))), 0, started, ended
+                ))
+                
+                if ended and rng.random() < 0.85:
+                    items = [{'name': name, 'dosage': '1 tablet', 'frequency': rng.choice(SYNTHETIC_FREQUENCIES),
+                              'duration': f'{rng.choice((3, 5, 7, 10))} days', 'quantity': rng.choice((6, 10, 15, 21))}
+                             for name in rng.sample(prescribable, min(len(prescribable), rng.randint(1, 4)))]
+                    if offset < 0:
+                        pharmacy_status = rng.choices(('dispensed', 'cancelled'), (0.95, 0.05))[0]
+                        pickup_token = format_pickup_token(rng.randrange(PICKUP_TOKEN_SPACE), day)
+                    else:
+                        # Today's active tokens must stay unique, so they come off the real counter
+                        pharmacy_status = rng.choice(ACTIVE_PHARMACY_STATUSES)
+                        pickup_counter += 1
+                        pickup_token = format_pickup_token(pickup_counter, day)
+                    issued = to_utc(ended)
+                    buffers[Prescription].append((
+                        appointment_id, patient_id, doctor['user_id'], {'medicines': items, 'notes': ''},
+                        pharmacy_status, pickup_token, day, False, issued, issued,
+                        issued + timedelta(hours=1) if pharmacy_status == 'dispensed' else None
+                    ))
+                appointment_id += 1
+                if len(buffers[Appointment]) >= batch_size:
+                    flush()
+    flush()
+    
+    if pickup_counter:
+        if counter:
+            counter.last_value = pickup_counter
+        else:
+            db.session.add(PickupTokenCounter(token_date=today, last_value=pickup_counter))
+    if db.engine.dialect.name == 'postgresql':
+        # Explicit ids bypassed the serial sequences
+        for table in ('users', 'medicines', 'medicine_batches', 'appointments', 'prescriptions', 'queue_logs'):
+            db.session.execute(text(
+                f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), COALESCE((SELECT MAX(id) FROM {table}), 1))"
+            ))
+    db.session.commit()
+    system_stats.mark_stale()
+    medicine_autocomplete.invalidate()
+    return counts
+
+@app.cli.command('seed-synthetic')
+@click.option('--hospitals', default=3, show_default=True)
+@click.option('--departments', default=6, show_default=True, help='Departments per hospital')
+@click.option('--doctors', 'doctors_per_department', default=3, show_default=True, help='Doctors per department')
+@click.option('--patients', default=5000, show_default=True)
+@click.option('--days', default=90, show_default=True, help='Days of appointment history')
+@click.option('--future-days', default=7, show_default=True, help='Days of bookings ahead')
+@click.option('--medicines', default=500, show_default=True)
+@click.option('--seed', default=42, show_default=True)
+@click.option('--prefix', default='syn', show_default=True, help='Username prefix, change it to seed twice')
+@click.option('--batch-size', default=SYNTHETIC_BATCH_SIZE, show_default=True)
+@click.option('--rollups/--no-rollups', default=True, show_default=True, help='Build analytics rollups afterwards')
+def seed_synthetic_command(hospitals, departments, doctors_per_department, patients, days, future_days,
+                           medicines, seed, prefix, batch_size, rollups):
+    """Bulk-load a reproducible synthetic workload for benchmarking."""
+    if departments > len(SYNTHETIC_DEPARTMENTS):
+        raise click.BadParameter(f'at most {len(SYNTHETIC_DEPARTMENTS)} departments per hospital')
+    if patients < 1:
+        raise click.BadParameter('at least one patient is required')
+    db.create_all()
+    started = perf_counter()
+    counts = seed_synthetic_workload(
+        hospitals, departments, doctors_per_department, patients, days, future_days, medicines, seed, prefix,
+        batch_size, progress=lambda table, count: click.echo(f'  {table}: {count} rows ({perf_counter() - started:.1f}s)')
+    )
+    if rollups and days:
+        rollup_days(date.today() - timedelta(days=days), date.today())
+    total = sum(counts.values())
+    click.echo(f'Loaded {total} rows in {perf_counter() - started:.1f}s: '
+               + ', '.join(f'{table}={count}' for table, count in counts.items()))
+
 # =======================
 # AUTO CLEANUP — PAST APPOINTMENTS
 # =======================
@@ -2764,10 +7074,15 @@ def cleanup_past_appointments():
             Appointment.status.in_(['booked', 'in_queue', 'in_consultation', 'consulting'])
         ).all()
         count = len(expired)
+        doctor_days = {}
         for appt in expired:
             appt.status = 'expired'
+            doctor_days.setdefault((appt.doctor_id, appt.appointment_date), []).append(appt)
+        for (doctor_id, appointment_date), appts in doctor_days.items():
+            bump_queue_version(doctor_id, appointment_date, *appts)
         if count:
             db.session.commit()
+            publish_queue_change()
             app.logger.info(f'Auto-cleanup: marked {count} past appointment(s) as expired')
             
         # Reset token numbers for doctors with appointments today
@@ -2802,15 +7117,19 @@ def reset_daily_tokens():
             ).fetchall()
             
             # Reassign token numbers starting from 1
+            version = None
             for idx, appt_row in enumerate(appointments, 1):
                 if appt_row[1] != idx:  # Only update if token number is different
+                    if version is None:
+                        version = bump_queue_version(doctor_id, today)
                     db.session.execute(
-                        text('UPDATE appointments SET token_number = :token '
+                        text('UPDATE appointments SET token_number = :token, queue_version = :version '
                              'WHERE id = :appt_id'),
-                        {'token': idx, 'appt_id': appt_row[0]}
+                        {'token': idx, 'version': version, 'appt_id': appt_row[0]}
                     )
         
         db.session.commit()
+        publish_queue_change()
         app.logger.info(f'Reset token numbers for {len(doctors_today)} doctor(s)')
         
     except Exception as e:
@@ -2829,6 +7148,13 @@ def _nightly_cleanup_loop():
         _time.sleep(sleep_secs)
         with app.app_context():
             cleanup_past_appointments()
+            # Finalise yesterday now that its leftovers are marked expired
+            try:
+                yesterday = date.today() - timedelta(days=1)
+                rollup_days(yesterday, yesterday)
+            except Exception as e:
+                db.session.rollback()
+                app.logger.error(f'Nightly rollup failed: {e}')
 
 
 def schedule_nightly_cleanup():
@@ -2841,6 +7167,7 @@ if __name__ == '__main__':
     with app.app_context():
         # Create database tables
         db.create_all()
+        apply_schema_upgrades()
         
         # Seed production data - DISABLED for clean start
         # seed_production_data()  # Commented out - system starts completely clean
@@ -2854,6 +7181,13 @@ if __name__ == '__main__':
         # Schedule nightly cleanup at midnight
         schedule_nightly_cleanup()
         
+        # Release prescription stock holds that were never dispensed
+        expire_stock_holds()
+        schedule_stock_hold_sweep()
+        
+        # Keep today's analytics rollups current
+        schedule_rollup_refresh()
+        
     # Run the app
     print("Healthcare Queue-Free System Starting...")
     print(f"Database: {app.config['SQLALCHEMY_DATABASE_URI']}")
@@ -0,0 +1,80 @@
+"""
+Shared setup for the benchmark scripts: load the app against a throwaway SQLite
+database and seed it with synthetic rows.
+"""
+
+import contextlib
+import io
+import os
+import sys
+import tempfile
+from datetime import date, time, timedelta
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_app(database_url=None):
+    """
+    Import the backend against a fresh SQLite file in a temp directory (logs/ goes there too),
+    or against `database_url` when given (e.g. a scratch local PostgreSQL database)
+    """
+    workdir = tempfile.mkdtemp(prefix='qms-bench-')
+    os.chdir(workdir)
+    os.environ['DATABASE_URL'] = database_url or f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    os.environ.setdefault('JWT_SECRET_KEY', 'benchmark-jwt-secret-key-not-for-production')
+    os.environ.setdefault('SECRET_KEY', 'benchmark-secret-key')
+    sys.path.insert(0, BACKEND_DIR)
+    with contextlib.redirect_stdout(io.StringIO()):
+        import app as backend
+    return backend
+
+
+def seed(backend, rows, medicines=None):
+    """
+    Create one doctor and one patient, `rows` appointments with one prescription each,
+    and `medicines` inventory rows (defaults to `rows`). Call inside an app context.
+    """
+    db = backend.db
+    db.create_all()
+    hospital = backend.Hospital(name='Benchmark Hospital')
+    db.session.add(hospital)
+    db.session.flush()
+    department = backend.Department(hospital_id=hospital.id, name='General')
+    db.session.add(department)
+    db.session.flush()
+
+    users = {}
+    for role in ('doctor', 'patient'):
+        user = backend.User(username=f'bench_{role}', email=f'{role}@bench.local', password_hash='x',
+                            full_name=f'Bench {role.title()}', role=role)
+        db.session.add(user)
+        db.session.flush()
+        users[role] = user.id
+    db.session.add(backend.DoctorProfile(user_id=users['doctor'], hospital_id=hospital.id,
+                                         department_id=department.id, specialization='General Medicine'))
+
+    today = date.today()
+    db.session.add_all(
+        backend.Appointment(patient_id=users['patient'], doctor_id=users['doctor'], hospital_id=hospital.id,
+                            department_id=department.id, appointment_date=today,
+                            appointment_time=time(9 + (i % 8), (i * 7) % 60), token_number=i + 1,
+                            symptoms='fever and cough', status='booked')
+        for i in range(rows)
+    )
+    db.session.flush()
+    appointment_ids = [a.id for a in backend.Appointment.query.with_entities(backend.Appointment.id)]
+    db.session.add_all(
+        backend.Prescription(appointment_id=appointment_id, patient_id=users['patient'], doctor_id=users['doctor'],
+                             prescription_data=[{'name': 'Paracetamol', 'dosage': '500mg', 'frequency': 'BID'}],
+                             pickup_token=f'T{i:05d}')
+        for i, appointment_id in enumerate(appointment_ids)
+    )
+    db.session.add_all(
+        backend.Medicine(name=f'Medicine {i}', generic_name=f'generic-{i}', category='analgesic', strength='500mg',
+                         form='tablet', price_per_unit=1.5, stock_quantity=i % 120, reorder_level=10,
+                         expiry_date=today + timedelta(days=365), manufacturer='Bench Pharma')
+        for i in range(rows if medicines is None else medicines)
+    )
+    db.session.commit()
+    db.session.expunge_all()
+    return users
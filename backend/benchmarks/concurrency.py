@@ -0,0 +1,308 @@
+"""
+Concurrency stress harness for the booking and dispensing races.
+
+Booking: fires --bookings concurrent bookings from distinct patients at one doctor for one
+day, with the doctor's daily limit set to --capacity, then checks that tokens are unique,
+that exactly min(bookings, capacity) appointments exist and that every 201 response has a
+row behind it.
+
+Dispensing: creates --prescriptions prescriptions over a small set of medicines (each
+prescription draws --per-prescription of them, so they overlap heavily), stocks the
+medicines below total demand, and dispenses every prescription --duplicates times at once.
+It then checks that stock and batch quantities stayed non-negative, that batch totals
+match stock, that each medicine's stock fell by exactly what the dispensed prescriptions
+asked for (no lost or doubled deductions) and that no prescription was dispensed twice.
+
+Attempts are attributed per request by watching the SQL each worker thread sends: a booking
+attempt runs the next-token query once, a dispense attempt runs one guarded deduction per
+medicine until one misses. Requests run in threads through the Flask test client; use
+--database-url with a scratch PostgreSQL database (and --reset) for real row locking,
+SQLite serialises writers.
+
+Usage:
+    python benchmarks/concurrency.py [--workers 32] [--bookings 300] [--prescriptions 200]
+    python benchmarks/concurrency.py --database-url postgresql://localhost/qms_bench --reset
+"""
+
+import argparse
+import random
+import sys
+import threading
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+from time import perf_counter
+
+from sqlalchemy import event
+
+from common import load_app
+
+BOOKING_MARKER = 'next_token'
+DEDUCTION_MARKER = 'stock_quantity - reserved_quantity >='
+
+
+class StatementLog:
+    """Per-thread counts of the statements that mark a retry-loop attempt"""
+
+    def __init__(self, engine):
+        self.local = threading.local()
+        event.listen(engine, 'before_cursor_execute', self._on_execute)
+
+    def _on_execute(self, conn, cursor, statement, *args):
+        counts = getattr(self.local, 'counts', None)
+        if counts is not None:
+            if BOOKING_MARKER in statement:
+                counts['booking_attempts'] += 1
+            elif DEDUCTION_MARKER in statement:
+                counts['deductions'] += 1
+
+    def start(self):
+        self.local.counts = Counter()
+
+    def stop(self):
+        counts, self.local.counts = self.local.counts, None
+        return counts
+
+
+def headers(backend, user_id, role):
+    with backend.app.app_context():
+        token = backend.create_access_token(identity=user_id, additional_claims={'role': role, 'user_id': user_id},
+                                            expires_delta=timedelta(hours=1))
+    return {'Authorization': f'Bearer {token}'}
+
+
+def fire(backend, statements, jobs, workers):
+    """Run (method, url, headers, json) jobs concurrently; returns [(status, body, counts, seconds)] and wall time"""
+    start_gate = threading.Barrier(min(workers, len(jobs)))
+    local = threading.local()
+
+    def run(job):
+        client = getattr(local, 'client', None)
+        if client is None:
+            client = local.client = backend.app.test_client()
+            try:
+                start_gate.wait(timeout=10)
+            except threading.BrokenBarrierError:
+                pass
+        method, url, request_headers, body = job
+        statements.start()
+        started = perf_counter()
+        response = getattr(client, method)(url, headers=request_headers, json=body)
+        elapsed = perf_counter() - started
+        return response.status_code, response.get_json(silent=True) or {}, statements.stop(), elapsed
+
+    started = perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(run, jobs))
+    return results, perf_counter() - started
+
+
+def setup(backend, args, rng):
+    db = backend.db
+    with backend.app.app_context():
+        if args.reset or not args.database_url:
+            db.drop_all()
+        db.create_all()
+        if backend.User.query.first() is not None:
+            raise SystemExit('Database is not empty; pass --reset to wipe it (scratch databases only)')
+        hospital = backend.Hospital(name='Stress Hospital')
+        db.session.add(hospital)
+        db.session.flush()
+        department = backend.Department(hospital_id=hospital.id, name='General')
+        db.session.add(department)
+        db.session.flush()
+
+        def user(username, role):
+            account = backend.User(username=username, email=f'{username}@stress.local', password_hash='x',
+                                   full_name=username.replace('_', ' ').title(), role=role)
+            db.session.add(account)
+            return account
+
+        doctor = user('stress_doctor', 'doctor')
+        pharmacist = user('stress_pharmacy', 'pharmacy')
+        patients = [user(f'stress_patient_{i + 1}', 'patient') for i in range(max(args.bookings, 1))]
+        db.session.flush()
+        profile = backend.DoctorProfile(user_id=doctor.id, hospital_id=hospital.id, department_id=department.id,
+                                        specialization='General Medicine', max_patients_per_day=args.capacity)
+        db.session.add(profile)
+
+        # Medicines stocked at --stock-ratio of the demand the prescriptions will place on them
+        names = [f'Stress Medicine {i + 1}' for i in range(args.medicines)]
+        demand = Counter()
+        prescriptions = []
+        for i in range(args.prescriptions):
+            items = [{'name': name, 'dosage': '1 tablet', 'frequency': 'Twice daily', 'quantity': rng.randint(1, 10)}
+                     for name in rng.sample(names, min(args.per_prescription, len(names)))]
+            for item in items:
+                demand[item['name']] += item['quantity']
+            prescriptions.append(items)
+        today = date.today()
+        medicines = {}
+        for name in names:
+            stock = int(demand[name] * args.stock_ratio)
+            medicine = backend.Medicine(name=name, stock_quantity=stock, reorder_level=10,
+                                        expiry_date=today + timedelta(days=365))
+            db.session.add(medicine)
+            db.session.flush()
+            # Two batches so dispensing has to draw across them
+            db.session.add_all([
+                backend.MedicineBatch(medicine_id=medicine.id, batch_number=f'S{medicine.id}-A',
+                                      quantity=stock // 2, expiry_date=today + timedelta(days=90)),
+                backend.MedicineBatch(medicine_id=medicine.id, batch_number=f'S{medicine.id}-B',
+                                      quantity=stock - stock // 2, expiry_date=today + timedelta(days=365)),
+            ])
+            medicines[name] = stock
+
+        appointment = backend.Appointment(patient_id=patients[0].id, doctor_id=doctor.id, hospital_id=hospital.id,
+                                          department_id=department.id, appointment_date=today - timedelta(days=1),
+                                          token_number=1, status='completed')
+        db.session.add(appointment)
+        db.session.flush()
+        prescription_ids = []
+        for i, items in enumerate(prescriptions):
+            prescription = backend.Prescription(appointment_id=appointment.id, patient_id=patients[0].id,
+                                                doctor_id=doctor.id, prescription_data={'medicines': items, 'notes': ''},
+                                                pharmacy_status='ready', pickup_token=f'{i:06d}', pickup_date=today)
+            db.session.add(prescription)
+            db.session.flush()
+            prescription_ids.append(prescription.id)
+        db.session.commit()
+        return {
+            'profile_id': profile.id,
+            'doctor_id': doctor.id,
+            'patients': [patient.id for patient in patients],
+            'pharmacist': pharmacist.id,
+            'medicines': medicines,
+            'prescriptions': dict(zip(prescription_ids, prescriptions)),
+        }
+
+
+def rate(part, whole):
+    return f'{part / whole:.1%}' if whole else 'n/a'
+
+
+def stress_bookings(backend, statements, fixture, args):
+    today = date.today()
+    jobs = [('post', '/api/appointments', headers(backend, patient_id, 'patient'),
+             {'doctor_id': fixture['profile_id'], 'appointment_date': today.isoformat(), 'symptoms': 'stress'})
+            for patient_id in fixture['patients'][:args.bookings]]
+    results, elapsed = fire(backend, statements, jobs, args.workers)
+
+    statuses = Counter(status for status, _, _, _ in results)
+    attempts = sum(counts['booking_attempts'] for _, _, counts, _ in results)
+    retries = sum(max(counts['booking_attempts'] - 1, 0) for _, _, counts, _ in results)
+    booked = [body['data']['appointment_id'] for status, body, _, _ in results if status == 201]
+    with backend.app.app_context():
+        rows = backend.db.session.query(backend.Appointment.id, backend.Appointment.token_number).filter(
+            backend.Appointment.doctor_id == fixture['doctor_id'], backend.Appointment.appointment_date == today
+        ).all()
+    tokens = Counter(token for _, token in rows)
+    duplicates = {token: count for token, count in tokens.items() if count > 1}
+    expected = min(args.bookings, args.capacity)
+
+    print(f'Bookings: {len(jobs)} requests in {elapsed:.2f}s ({len(jobs) / elapsed:.1f} req/s), '
+          f'statuses {dict(sorted(statuses.items()))}')
+    print(f'  attempts {attempts}, retries {retries} ({rate(retries, len(jobs))} of requests), '
+          f'409 conflicts {statuses.get(409, 0)}, 5xx {sum(n for s, n in statuses.items() if s >= 500)}')
+    violations = []
+    if duplicates:
+        violations.append(f'duplicate tokens {sorted(duplicates.items())[:10]}')
+    if len(rows) > args.capacity:
+        violations.append(f'{len(rows)} appointments booked past the daily limit of {args.capacity}')
+    if len(rows) != len(booked) or set(booked) - {appointment_id for appointment_id, _ in rows}:
+        violations.append(f'{len(booked)} bookings acknowledged but {len(rows)} rows stored')
+    if len(booked) < expected:
+        print(f'  note: {expected - len(booked)} bookings under the limit were turned away')
+    return violations
+
+
+def stress_dispensing(backend, statements, fixture, args):
+    pharmacy = headers(backend, fixture['pharmacist'], 'pharmacy')
+    jobs = [('put', f'/api/pharmacy/prescriptions/{prescription_id}/status', pharmacy, {'status': 'dispensed'})
+            for prescription_id in fixture['prescriptions'] for _ in range(args.duplicates)]
+    random.Random(args.seed).shuffle(jobs)
+    results, elapsed = fire(backend, statements, jobs, args.workers)
+
+    statuses = Counter(status for status, _, _, _ in results)
+    deductions = sum(counts['deductions'] for _, _, counts, _ in results)
+    applied = sum(len(body.get('dispensing_log') or []) for status, body, _, _ in results if status == 200)
+    misses = deductions - applied
+    stock_conflicts = sum(1 for status, body, _, _ in results if body.get('error_code') == 'STOCK_CONFLICT')
+    dispensed_responses = Counter(
+        body['prescription']['id'] for status, body, _, _ in results
+        if status == 200 and body.get('dispensing_log')
+    )
+
+    violations = []
+    with backend.app.app_context():
+        db = backend.db
+        stock = dict(db.session.query(backend.Medicine.name, backend.Medicine.stock_quantity))
+        reserved = dict(db.session.query(backend.Medicine.name, backend.Medicine.reserved_quantity))
+        batch_totals = dict(db.session.query(backend.Medicine.name, db.func.sum(backend.MedicineBatch.quantity)).join(
+            backend.MedicineBatch, backend.MedicineBatch.medicine_id == backend.Medicine.id
+        ).group_by(backend.Medicine.name))
+        negative_batches = backend.MedicineBatch.query.filter(backend.MedicineBatch.quantity < 0).count()
+        dispensed = [prescription_id for prescription_id, in db.session.query(backend.Prescription.id).filter(
+            backend.Prescription.pharmacy_status == 'dispensed'
+        )]
+
+    expected_use = defaultdict(int)
+    for prescription_id in dispensed:
+        for item in fixture['prescriptions'][prescription_id]:
+            expected_use[item['name']] += item['quantity']
+    for name, initial in fixture['medicines'].items():
+        if stock[name] < 0 or reserved[name] < 0:
+            violations.append(f'{name}: negative stock {stock[name]} / reserved {reserved[name]}')
+        if initial - stock[name] != expected_use[name]:
+            violations.append(f'{name}: stock fell by {initial - stock[name]}, dispensed prescriptions '
+                              f'account for {expected_use[name]}')
+        if (batch_totals.get(name) or 0) != stock[name]:
+            violations.append(f'{name}: batches hold {batch_totals.get(name) or 0}, stock says {stock[name]}')
+    if negative_batches:
+        violations.append(f'{negative_batches} batches below zero')
+    doubled = [prescription_id for prescription_id, count in dispensed_responses.items() if count > 1]
+    if doubled:
+        violations.append(f'prescriptions dispensed more than once: {doubled[:10]}')
+    if set(dispensed_responses) != set(dispensed):
+        violations.append(f'{len(dispensed_responses)} dispenses acknowledged, {len(dispensed)} stored')
+
+    print(f'Dispensing: {len(jobs)} requests in {elapsed:.2f}s ({len(jobs) / elapsed:.1f} req/s), '
+          f'statuses {dict(sorted(statuses.items()))}')
+    print(f'  {len(dispensed)}/{len(fixture["prescriptions"])} prescriptions dispensed, guarded deductions '
+          f'{deductions}, misses {misses} ({rate(misses, deductions)}), STOCK_CONFLICT responses {stock_conflicts}')
+    return violations
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, default=32, help='Concurrent client threads')
+    parser.add_argument('--bookings', type=int, default=300)
+    parser.add_argument('--capacity', type=int, default=250, help="Doctor's daily limit for the booking run")
+    parser.add_argument('--prescriptions', type=int, default=200)
+    parser.add_argument('--medicines', type=int, default=8)
+    parser.add_argument('--per-prescription', type=int, default=3, help='Medicines per prescription')
+    parser.add_argument('--stock-ratio', type=float, default=0.7, help='Stock as a share of total demand')
+    parser.add_argument('--duplicates', type=int, default=2, help='Concurrent dispense requests per prescription')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--database-url', help='Scratch database instead of a temp SQLite file')
+    parser.add_argument('--reset', action='store_true', help='Drop and recreate all tables in --database-url first')
+    args = parser.parse_args()
+
+    backend = load_app(args.database_url)
+    fixture = setup(backend, args, random.Random(args.seed))
+    with backend.app.app_context():
+        dialect = backend.db.engine.dialect.name
+        statements = StatementLog(backend.db.engine)
+    print(f'{dialect}, {args.workers} workers')
+
+    violations = stress_bookings(backend, statements, fixture, args)
+    violations += stress_dispensing(backend, statements, fixture, args)
+    for violation in violations:
+        print(f'INVARIANT VIOLATED {violation}')
+    if not violations:
+        print('All invariants held')
+    sys.exit(1 if violations else 0)
+
+
+if __name__ == '__main__':
+    main()
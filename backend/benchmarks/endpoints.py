@@ -0,0 +1,360 @@
+"""
+Endpoint benchmark suite: throughput, latency percentiles and SQL statements per request
+for the hot paths (login, book appointment, queue status, call next, daily summary,
+pharmacy list, dispense), driven serially through the Flask test client.
+
+Seeds a synthetic workload (the same generator as `flask seed-synthetic`) into a throwaway
+SQLite database, or into --database-url (a scratch local PostgreSQL database, emptied
+first when --reset is given), runs each case and compares the results with a JSON
+baseline. Exits 1 when a request fails or any metric regresses beyond --threshold
+(query counts beyond --query-slack statements per request).
+
+Usage:
+    python benchmarks/endpoints.py --update-baseline       # record benchmarks/baseline.json
+    python benchmarks/endpoints.py [--threshold 0.25]      # compare against it
+    python benchmarks/endpoints.py --database-url postgresql://localhost/qms_bench --reset
+"""
+
+import argparse
+import json
+import os
+import platform
+import sys
+from datetime import date, datetime, timedelta
+from time import perf_counter
+
+from sqlalchemy import event
+
+from common import load_app
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+# Small enough to seed in seconds, large enough that list and summary queries do real work
+WORKLOAD = dict(hospitals=1, departments=3, doctors_per_department=3, patients=2000, days=30,
+                future_days=3, medicines=300, seed=42)
+
+# Metric -> True when larger is worse
+METRICS = {
+    'throughput_rps': False,
+    'p50_ms': True,
+    'p95_ms': True,
+    'p99_ms': True,
+    'queries_per_request': True,
+}
+
+
+class QueryCounter:
+    """Counts statements sent to the database (an executemany counts once)"""
+
+    def __init__(self, engine):
+        self.count = 0
+        event.listen(engine, 'before_cursor_execute', self._on_execute)
+
+    def _on_execute(self, *args):
+        self.count += 1
+
+
+class Bench:
+    """Seeded app plus the ids and tokens the cases draw their requests from"""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.app = backend.app
+        self.client = self.app.test_client()
+        self.today = date.today()
+
+    def headers(self, user_id, role):
+        with self.app.app_context():
+            token = self.backend.create_access_token(
+                identity=user_id, additional_claims={'role': role, 'user_id': user_id},
+                expires_delta=timedelta(hours=1)
+            )
+        return {'Authorization': f'Bearer {token}'}
+
+    def seed(self, reset, workload=WORKLOAD):
+        backend, db = self.backend, self.backend.db
+        with self.app.app_context():
+            if reset:
+                db.drop_all()
+            db.create_all()
+            if backend.User.query.first() is not None:
+                raise SystemExit('Database is not empty; pass --reset to wipe it (scratch databases only)')
+            self.workload = workload
+            backend.seed_synthetic_workload(**workload)
+            backend.rollup_days(self.today - timedelta(days=workload['days']), self.today)
+            pharmacist = backend.User(username='bench_pharmacy', email='pharmacy@bench.local', password_hash='x',
+                                      full_name='Bench Pharmacy', role='pharmacy')
+            db.session.add(pharmacist)
+            db.session.commit()
+            self.pharmacy = self.headers(pharmacist.id, 'pharmacy')
+            self.profiles = [(profile.id, profile.user_id, profile.max_patients_per_day)
+                             for profile in backend.DoctorProfile.query.order_by(backend.DoctorProfile.id)]
+            self.patients = [user_id for user_id, in db.session.query(backend.User.id).filter(
+                backend.User.role == 'patient', backend.User.username.like('syn_patient_%')
+            ).order_by(backend.User.id)]
+
+
+def _cycle(items, count):
+    return [items[i % len(items)] for i in range(count)] if items else []
+
+
+def login_requests(bench, count):
+    """Password checks dominate; each attempt comes from its own address to stay under the rate limit"""
+    backend = bench.backend
+    with bench.app.app_context():
+        usernames = [name for name, in bench.backend.db.session.query(backend.User.username).filter(
+            backend.User.username.like('syn_patient_%')
+        ).order_by(backend.User.id).limit(count)]
+    return [
+        (lambda i=i, username=username: bench.client.post(
+            '/api/auth/login', json={'username': username, 'password': backend.SYNTHETIC_PASSWORD},
+            environ_base={'REMOTE_ADDR': f'10.{i // 65536 % 256}.{i // 256 % 256}.{i % 256}'}
+        ))
+        for i, username in enumerate(_cycle(usernames, count))
+    ]
+
+
+def book_requests(bench, count):
+    """Bookings past the seeded horizon, spread over doctors and days below every daily limit"""
+    first_day = bench.today + timedelta(days=bench.workload['future_days'] + 1)
+    per_day = min(cap for _, _, cap in bench.profiles)
+    requests = []
+    for i in range(count):
+        profile_id, _, _ = bench.profiles[i % len(bench.profiles)]
+        day = first_day + timedelta(days=i // len(bench.profiles) // per_day)
+        headers = bench.headers(bench.patients[i % len(bench.patients)], 'patient')
+        requests.append(lambda profile_id=profile_id, day=day, headers=headers: bench.client.post(
+            '/api/appointments', headers=headers,
+            json={'doctor_id': profile_id, 'appointment_date': day.isoformat(), 'symptoms': 'fever and cough'}
+        ))
+    return requests
+
+
+def queue_status_requests(bench, count):
+    backend = bench.backend
+    with bench.app.app_context():
+        waiting = backend.db.session.query(backend.Appointment.id, backend.Appointment.patient_id).filter(
+            backend.Appointment.appointment_date == bench.today, backend.Appointment.status == 'in_queue'
+        ).order_by(backend.Appointment.id).limit(200).all()
+    pool = [(appointment_id, bench.headers(patient_id, 'patient')) for appointment_id, patient_id in waiting]
+    return [
+        (lambda appointment_id=appointment_id, headers=headers: bench.client.get(
+            f'/api/patient/queue-status/{appointment_id}', headers=headers
+        ))
+        for appointment_id, headers in _cycle(pool, count)
+    ]
+
+
+def call_next_requests(bench, count):
+    """
+    One call per waiting patient today, round-robin over doctors so no queue runs dry early.
+    A doctor's first call is /api/doctor/call-next; later ones go through /api/queue/next,
+    which completes the consulting patient first (call-next refuses while one is in).
+    """
+    backend, db = bench.backend, bench.backend.db
+    Appointment = backend.Appointment
+    with bench.app.app_context():
+        today = (Appointment.appointment_date == bench.today)
+        # Start from a clean slate: nobody consulting, every waiting patient checked in
+        Appointment.query.filter(today, Appointment.status == 'consulting').update(
+            {'status': 'completed', 'actual_end_time': datetime.now()}, synchronize_session=False
+        )
+        Appointment.query.filter(today, Appointment.status == 'booked').update(
+            {'status': 'in_queue'}, synchronize_session=False
+        )
+        db.session.commit()
+        waiting = dict(db.session.query(Appointment.doctor_id, db.func.count()).filter(
+            today, Appointment.status == 'in_queue'
+        ).group_by(Appointment.doctor_id).all())
+    headers = {user_id: bench.headers(user_id, 'doctor') for user_id in waiting}
+    order = []
+    called = set()
+    while len(order) < count and any(waiting.values()):
+        for user_id in sorted(waiting):
+            if waiting[user_id] and len(order) < count:
+                waiting[user_id] -= 1
+                order.append(('/api/queue/next' if user_id in called else '/api/doctor/call-next', headers[user_id]))
+                called.add(user_id)
+    return [(lambda path=path, headers=headers: bench.client.post(path, headers=headers)) for path, headers in order]
+
+
+def daily_summary_requests(bench, count):
+    pool = [bench.headers(user_id, 'doctor') for _, user_id, _ in bench.profiles]
+    return [
+        (lambda headers=headers: bench.client.get('/api/doctor/daily-summary', headers=headers))
+        for headers in _cycle(pool, count)
+    ]
+
+
+def pharmacy_list_requests(bench, count):
+    return [(lambda: bench.client.get('/api/pharmacy/prescriptions?limit=20', headers=bench.pharmacy))] * count
+
+
+def dispense_requests(bench, count):
+    """Reopen historical prescriptions and top up stock (batches follow) so every dispense succeeds"""
+    backend, db = bench.backend, bench.backend.db
+    with bench.app.app_context():
+        ids = [prescription_id for prescription_id, in db.session.query(backend.Prescription.id).filter(
+            backend.Prescription.pharmacy_status == 'dispensed'
+        ).order_by(backend.Prescription.id.desc()).limit(count)]
+        backend.Prescription.query.filter(backend.Prescription.id.in_(ids)).update({
+            'pharmacy_status': 'pending', 'pickup_token': None, 'dispensed_at': None
+        }, synchronize_session=False)
+        # The top-up lands in each medicine's current batch, so give that batch a future expiry
+        backend.Medicine.query.update({'stock_quantity': backend.Medicine.stock_quantity + 25 * count,
+                                       'expiry_date': bench.today + timedelta(days=365)},
+                                      synchronize_session=False)
+        backend.reconcile_medicine_batches()
+        db.session.commit()
+    return [
+        (lambda prescription_id=prescription_id: bench.client.put(
+            f'/api/pharmacy/prescriptions/{prescription_id}/status', headers=bench.pharmacy,
+            json={'status': 'dispensed'}
+        ))
+        for prescription_id in ids
+    ]
+
+
+# name -> (request builder, share of --iterations); login is bound by password hashing
+CASES = {
+    'login': (login_requests, 0.1),
+    'book_appointment': (book_requests, 1),
+    'queue_status': (queue_status_requests, 1),
+    'call_next': (call_next_requests, 1),
+    'daily_summary': (daily_summary_requests, 1),
+    'pharmacy_list': (pharmacy_list_requests, 1),
+    'dispense': (dispense_requests, 1),
+}
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, round(fraction * (len(ordered) - 1)))]
+
+
+def run_case(requests, counter, warmup):
+    """Time each request after `warmup` untimed ones; returns (metrics, failures)"""
+    failures = []
+    for send in requests[:warmup]:
+        response = send()
+        if response.status_code >= 400:
+            failures.append(f'{response.status_code} {response.get_data(as_text=True)[:200]}')
+    measured = requests[warmup:]
+    latencies = []
+    queries = 0
+    started = perf_counter()
+    for send in measured:
+        before = counter.count
+        request_started = perf_counter()
+        response = send()
+        latencies.append(perf_counter() - request_started)
+        queries += counter.count - before
+        if response.status_code >= 400:
+            failures.append(f'{response.status_code} {response.get_data(as_text=True)[:200]}')
+    elapsed = perf_counter() - started
+    if not measured:
+        return None, failures
+    return {
+        'requests': len(measured),
+        'throughput_rps': round(len(measured) / elapsed, 1),
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 2),
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+        'queries_per_request': round(queries / len(measured), 2),
+    }, failures
+
+
+def compare(results, baseline, threshold, query_slack):
+    """Regression messages for every metric beyond its allowance"""
+    regressions = []
+    for name, metrics in results.items():
+        previous = baseline.get(name)
+        if not previous:
+            continue
+        for metric, larger_is_worse in METRICS.items():
+            old, new = previous.get(metric), metrics.get(metric)
+            if old is None or new is None:
+                continue
+            if metric == 'queries_per_request':
+                regressed = new > old + query_slack
+            elif larger_is_worse:
+                regressed = new > old * (1 + threshold)
+            else:
+                regressed = new < old / (1 + threshold)
+            if regressed:
+                regressions.append(f'{name}.{metric}: {old} -> {new}')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--iterations', type=int, default=200, help='Timed requests per case')
+    parser.add_argument('--warmup', type=int, default=10, help='Untimed requests per case')
+    parser.add_argument('--cases', nargs='*', choices=list(CASES), help='Subset of cases (default: all)')
+    parser.add_argument('--database-url', help='Scratch database to seed instead of a temp SQLite file')
+    parser.add_argument('--reset', action='store_true', help='Drop and recreate all tables in --database-url first')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--update-baseline', action='store_true', help='Write the results as the new baseline')
+    parser.add_argument('--threshold', type=float, default=0.25, help='Allowed relative latency/throughput change')
+    parser.add_argument('--query-slack', type=float, default=0.5, help='Allowed extra statements per request')
+    parser.add_argument('--output', help='Also write these results to this JSON file')
+    args = parser.parse_args()
+
+    backend = load_app(args.database_url)
+    bench = Bench(backend)
+    started = perf_counter()
+    bench.seed(args.reset or not args.database_url)
+    with backend.app.app_context():
+        dialect = backend.db.engine.dialect.name
+        counter = QueryCounter(backend.db.engine)
+    print(f'Seeded {dialect} in {perf_counter() - started:.1f}s; {args.iterations} requests per case, '
+          f'{args.warmup} warm-up')
+
+    results = {}
+    failed = False
+    print(f'{"case":<18}{"req":>6}{"rps":>10}{"p50 ms":>10}{"p95 ms":>10}{"p99 ms":>10}{"queries":>9}')
+    for name in args.cases or CASES:
+        build, share = CASES[name]
+        iterations = max(5, int(args.iterations * share))
+        requests = build(bench, args.warmup + iterations)
+        metrics, failures = run_case(requests, counter, min(args.warmup, len(requests) // 2))
+        if failures:
+            failed = True
+            print(f'{name:<18}{len(failures)} failed requests, e.g. {failures[0]}')
+        if metrics is None:
+            print(f'{name:<18}skipped: no requests could be prepared')
+            continue
+        results[name] = metrics
+        print(f'{name:<18}{metrics["requests"]:>6}{metrics["throughput_rps"]:>10}{metrics["p50_ms"]:>10}'
+              f'{metrics["p95_ms"]:>10}{metrics["p99_ms"]:>10}{metrics["queries_per_request"]:>9}')
+
+    report = {
+        'environment': {'dialect': dialect, 'python': platform.python_version(), 'workload': WORKLOAD,
+                        'iterations': args.iterations},
+        'cases': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.update_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f'Baseline written to {args.baseline}')
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline['environment'].get('dialect') != dialect:
+            print(f'note: baseline was recorded on {baseline["environment"].get("dialect")}, this run is {dialect}')
+        regressions = compare(results, baseline['cases'], args.threshold, args.query_slack)
+        for regression in regressions:
+            print(f'REGRESSION {regression}')
+        failed = failed or bool(regressions)
+        if not regressions:
+            print(f'No regressions beyond {args.threshold:.0%} against {args.baseline}')
+    else:
+        print(f'No baseline at {args.baseline}; run with --update-baseline to record one')
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""
+Memory benchmark for read-only list endpoints: ORM instances vs column-only row DTOs.
+
+Seeds a throwaway SQLite database with N medicines and measures the tracemalloc peak
+of building each response inside a request context, the legacy way (Query.all() +
+to_dict()/dict per row) and the current way (RowSchema.fetch on a column select).
+
+Usage:
+    python benchmarks/memory.py [--medicines 10000]
+"""
+
+import argparse
+import gc
+import tracemalloc
+from time import perf_counter
+
+from common import load_app, seed
+
+
+def measure(backend, build):
+    """Peak traced bytes and wall time to build one response, session cleared before and after"""
+    backend.db.session.remove()
+    gc.collect()
+    with backend.app.test_request_context():
+        tracemalloc.start()
+        start = perf_counter()
+        response = build()
+        elapsed = perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        size = len(response.get_data())
+    backend.db.session.remove()
+    return peak, elapsed, size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--medicines', type=int, default=10000)
+    args = parser.parse_args()
+
+    backend = load_app()
+    app, db, Medicine = backend.app, backend.db, backend.Medicine
+    jsonify = backend.jsonify
+
+    def legacy_inventory():
+        return jsonify([{
+            'id': medicine.id,
+            'medicine_name': medicine.name,
+            'generic_name': medicine.generic_name,
+            'category': medicine.category,
+            'quantity_in_stock': medicine.stock_quantity,
+            'reorder_level': medicine.reorder_level,
+            'price_per_unit': medicine.price_per_unit,
+            'low_stock': medicine.stock_quantity <= medicine.reorder_level
+        } for medicine in Medicine.query.filter_by(is_available=True).all()])
+
+    def dto_inventory():
+        return jsonify(backend.INVENTORY_ROWS.fetch(
+            db.select(*backend.INVENTORY_ROWS.columns(Medicine)).where(Medicine.is_available == True)
+        ))
+
+    def legacy_medicines():
+        return jsonify([medicine.to_dict() for medicine in Medicine.query.filter_by(is_available=True).all()])
+
+    def dto_medicines():
+        return jsonify(backend.MEDICINE_ROWS.fetch(
+            db.select(*backend.MEDICINE_ROWS.columns(Medicine)).where(Medicine.is_available == True)
+        ))
+
+    with app.app_context():
+        seed(backend, rows=0, medicines=args.medicines)
+
+        print(f'medicines: {args.medicines}, JSON backend: {backend.FAST_JSON_BACKEND or "stdlib"}')
+        print(f'{"endpoint":<22}{"ORM peak":>12}{"DTO peak":>12}{"saved":>8}{"ORM time":>12}{"DTO time":>12}')
+        for name, legacy, dto in [('/api/pharmacy/inventory', legacy_inventory, dto_inventory),
+                                  ('/api/pharmacy/medicines', legacy_medicines, dto_medicines)]:
+            # Warm both paths so statement compilation caches don't count against either
+            measure(backend, legacy)
+            measure(backend, dto)
+            orm_peak, orm_time, _ = measure(backend, legacy)
+            dto_peak, dto_time, _ = measure(backend, dto)
+            print(f'{name:<22}{orm_peak / 2**20:>9.1f} MB{dto_peak / 2**20:>9.1f} MB'
+                  f'{1 - dto_peak / orm_peak:>8.0%}{orm_time * 1000:>9.0f} ms{dto_time * 1000:>9.0f} ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,362 @@
+"""
+Query-plan regression check for the hot SQL behind the queue, booking, pharmacy and audit
+routes.
+
+Seeds the synthetic workload (plus audit history) into --database-url, a scratch local
+PostgreSQL database emptied first when --reset is given, drives each route a few times
+through the Flask test client and captures every SELECT/UPDATE/DELETE it sends. Each
+distinct statement is then explained with its captured parameters:
+
+  * PostgreSQL: EXPLAIN (FORMAT JSON) after ANALYZE. Fails on a Seq Scan over any table
+    with more than --large-rows rows, on a total estimated cost above --max-cost, and on a
+    cost more than --threshold above the JSON baseline.
+  * SQLite (the default, a throwaway file): EXPLAIN QUERY PLAN. Fails on a full SCAN of a
+    large table; SQLite has no cost estimate, so only the scan check applies.
+
+Walking a whole index counts as a full scan too: SCAN ... USING [COVERING] INDEX on SQLite,
+an Index (Only) Scan with a Filter but no Index Cond on PostgreSQL.
+
+Intended full scans are listed in ALLOWED_SCANS with the reason. Exits 1 on any violation.
+
+Usage:
+    python benchmarks/query_plans.py --database-url postgresql://localhost/qms_plans --reset --update-baseline
+    python benchmarks/query_plans.py --database-url postgresql://localhost/qms_plans --reset
+    python benchmarks/query_plans.py                                  # SQLite scan check only
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import random
+import re
+import sys
+from datetime import datetime, timedelta
+from time import perf_counter
+
+from sqlalchemy import event, text
+
+from common import load_app
+from endpoints import (WORKLOAD, Bench, book_requests, call_next_requests, daily_summary_requests,
+                       dispense_requests, pharmacy_list_requests, queue_status_requests)
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'plan_baseline.json')
+
+# Three months of history so the appointment, prescription and audit tables are well past
+# the size where a missing index shows up as a full scan
+PLAN_WORKLOAD = dict(WORKLOAD, days=90)
+AUDIT_ROWS_PER_DAY = 400
+
+# Requests sent per case; statements are deduplicated, so a few calls cover every branch
+CALLS = 3
+
+# (case, table) -> why a full scan there is expected
+ALLOWED_SCANS = {
+    ('pharmacy_list', 'prescriptions'): 'unfiltered newest-first list walks ix_prescription_created_id backwards '
+                                        'and stops after LIMIT rows',
+    ('pharmacy_pages', 'prescriptions'): 'legacy ?page= paging with ?total=exact counts every live prescription; '
+                                         'cursor paging (total=none/approx) is the indexed path',
+}
+
+EXPLAINED = ('SELECT', 'WITH', 'UPDATE', 'DELETE')
+PARAMETER_LIST = re.compile(r'\(\s*(?:\?|%\(\w+\)s)(?:\s*,\s*(?:\?|%\(\w+\)s))*\s*\)')
+# SQLite reports a constrained index lookup as SEARCH; SCAN ... USING [COVERING] INDEX walks
+# the whole index (in its order), which costs as much as scanning the table
+SQLITE_SCAN = re.compile(r'^SCAN (\w+)(?: AS \w+)?(?: USING (?:COVERING )?INDEX \w+)?$')
+ALIAS_SUFFIX = re.compile(r'_\d+$')
+
+
+class StatementCapture:
+    """Statements and their first parameter set, per case, deduplicated by shape"""
+
+    def __init__(self, engine):
+        self.case = None
+        self.statements = {}
+        event.listen(engine, 'before_cursor_execute', self._on_execute)
+
+    def _on_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if self.case is None:
+            return
+        sql = ' '.join(statement.split())
+        if not sql.upper().startswith(EXPLAINED) or sql.upper() == 'SELECT 1':
+            return
+        if executemany:
+            parameters = parameters[0] if parameters else None
+        shape = PARAMETER_LIST.sub('(...)', sql)
+        self.statements.setdefault(self.case, {}).setdefault(
+            hashlib.sha1(shape.encode()).hexdigest()[:12], (statement, parameters)
+        )
+
+
+def seed_audit_history(bench, days):
+    """Audit rows in the shape log_audit_event writes: mostly access, some security events"""
+    backend = bench.backend
+    rng = random.Random(f'{PLAN_WORKLOAD["seed"]}:audit')
+    now = datetime.utcnow()
+    actions = ['ACCESS'] * 6 + ['LOGIN', 'UPDATE', 'CREATE', 'SECURITY_EVENT']
+    columns = ('user_id', 'action_type', 'resource_type', 'resource_id', 'ip_address', 'timestamp', 'success')
+    rows = (
+        (rng.choice(bench.patients), rng.choice(actions), rng.choice(['APPOINTMENT', 'PRESCRIPTION', 'USER']),
+         rng.randint(1, 50000), f'10.0.{rng.randint(0, 255)}.{rng.randint(1, 254)}',
+         now - timedelta(seconds=rng.uniform(0, days * 86400)), rng.random() > 0.05)
+        for _ in range(days * AUDIT_ROWS_PER_DAY)
+    )
+    with bench.app.app_context():
+        loaded = backend.bulk_load(backend.AuditLog, columns, rows)
+        admin = backend.User(username='bench_admin', email='admin@bench.local', password_hash='x',
+                             full_name='Bench Admin', role='admin')
+        backend.db.session.add(admin)
+        backend.db.session.commit()
+        bench.admin = bench.headers(admin.id, 'admin')
+    return loaded
+
+
+def doctor_queue_requests(bench, count):
+    pool = [bench.headers(user_id, 'doctor') for _, user_id, _ in bench.profiles]
+    return [(lambda headers=pool[i % len(pool)]: bench.client.get('/api/doctor/queue', headers=headers))
+            for i in range(count)]
+
+
+def queue_by_doctor_requests(bench, count):
+    pool = [(user_id, bench.headers(user_id, 'doctor')) for _, user_id, _ in bench.profiles]
+    return [
+        (lambda user_id=user_id, headers=headers: bench.client.get(f'/api/queue/{user_id}', headers=headers))
+        for user_id, headers in (pool[i % len(pool)] for i in range(count))
+    ]
+
+
+def wallboard_requests(bench, count):
+    with bench.app.app_context():
+        hospital_id = bench.backend.Hospital.query.order_by(bench.backend.Hospital.id).first().id
+    return [(lambda: bench.client.get(f'/api/wallboard?hospital_id={hospital_id}', headers=bench.admin))] * count
+
+
+def pharmacy_filter_requests(bench, count):
+    backend = bench.backend
+    with bench.app.app_context():
+        name = backend.db.session.get(backend.User, bench.patients[0]).full_name
+    paths = ['/api/pharmacy/prescriptions?status=pending&limit=20',
+             f'/api/pharmacy/prescriptions?search={name.split()[-1]}&limit=20',
+             '/api/pharmacy/prescriptions?date_from={0}&date_to={0}&limit=20'.format(bench.today.isoformat())]
+    return [(lambda path=paths[i % len(paths)]: bench.client.get(path, headers=bench.pharmacy)) for i in range(count)]
+
+
+def pharmacy_page_requests(bench, count):
+    return [(lambda page=i + 1: bench.client.get(f'/api/pharmacy/prescriptions?page={page}&limit=20&total=exact',
+                                                 headers=bench.pharmacy))
+            for i in range(count)]
+
+
+def pickup_requests(bench, count):
+    backend = bench.backend
+    Prescription = backend.Prescription
+    with bench.app.app_context():
+        tokens = backend.db.session.query(Prescription.pickup_date, Prescription.pickup_token).filter(
+            Prescription.pickup_token.isnot(None),
+            Prescription.pharmacy_status.in_(backend.ACTIVE_PHARMACY_STATUSES),
+            Prescription.is_deleted == False
+        ).order_by(Prescription.id.desc()).limit(count).all()
+        if not tokens:
+            # Before clinic hours the seeder has issued no tokens yet: hand one out so the case has work
+            prescription = Prescription.query.filter_by(is_deleted=False).order_by(Prescription.id.desc()).first()
+            prescription.pharmacy_status = 'pending'
+            prescription.pickup_date, prescription.pickup_token = backend.issue_pickup_token(bench.today)
+            backend.db.session.commit()
+            tokens = [(prescription.pickup_date, prescription.pickup_token)]
+    return [(lambda path=f'/api/pharmacy/pickup/{token}?date={day.isoformat()}':
+             bench.client.get(path, headers=bench.pharmacy))
+            for day, token in tokens]
+
+
+def inventory_requests(bench, count):
+    paths = ['/api/pharmacy/inventory', '/api/pharmacy/low-stock', '/api/pharmacy/batches/expiring']
+    return [(lambda path=paths[i % len(paths)]: bench.client.get(path, headers=bench.pharmacy)) for i in range(count)]
+
+
+def patient_search_requests(bench, count):
+    backend = bench.backend
+    with bench.app.app_context():
+        names = [name for name, in backend.db.session.query(backend.User.full_name).filter(
+            backend.User.id.in_(bench.patients[:count])
+        )]
+    return [(lambda term=name[:4]: bench.client.get(f'/api/pharmacy/patients/search?q={term}', headers=bench.pharmacy))
+            for name in names]
+
+
+def security_audit_requests(bench, count):
+    return [(lambda: bench.client.get('/api/admin/security-audit', headers=bench.admin))] * count
+
+
+CASES = {
+    'book_appointment': book_requests,
+    'queue_status': queue_status_requests,
+    'call_next': call_next_requests,
+    'doctor_queue': doctor_queue_requests,
+    'queue_by_doctor': queue_by_doctor_requests,
+    'wallboard': wallboard_requests,
+    'daily_summary': daily_summary_requests,
+    'pharmacy_list': pharmacy_list_requests,
+    'pharmacy_filters': pharmacy_filter_requests,
+    'pharmacy_pages': pharmacy_page_requests,
+    'pickup_lookup': pickup_requests,
+    'inventory': inventory_requests,
+    'patient_search': patient_search_requests,
+    'dispense': dispense_requests,
+    'security_audit': security_audit_requests,
+}
+
+
+def table_sizes(conn, dialect, tables):
+    if dialect == 'postgresql':
+        return {name: int(rows) for name, rows in conn.execute(text(
+            "SELECT c.relname, c.reltuples FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace "
+            "WHERE c.relkind = 'r' AND n.nspname = current_schema()"
+        ))}
+    return {table: conn.execute(text(f'SELECT COUNT(*) FROM "{table}"')).scalar() for table in tables}
+
+
+def _plan_nodes(node):
+    yield node
+    for child in node.get('Plans', []):
+        yield from _plan_nodes(child)
+
+
+def explain(dbapi_connection, dialect, statement, parameters):
+    """(full scans as table names, total cost or None, plan summary)"""
+    cursor = dbapi_connection.cursor()
+    try:
+        if dialect == 'postgresql':
+            cursor.execute('EXPLAIN (FORMAT JSON) ' + statement, parameters or None)
+            plan = cursor.fetchone()[0]
+            root = (json.loads(plan) if isinstance(plan, str) else plan)[0]['Plan']
+            nodes = list(_plan_nodes(root))
+            # An index scan with a Filter but no Index Cond reads the whole index
+            scans = [
+                node['Relation Name'] for node in nodes
+                if node['Node Type'] == 'Seq Scan'
+                or (node['Node Type'] in ('Index Scan', 'Index Only Scan')
+                    and 'Filter' in node and 'Index Cond' not in node)
+            ]
+            summary = ' > '.join(
+                f"{node['Node Type']}" + (f" on {node['Relation Name']}" if 'Relation Name' in node else '')
+                for node in nodes
+            )
+            return scans, root['Total Cost'], summary
+        cursor.execute('EXPLAIN QUERY PLAN ' + statement, parameters or ())
+        details = [row[3] for row in cursor.fetchall()]
+        scans = [match.group(1) for match in map(SQLITE_SCAN.match, details) if match]
+        return scans, None, '; '.join(details)
+    finally:
+        cursor.close()
+        dbapi_connection.rollback()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--cases', nargs='*', choices=list(CASES), help='Subset of cases (default: all)')
+    parser.add_argument('--database-url', help='Scratch database to seed instead of a temp SQLite file')
+    parser.add_argument('--reset', action='store_true', help='Drop and recreate all tables in --database-url first')
+    parser.add_argument('--large-rows', type=int, default=10000, help='Full scans of tables above this fail')
+    parser.add_argument('--max-cost', type=float, default=20000, help='Estimated cost ceiling per statement')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--update-baseline', action='store_true', help='Write the plan costs as the new baseline')
+    parser.add_argument('--threshold', type=float, default=0.5, help='Allowed relative cost increase')
+    parser.add_argument('--verbose', action='store_true', help='Print every statement with its plan')
+    args = parser.parse_args()
+
+    backend = load_app(args.database_url)
+    bench = Bench(backend)
+    started = perf_counter()
+    bench.seed(args.reset or not args.database_url, PLAN_WORKLOAD)
+    audit_rows = seed_audit_history(bench, PLAN_WORKLOAD['days'])
+    with backend.app.app_context():
+        engine = backend.db.engine
+        dialect = engine.dialect.name
+        with engine.begin() as conn:
+            # Fresh statistics, as autovacuum would have gathered on a live database
+            conn.execute(text('ANALYZE'))
+        capture = StatementCapture(engine)
+    print(f'Seeded {dialect} with {audit_rows} audit rows in {perf_counter() - started:.1f}s')
+
+    failed = []
+    for name in args.cases or CASES:
+        requests = CASES[name](bench, CALLS)
+        capture.case = name
+        for send in requests:
+            response = send()
+            if response.status_code >= 400:
+                failed.append(f'{name}: {response.status_code} {response.get_data(as_text=True)[:200]}')
+        capture.case = None
+
+    violations = []
+    costs = {}
+    with backend.app.app_context(), backend.db.engine.connect() as conn:
+        sizes = table_sizes(conn, dialect, [table.name for table in backend.db.metadata.sorted_tables])
+        large = {table for table, rows in sizes.items() if rows > args.large_rows}
+        dbapi_connection = conn.connection.dbapi_connection
+        print(f'Large tables (> {args.large_rows} rows): '
+              f'{", ".join(f"{table} {sizes[table]}" for table in sorted(large)) or "none"}')
+        print(f'{"case":<18}{"statements":>11}{"max cost":>11}  full scans of large tables')
+        for name in args.cases or CASES:
+            statements = capture.statements.get(name, {})
+            if not statements:
+                violations.append(f'{name}: captured no statements, so nothing was checked')
+            case_scans = set()
+            case_costs = []
+            details = []
+            for key, (statement, parameters) in statements.items():
+                try:
+                    scans, cost, summary = explain(dbapi_connection, dialect, statement, parameters)
+                except Exception as e:
+                    violations.append(f'{name} [{key}]: EXPLAIN failed ({e}): {" ".join(statement.split())[:200]}')
+                    continue
+                sql = ' '.join(statement.split())
+                details.append(f'  [{key}] {sql[:160]}\n      {summary}')
+                # SQLite names aliased tables (users AS users_1) by their alias
+                scanned = {table if table in sizes else ALIAS_SUFFIX.sub('', table) for table in scans}
+                for table in scanned & large:
+                    if (name, table) in ALLOWED_SCANS:
+                        continue
+                    case_scans.add(table)
+                    violations.append(f'{name} [{key}]: full scan of {table} ({sizes[table]} rows): {sql[:200]}')
+                if cost is not None:
+                    case_costs.append(cost)
+                    costs[key] = {'case': name, 'cost': cost, 'sql': sql[:200]}
+                    if cost > args.max_cost:
+                        violations.append(f'{name} [{key}]: estimated cost {cost:.0f} > {args.max_cost:.0f}: {sql[:200]}')
+            max_cost = f'{max(case_costs):.0f}' if case_costs else '-'
+            print(f'{name:<18}{len(statements):>11}{max_cost:>11}  {", ".join(sorted(case_scans)) or "-"}')
+            if args.verbose:
+                print('\n'.join(details))
+
+    if dialect != 'postgresql':
+        print(f'note: {dialect} has no cost estimates; run against PostgreSQL for the cost checks')
+    elif args.update_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump({'environment': {'dialect': dialect, 'workload': PLAN_WORKLOAD}, 'statements': costs}, f, indent=2)
+        print(f'Baseline written to {args.baseline}')
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)['statements']
+        for key, current in costs.items():
+            previous = baseline.get(key)
+            if previous and current['cost'] > previous['cost'] * (1 + args.threshold):
+                violations.append(f'{current["case"]} [{key}]: cost {previous["cost"]:.0f} -> {current["cost"]:.0f}: '
+                                  f'{current["sql"]}')
+        unseen = sorted(key for key in costs if key not in baseline)
+        if unseen:
+            print(f'note: {len(unseen)} statements not in the baseline (new or changed SQL): {", ".join(unseen)}')
+    else:
+        print(f'No baseline at {args.baseline}; run with --update-baseline to record one')
+
+    for failure in failed:
+        print(f'FAILED REQUEST {failure}')
+    for violation in violations:
+        print(f'VIOLATION {violation}')
+    if not failed and not violations:
+        print('All captured statements use indexes on large tables and stay within their cost bounds')
+    sys.exit(1 if failed or violations else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,266 @@
+"""
+Replay recorded API traffic (TRAFFIC_RECORD_PATH) against a test instance.
+
+Every recorded caller becomes a virtual user of the same role, mapped onto a real account
+in the test database (patients with appointments today first), and replays its requests in
+order at the recorded offsets divided by --speed. Path ids, *_id body and query fields and
+other values the recorder reduced to a type are filled from the test database, so the
+target should hold realistic data (e.g. `flask seed-synthetic`). Tokens are signed with
+the target's JWT secret, so no logins are needed; recorded logins go out with the virtual
+user's username and --password, each virtual user from its own X-Forwarded-For address.
+
+Usage:
+    python benchmarks/replay.py logs/traffic.log [logs/traffic.log.1 ...] \\
+        --target http://localhost:5000 --database-url sqlite:///instance/test.db \\
+        --jwt-secret "$JWT_SECRET_KEY" [--speed 10] [--duration 600] [--max-users 500]
+"""
+
+import argparse
+import http.client
+import json
+import re
+import sys
+import threading
+import time
+import uuid
+from collections import Counter, defaultdict
+from datetime import date, datetime, timedelta, timezone
+from urllib.parse import urlencode, urlsplit
+
+import jwt
+from sqlalchemy import create_engine, text
+
+RULE_ARGUMENT = re.compile(r'<(?:(\w+):)?(\w+)>')
+
+# (field name, converter/type) -> ids on the target; doctor_id is a user id in paths and a
+# profile id in booking bodies
+ID_SOURCES = {
+    ('doctor_id', 'int'): 'SELECT user_id FROM doctor_profiles WHERE active = :true',
+    ('doctor_id', 'str'): 'SELECT id FROM doctor_profiles WHERE active = :true',
+    ('appointment_id', 'int'): 'SELECT id FROM appointments WHERE appointment_date = :today',
+    ('prescription_id', 'int'): 'SELECT id FROM prescriptions ORDER BY id DESC LIMIT 5000',
+    ('medicine_id', 'int'): 'SELECT id FROM medicines',
+    ('hospital_id', 'str'): 'SELECT id FROM hospitals',
+    ('department_id', 'str'): 'SELECT id FROM departments',
+    ('user_id', 'int'): 'SELECT id FROM users',
+}
+# Ids a patient may only use for their own rows
+OWNED_SOURCES = {
+    'appointment_id': 'SELECT patient_id, id FROM appointments WHERE appointment_date = :today',
+    'prescription_id': 'SELECT patient_id, id FROM prescriptions ORDER BY id DESC LIMIT 20000',
+}
+
+
+def read_records(paths, duration):
+    records = []
+    for path in paths:
+        with open(path) as f:
+            records.extend(json.loads(line) for line in f if line.strip())
+    records.sort(key=lambda record: record['t'])
+    if records and duration:
+        cutoff = records[0]['t'] + duration
+        records = [record for record in records if record['t'] <= cutoff]
+    return records
+
+
+class Target:
+    """Accounts and id pools on the test database"""
+
+    def __init__(self, database_url):
+        engine = create_engine(database_url)
+        today = date.today()
+        params = {'today': today, 'true': True}
+        with engine.connect() as conn:
+            self.accounts = defaultdict(list)
+            for user_id, username, role in conn.execute(text(
+                'SELECT id, username, role FROM users WHERE is_active = :true ORDER BY id'
+            ), params):
+                self.accounts[role].append((user_id, username))
+            booked_today = {row[0] for row in conn.execute(text(
+                'SELECT DISTINCT patient_id FROM appointments WHERE appointment_date = :today'
+            ), params)}
+            self.accounts['patient'].sort(key=lambda account: account[0] not in booked_today)
+            self.ids = {key: [row[0] for row in conn.execute(text(sql), params)] for key, sql in ID_SOURCES.items()}
+            self.owned = {}
+            for name, sql in OWNED_SOURCES.items():
+                owned = defaultdict(list)
+                for owner, value in conn.execute(text(sql), params):
+                    owned[owner].append(value)
+                self.owned[name] = owned
+        engine.dispose()
+
+
+class VirtualUser(threading.Thread):
+    def __init__(self, index, role, account, records, options, target, start, results):
+        super().__init__(daemon=True)
+        self.index, self.role, self.records = index, role, records
+        self.user_id, self.username = account if account else (None, None)
+        self.options, self.target, self.start_at, self.results = options, target, start, results
+        self.headers = {'Content-Type': 'application/json',
+                        'X-Forwarded-For': f'10.{index // 65536 % 256}.{index // 256 % 256}.{index % 256}'}
+        if self.user_id is not None and role:
+            now = datetime.now(timezone.utc)
+            token = jwt.encode({
+                'sub': self.user_id, 'role': role, 'user_id': self.user_id, 'type': 'access', 'fresh': False,
+                'jti': str(uuid.uuid4()), 'iat': now, 'nbf': now, 'exp': now + timedelta(days=1)
+            }, options.jwt_secret, algorithm='HS256')
+            self.headers['Authorization'] = f'Bearer {token}'
+        self.counter = 0
+
+    def pick(self, name, kind):
+        if self.role == 'patient' and name in OWNED_SOURCES:
+            own = self.target.owned[name].get(self.user_id)
+            if own:
+                self.counter += 1
+                return own[self.counter % len(own)]
+        pool = self.target.ids.get((name, kind)) or self.target.ids.get((name, 'int' if kind == 'str' else 'str'))
+        if not pool:
+            return None
+        self.counter += 1
+        return pool[(self.index * 7919 + self.counter) % len(pool)]
+
+    def fill(self, name, shape):
+        """A value for a field the recorder reduced to its type"""
+        if isinstance(shape, dict):
+            return {key: self.fill(key, value) for key, value in shape.items()}
+        if isinstance(shape, list):
+            return [self.fill(name, shape[0])] if shape else []
+        if name.endswith('_id'):
+            value = self.pick(name, shape)
+            if value is not None:
+                return value
+        if name in ('username', 'email'):
+            return self.username or 'replay'
+        if name == 'password':
+            return self.options.password
+        if 'date' in name:
+            return date.today().isoformat()
+        return {'int': 1, 'float': 1.0, 'bool': False, 'NoneType': None}.get(shape, 'replay')
+
+    def build(self, record):
+        missing = []
+
+        def argument(match):
+            converter, name = match.group(1) or 'str', match.group(2)
+            value = self.pick(name, 'int' if converter == 'int' else 'str')
+            if value is None:
+                missing.append(name)
+            return str(value)
+
+        path = RULE_ARGUMENT.sub(argument, record['r'])
+        if missing:
+            return None, None
+        query = {name: value if value not in ('int', 'str') else self.fill(name, value)
+                 for name, value in (record.get('q') or {}).items()}
+        if query:
+            path += '?' + urlencode(query)
+        body = json.dumps(self.fill('', record['b'])) if 'b' in record else None
+        return path, body
+
+    def run(self):
+        url = urlsplit(self.options.target)
+        connection_class = http.client.HTTPSConnection if url.scheme == 'https' else http.client.HTTPConnection
+        connection = None
+        origin = self.options.origin
+        for record in self.records:
+            path, body = self.build(record)
+            if path is None:
+                self.results.append((record['r'], 'skipped', None, None, record['s']))
+                continue
+            due = self.start_at + (record['t'] - origin) / self.options.speed
+            lag = time.monotonic() - due
+            if lag < 0:
+                time.sleep(-lag)
+                lag = 0.0
+            if connection is None:
+                connection = connection_class(url.hostname, url.port, timeout=30)
+            sent = time.perf_counter()
+            try:
+                connection.request(record['m'], path, body=body, headers=self.headers)
+                response = connection.getresponse()
+                response.read()
+                status = response.status
+            except (OSError, http.client.HTTPException):
+                connection.close()
+                connection = None
+                status = 'error'
+            self.results.append((record['r'], status, time.perf_counter() - sent, lag, record['s']))
+        if connection is not None:
+            connection.close()
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, round(fraction * (len(ordered) - 1)))] if ordered else 0.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('logs', nargs='+', help='Traffic log files (rotated files may be listed too)')
+    parser.add_argument('--target', required=True, help='Base URL of the test instance')
+    parser.add_argument('--database-url', required=True, help="The test instance's database, for accounts and ids")
+    parser.add_argument('--jwt-secret', required=True, help="The test instance's JWT_SECRET_KEY")
+    parser.add_argument('--speed', type=float, default=1.0, help='Replay N times faster than recorded')
+    parser.add_argument('--duration', type=float, help='Only the first N recorded seconds')
+    parser.add_argument('--max-users', type=int, default=1000, help='Cap on concurrent virtual users')
+    parser.add_argument('--password', default='password123', help='Password sent for recorded logins')
+    args = parser.parse_args()
+
+    records = read_records(args.logs, args.duration)
+    if not records:
+        raise SystemExit('No records to replay')
+    args.origin = records[0]['t']
+    span = records[-1]['t'] - records[0]['t']
+
+    callers = defaultdict(list)
+    for record in records:
+        callers[(record.get('u'), record['k'])].append(record)
+    if len(callers) > args.max_users:
+        busiest = sorted(callers, key=lambda caller: len(callers[caller]), reverse=True)[:args.max_users]
+        print(f'note: replaying the {args.max_users} busiest of {len(callers)} callers')
+        callers = {caller: callers[caller] for caller in busiest}
+
+    target = Target(args.database_url)
+    per_role = Counter()
+    results = []
+    start = time.monotonic() + 1.0
+    users = []
+    for index, ((role, _), user_records) in enumerate(sorted(callers.items(), key=lambda item: item[1][0]['t'])):
+        accounts = target.accounts.get(role or 'patient') or [None]
+        account = accounts[per_role[role] % len(accounts)]
+        per_role[role] += 1
+        if role and account is None:
+            print(f'note: no {role} accounts on the target; {len(user_records)} requests will fail auth')
+        users.append(VirtualUser(index, role, account, user_records, args, target, start, results))
+    print(f'Replaying {sum(len(user.records) for user in users)} requests from {len(users)} virtual users '
+          f'({dict(per_role)}) recorded over {span:.0f}s at {args.speed}x')
+    for user in users:
+        user.start()
+    for user in users:
+        user.join()
+    elapsed = time.monotonic() - start
+
+    sent = [result for result in results if result[1] != 'skipped']
+    skipped = len(results) - len(sent)
+    lags = [result[3] for result in sent]
+    print(f'Sent {len(sent)} in {elapsed:.1f}s ({len(sent) / elapsed:.1f} req/s, recorded '
+          f'{len(records) / max(span, 1e-9) * args.speed:.1f} req/s at this speed); skipped {skipped} '
+          f'without ids; schedule lag p95 {percentile(lags, 0.95) * 1000:.0f} ms')
+
+    by_route = defaultdict(list)
+    for result in sent:
+        by_route[result[0]].append(result)
+    print(f'{"route":<52}{"count":>7}{"p50 ms":>9}{"p95 ms":>9}{"errors":>8}{"same status":>13}')
+    for route, route_results in sorted(by_route.items(), key=lambda item: -len(item[1]))[:25]:
+        latencies = [latency for _, _, latency, _, _ in route_results if latency is not None]
+        errors = sum(1 for _, status, _, _, _ in route_results if status == 'error' or status >= 500)
+        same = sum(1 for _, status, _, _, recorded in route_results if status == recorded)
+        print(f'{route[:51]:<52}{len(route_results):>7}{percentile(latencies, 0.5) * 1000:>9.1f}'
+              f'{percentile(latencies, 0.95) * 1000:>9.1f}{errors:>8}{same / len(route_results):>13.0%}')
+    statuses = Counter(str(result[1]) for result in sent)
+    print(f'Statuses: {dict(sorted(statuses.items()))}')
+    sys.exit(1 if statuses.get('error') else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+"""
+Serialization benchmark: to_dict() + stdlib json vs RowSchema rows + FastJSONProvider.
+
+Seeds a throwaway SQLite database with N appointments, prescriptions and medicines,
+then times both paths over the same loaded objects (the DB query is excluded so only
+serialization is measured).
+
+Usage:
+    python benchmarks/serialization.py [--rows 5000] [--repeat 5]
+"""
+
+import argparse
+import json
+from time import perf_counter
+
+from common import load_app, seed
+
+
+def timed(fn, repeat):
+    best = float('inf')
+    size = 0
+    for _ in range(repeat):
+        start = perf_counter()
+        size = len(fn())
+        best = min(best, perf_counter() - start)
+    return best, size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=5000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    backend = load_app()
+    app = backend.app
+
+    with app.app_context():
+        seed(backend, args.rows)
+
+        appointments = backend.Appointment.query.options(*backend.APPOINTMENT_ROW_LOADERS).all()
+        prescriptions = backend.Prescription.query.options(*backend.PRESCRIPTION_ROW_LOADERS).all()
+        medicines = backend.Medicine.query.all()
+
+        cases = [
+            ('appointments', appointments, backend.APPOINTMENT_ROWS,
+             lambda objs: backend.appointment_row_context(objs)),
+            ('prescriptions', prescriptions, backend.PRESCRIPTION_ROWS, lambda objs: None),
+            ('medicines', medicines, backend.MEDICINE_ROWS, lambda objs: None),
+        ]
+
+        print(f'JSON backend: {backend.FAST_JSON_BACKEND or "stdlib"}, rows: {args.rows}, best of {args.repeat}')
+        print(f'{"payload":<15}{"to_dict+json":>15}{"schema+fast":>15}{"speedup":>10}')
+        for name, objs, schema, context in cases:
+            # Same settings as Flask's DefaultJSONProvider; Appointment.to_dict() also queries
+            # DoctorProfile per row, exactly as the endpoints used to
+            baseline, baseline_size = timed(
+                lambda: json.dumps([o.to_dict() for o in objs], sort_keys=True, separators=(',', ':')).encode(),
+                args.repeat
+            )
+            fast, fast_size = timed(lambda: app.json._encode(schema.rows(objs, context(objs))), args.repeat)
+            print(f'{name:<15}{baseline * 1000:>12.1f} ms{fast * 1000:>12.1f} ms{baseline / fast:>9.1f}x')
+            if abs(baseline_size - fast_size) > baseline_size * 0.05:
+                print(f'  note: payload sizes differ ({baseline_size} vs {fast_size} bytes)')
+
+
+if __name__ == '__main__':
+    main()
@@ -100,6 +100,7 @@ const DoctorControlPanel = () => {
   });
   const [showRx, setShowRx] = useState(false);
   const [showMedDropdown, setShowMedDropdown] = useState(false);
+  const [inventoryMatches, setInventoryMatches] = useState([]);
   
   const prevQueueRef = useRef([]);
   const medInputRef = useRef(null);
@@ -357,6 +358,21 @@ const DoctorControlPanel = () => {
     }
   };
 
+  // Pharmacy inventory lookup - served from an in-memory index, cheap enough per keystroke
+  const searchInventory = async (value) => {
+    setMedForm(prev => ({ ...prev, name: value }));
+    if (value.trim().length < 2) {
+      setInventoryMatches([]);
+      return;
+    }
+    try {
+      const res = await doctorAPI.autocompleteMedicines(value);
+      setInventoryMatches(Array.isArray(res.data) ? res.data : []);
+    } catch {
+      setInventoryMatches([]);
+    }
+  };
+
   const addMedicine = () => {
     if (!medForm.name.trim()) return;
     
@@ -700,6 +716,20 @@ const DoctorControlPanel = () => {
                           </select>
                         );
                       })()}
+                      <input
+                        list="dcp-inventory-medicines"
+                        value={medForm.name}
+                        onChange={e => searchInventory(e.target.value)}
+                        placeholder="Search pharmacy stock..."
+                        className="dcp-med-select"
+                      />
+                      <datalist id="dcp-inventory-medicines">
+                        {inventoryMatches.map(m => (
+                          <option key={m.id} value={m.name}>
+                            {m.generic_name || ''}
+                          </option>
+                        ))}
+                      </datalist>
                       <select
                         value={medForm.dosage}
                         onChange={e => setMedForm(prev => ({...prev, dosage: e.target.value}))}
@@ -1,6 +1,6 @@
 ﻿import { useState, useEffect, useRef } from 'react';
 import { useAuth } from '../contexts/AuthContext';
-import api from '../utils/api';
+import api, { pharmacyAPI } from '../utils/api';
 import { Pill, ClipboardList, Package, ChevronRight, X, RefreshCw, Plus, Check, RotateCcw } from 'lucide-react';
 import './PharmacyDashboard.css';
 
@@ -21,7 +21,10 @@ const PharmacyDashboard = () => {
   const [records, setRecords] = useState([]);
   const [recPage, setRecPage] = useState(1);
   const [recTotal, setRecTotal] = useState(0);
+  const [recTotalEstimate, setRecTotalEstimate] = useState(false);
   const [recPages, setRecPages] = useState(0);
+  // Keyset cursors: recCursors[n] fetches page n+1 (page 1 needs none)
+  const [recCursors, setRecCursors] = useState([null]);
   const [searchQuery, setSearchQuery] = useState('');
   const [statusFilter, setStatusFilter] = useState('all');
   const [dateFrom, setDateFrom] = useState('');
@@ -51,6 +54,28 @@ const PharmacyDashboard = () => {
     if (activeTab === 'records') loadRecords();
   }, [recPage, statusFilter, activeTab]);
 
+  /* ── Low-stock events (pushed by the server instead of polling) ── */
+  useEffect(() => {
+    if (activeTab !== 'inventory') return;
+    const source = pharmacyAPI.lowStockStream();
+    source.addEventListener('change', (e) => {
+      const ev = JSON.parse(e.data);
+      setMedicines(list => list.map(m => m.id === ev.medicine_id
+        ? { ...m, stock_quantity: ev.stock_quantity, reorder_level: ev.reorder_level, stock_status: ev.stock_status || m.stock_status }
+        : m));
+    });
+    // Sent on connect, and again when the server's event backlog no longer reaches our
+    // last id: then medicines may also have left the low-stock list, so re-read them all
+    let connected = false;
+    source.addEventListener('snapshot', (e) => {
+      if (connected) { loadInventory(); return; }
+      connected = true;
+      const low = new Map(JSON.parse(e.data).map(row => [row.id, row]));
+      setMedicines(list => list.map(m => low.has(m.id) ? { ...m, ...low.get(m.id) } : m));
+    });
+    return () => source.close();
+  }, [activeTab]);
+
   useEffect(() => {
     if (activeTab === 'inventory') loadInventory();
   }, [activeTab]);
@@ -67,14 +92,20 @@ const PharmacyDashboard = () => {
   const loadRecords = async () => {
     try {
       setLoading(true);
-      const p = new URLSearchParams({ page: recPage, limit: 20, status: statusFilter });
+      const p = new URLSearchParams({ limit: 20, status: statusFilter, total: 'approx' });
+      const cursor = recPage > 1 ? recCursors[recPage - 1] : null;
+      if (cursor) p.append('cursor', cursor);
       if (searchQuery) p.append('search', searchQuery);
       if (dateFrom) p.append('date_from', dateFrom);
       if (dateTo) p.append('date_to', dateTo);
       const r = await api.get(`/api/pharmacy/prescriptions?${p}`);
       setRecords(r.data.prescriptions || []);
       setRecTotal(r.data.total || 0);
-      setRecPages(r.data.pages || 0);
+      setRecTotalEstimate(!!r.data.total_is_estimate);
+      setRecCursors(c => [...c.slice(0, recPage), r.data.next_cursor]);
+      // The total may be a planner estimate, so never report fewer pages than we can reach
+      const estimated = Math.ceil((r.data.total || 0) / 20);
+      setRecPages(r.data.has_more ? Math.max(estimated, recPage + 1) : recPage);
     } catch { setError('Failed to load records'); }
     finally { setLoading(false); }
   };
@@ -180,7 +211,8 @@ const PharmacyDashboard = () => {
     return null;
   };
 
-  const stockClass = (qty) => qty < 10 ? 'critical' : qty < 50 ? 'low' : 'ok';
+  // stock_status comes from the server, relative to each medicine's reorder level
+  const stockClass = (m) => (!m.stock_status || m.stock_status === 'available') ? 'ok' : m.stock_status;
   const stockPct   = (qty, reorder) => Math.min(100, Math.round((qty / Math.max(reorder * 3, 100)) * 100));
 
   /* ── Stats ── */
@@ -434,7 +466,7 @@ const PharmacyDashboard = () => {
             <div className="ph-card">
               <div className="ph-card-hdr">
                 <span className="ph-card-title">Prescription Records</span>
-                <span className="ph-card-meta">{recTotal} total</span>
+                <span className="ph-card-meta">{recTotalEstimate ? '~' : ''}{recTotal} total</span>
               </div>
               <div className="ph-table-wrap">
                 {loading ? (
@@ -482,7 +514,7 @@ const PharmacyDashboard = () => {
                 <div className="ph-pagination">
                   <button className="ph-btn ph-btn-ghost ph-btn-sm" onClick={() => setRecPage(p => Math.max(1, p-1))} disabled={recPage===1}>← Prev</button>
                   <span>Page {recPage} of {recPages}</span>
-                  <button className="ph-btn ph-btn-ghost ph-btn-sm" onClick={() => setRecPage(p => Math.min(recPages, p+1))} disabled={recPage===recPages}>Next →</button>
+                  <button className="ph-btn ph-btn-ghost ph-btn-sm" onClick={() => setRecPage(p => p+1)} disabled={!recCursors[recPage]}>Next →</button>
                 </div>
               )}
             </div>
@@ -517,7 +549,7 @@ const PharmacyDashboard = () => {
                   </thead>
                   <tbody>
                     {medicines.map(m => {
-                      const sc = stockClass(m.stock_quantity);
+                      const sc = stockClass(m);
                       const pct = stockPct(m.stock_quantity, m.reorder_level);
                       return (
                         <tr key={m.id} className="ph-row-static">
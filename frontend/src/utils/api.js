@@ -88,6 +88,26 @@ const ensureArray = (data, ...keys) => {
   return [];
 };
 
+// Conditional GET for versioned endpoints: replays the last ETag as If-None-Match
+// and serves the cached body when the server answers 304 Not Modified
+const etagCache = new Map();
+
+const conditionalGet = async (url) => {
+  const cached = etagCache.get(url);
+  const response = await api.get(url, {
+    headers: cached ? { 'If-None-Match': cached.etag } : {},
+    validateStatus: (status) => (status >= 200 && status < 300) || status === 304,
+  });
+  if (response.status === 304 && cached) {
+    return { ...response, data: cached.data, notModified: true };
+  }
+  const etag = response.headers?.etag;
+  if (etag) {
+    etagCache.set(url, { etag, data: response.data });
+  }
+  return response;
+};
+
 // Authentication APIs
 export const authAPI = {
   login: (credentials) => api.post('/api/auth/login', credentials),
@@ -112,11 +132,15 @@ export const patientAPI = {
 export const doctorAPI = {
   getProfile: () => api.get('/api/doctor/profile'),
   updateProfile: (data) => api.post('/api/doctor/profile', data),
-  getQueue: () => api.get('/api/doctor/queue'),                                          // uses JWT — no user.id needed
+  getQueue: () => conditionalGet('/api/doctor/queue'),                                   // uses JWT; 304 when the queue version is unchanged
+  getQueueChanges: (since) => api.get(`/api/doctor/queue?since=${since}`, {
+    validateStatus: (status) => (status >= 200 && status < 300) || status === 304,
+  }),                                                                                     // delta sync: appointments changed after `since`
   callNext: () => api.post('/api/doctor/call-next'),                                     // uses the correct doctor endpoint
   completeConsultation: (data) => api.post('/api/doctor/complete-consultation', data),   // handles prescription + status in one call
   createPrescription: (data) => api.post('/api/prescriptions', data),                    // standalone prescription creation
-  getDailySummary: (date) => api.get(`/api/doctor/daily-summary?date=${date || new Date().toISOString().slice(0,10)}`),
+  autocompleteMedicines: (q, limit = 10) => api.get('/api/medicines/autocomplete', { params: { q, limit } }), // in-memory prefix/typo lookup over pharmacy stock
+  getDailySummary: (date) => conditionalGet(`/api/doctor/daily-summary?date=${date || new Date().toISOString().slice(0,10)}`), // counts only; 304 when the queue version is unchanged
   updateAppointmentStatus: (id, status) => api.put(`/api/appointments/${id}`, { status }),
 };
 
@@ -126,6 +150,11 @@ export const pharmacyAPI = {
   updatePrescriptionStatus: (id, data) => api.put(`/api/pharmacy/prescriptions/${id}/status`, data),
   getMedicines: () => api.get('/api/pharmacy/medicines'),
   getLowStock: () => api.get('/api/pharmacy/low-stock'),
+  // EventSource can't send headers, so the token goes in the query string
+  lowStockStream: () => new EventSource(
+    `${api.defaults.baseURL}/api/pharmacy/low-stock/stream?jwt=${encodeURIComponent(localStorage.getItem('token') || '')}`
+  ),
+  lookupPickup: (token) => api.get(`/api/pharmacy/pickup/${encodeURIComponent(token)}`),
   getStats: () => api.get('/api/stats'),
 };
 